@@ -0,0 +1,222 @@
+import time
+
+import numpy as np
+
+
+class AlignmentEngine:
+    """
+    Automatic alignment of the input, output and focus fibers when tracking leaves the NanoTrak window.
+
+    Each side pairs a NanoTrak with the stepper motor that moves along its horizontal piezo axis. A compass
+    pattern search on the NanoTrak signal first runs over the motor and the vertical piezo axis with the
+    horizontal piezo held in the centre, which brings the spot back into the piezo range, and then refines
+    over both piezo axes.
+    """
+    WINDOW = (2.0, 8.0)
+    CENTER = 5.0
+
+    def __init__(self, apt_tab, nt_to_mm=0.002, motor_step=0.002, motor_min_step=0.0002, piezo_step=0.5, piezo_min_step=0.05, max_evaluations=200):
+        """
+        :param apt_tab: The APT tab holding the NanoTraks and motors.
+        :type apt_tab: APTTab
+        :param nt_to_mm: Motor travel in mm that corresponds to one NT unit of the piezo.
+        :type nt_to_mm: float
+        :param motor_step: Initial pattern search step of the motors in mm.
+        :type motor_step: float
+        :param motor_min_step: Motor step in mm at which the coarse search stops.
+        :type motor_min_step: float
+        :param piezo_step: Initial pattern search step of the piezos in NT units.
+        :type piezo_step: float
+        :param piezo_min_step: Piezo step in NT units at which the fine search stops.
+        :type piezo_min_step: float
+        :param max_evaluations: Maximum number of signal readings per search.
+        :type max_evaluations: int
+        """
+        self.apt_tab = apt_tab
+        self.nt_to_mm = nt_to_mm
+        self.motor_step = motor_step
+        self.motor_min_step = motor_min_step
+        self.piezo_step = piezo_step
+        self.piezo_min_step = piezo_min_step
+        self.max_evaluations = max_evaluations
+        self.history = []
+
+    def sides(self):
+        """Returns the (name, NanoTrak, motor) triples that are aligned."""
+        return (('input', self.apt_tab.InputNT, self.apt_tab.MotorIN),
+                ('output', self.apt_tab.OutputNT, self.apt_tab.MotorOUT),
+                ('focus', self.apt_tab.FocusNT, self.apt_tab.MotorFocus))
+
+    def in_window(self, position):
+        """Checks if a NanoTrak position lies inside the tracking window."""
+        return self.WINDOW[0] < position < self.WINDOW[1]
+
+    def move_motor(self, motor, distance):
+        """Moves a motor relative and waits until it has stopped."""
+        motor.move_relative(distance)
+        motor.wait_for_move()
+
+    def pattern_search(self, axes, signal, stop_event=None):
+        """
+        Maximises the signal with a compass search: each axis is tried one step in both directions, an
+        improvement is kept and the step of an axis is halved when neither direction improves.
+
+        :param axes: (move, step, min_step) per axis, move(delta) moves the axis relative by delta.
+        :type axes: list
+        :param signal: Returns the signal at the current position.
+        :type signal: callable
+        :param stop_event: Ends the search early when set.
+        :type stop_event: threading.Event
+        :return: The best signal and the number of signal readings.
+        :rtype: tuple
+        """
+        steps = [step for _, step, _ in axes]
+        best = signal()
+        evaluations = 1
+        while evaluations < self.max_evaluations and not (stop_event is not None and stop_event.is_set()):
+            if all(step < min_step for step, (_, _, min_step) in zip(steps, axes)):
+                break
+            for index, (move, _, min_step) in enumerate(axes):
+                if steps[index] < min_step:
+                    continue
+                improved = False
+                for direction in (1, -2):
+                    move(direction * steps[index])
+                    value = signal()
+                    evaluations += 1
+                    if value > best:
+                        best = value
+                        improved = True
+                        break
+                if not improved:
+                    # Back to the starting point of this axis
+                    move(steps[index])
+                    steps[index] /= 2
+        return best, evaluations
+
+    def align(self, nanotrak, motor, stop_event=None):
+        """
+        Aligns one side: coarse search over the motor and the vertical piezo axis, then fine search over both piezo axes.
+
+        :return: The final signal and the number of signal readings.
+        :rtype: tuple
+        """
+        horz_pos, vert_pos, _ = nanotrak.circ_position()
+        position = {'horz': self.CENTER, 'vert': float(np.clip(vert_pos, 0, 10))}
+
+        def move_piezo(axis):
+            def move(delta):
+                position[axis] = float(np.clip(position[axis] + delta, 0, 10))
+                nanotrak.move_and_settle(position['horz'], position['vert'])
+            return move
+
+        def read_signal():
+            return nanotrak.circ_position()[2]
+
+        # The first motor step covers the horizontal offset of the spot, the search picks the direction
+        nanotrak.move_and_settle(position['horz'], position['vert'])
+        motor_step = max(abs(horz_pos - self.CENTER) * self.nt_to_mm, self.motor_step)
+        coarse_axes = [(lambda delta: self.move_motor(motor, delta), motor_step, self.motor_min_step),
+                       (move_piezo('vert'), self.piezo_step, self.piezo_min_step)]
+        _, coarse_evaluations = self.pattern_search(coarse_axes, read_signal, stop_event)
+
+        fine_axes = [(move_piezo('horz'), self.piezo_step, self.piezo_min_step),
+                     (move_piezo('vert'), self.piezo_step, self.piezo_min_step)]
+        best, fine_evaluations = self.pattern_search(fine_axes, read_signal, stop_event)
+        return best, coarse_evaluations + fine_evaluations
+
+    def recover(self, stop_event=None):
+        """
+        Aligns every side whose NanoTrak position is outside the tracking window.
+
+        :param stop_event: Ends the alignment early when set.
+        :type stop_event: threading.Event
+        :return: Whether all NanoTraks are inside the window afterwards, the aligned sides, signal readings and seconds.
+        :rtype: dict
+        """
+        time_start = time.perf_counter()
+        evaluations = 0
+        aligned = []
+        for name, nanotrak, motor in self.sides():
+            horz_pos, vert_pos, _ = nanotrak.circ_position()
+            if self.in_window(horz_pos) and self.in_window(vert_pos):
+                continue
+            _, side_evaluations = self.align(nanotrak, motor, stop_event)
+            evaluations += side_evaluations
+            aligned.append(name)
+        result = {'recovered': bool(self.apt_tab.get_circ_position_all()), 'sides': aligned, 'evaluations': evaluations, 'time_s': time.perf_counter() - time_start}
+        self.history.append(result)
+        return result
+
+    def summary(self):
+        """Returns the number of recoveries with their mean signal readings and seconds as text."""
+        if not self.history:
+            return "No automatic alignments."
+        evaluations = np.mean([result['evaluations'] for result in self.history])
+        seconds = np.mean([result['time_s'] for result in self.history])
+        failed = sum(not result['recovered'] for result in self.history)
+        return f"{len(self.history)} automatic alignments, {evaluations:.0f} evaluations and {seconds:.1f}s per recovery, {failed} failed."
+
+
+class AlignmentCache:
+    """
+    Alignment of every waveguide from the first pass over the chip, reused on the later current steps.
+
+    An entry holds the absolute motor positions, the latched NanoTrak positions and the NanoTrak signals,
+    and the measurement state the alignment was found with, so the records of later passes carry it.
+    A later pass moves straight to the entry and only has to confirm that no signal dropped by more than
+    margin, relative to the cached signal.
+    """
+    def __init__(self, margin=0.05):
+        """
+        :param margin: Relative signal drop below the cached signal at which the waveguide is tracked again.
+        :type margin: float
+        """
+        self.margin = margin
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, key, motor_positions, nanotrak_positions, signals, state=None):
+        """
+        Stores the alignment of a waveguide.
+
+        :param key: The waveguide
+        :type key: int
+        :param motor_positions: Absolute positions of the input, output and focus motors in mm
+        :type motor_positions: tuple
+        :param nanotrak_positions: Latched (horizontal, vertical) positions of the input, output and focus NanoTraks in NT units
+        :type nanotrak_positions: tuple
+        :param signals: Signals of the input, output and focus NanoTraks
+        :type signals: tuple
+        :param state: The coupling fit parameters, coupling scan log line and tracking offsets of the alignment
+        :type state: dict
+        """
+        self.entries[key] = {'motor_positions': tuple(motor_positions), 'nanotrak_positions': tuple(nanotrak_positions), 'signals': tuple(signals), 'state': dict(state or {})}
+
+    def get(self, key):
+        """Returns the cached alignment of a waveguide or None."""
+        return self.entries.get(key)
+
+    def verify(self, key, signals):
+        """
+        Checks the signals after moving to a cached alignment.
+
+        :param key: The waveguide
+        :type key: int
+        :param signals: Signals of the input, output and focus NanoTraks at the cached alignment
+        :type signals: tuple
+        :return: True if no signal is more than margin below its cached value
+        :rtype: bool
+        """
+        cached = np.array(self.entries[key]['signals'], dtype=float)
+        verified = bool(np.all(np.asarray(signals, dtype=float) >= cached - self.margin * np.abs(cached)))
+        if verified:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return verified
+
+    def summary(self):
+        """Returns the number of verified and re-tracked cached alignments as text."""
+        return f"Alignment cache: {len(self.entries)} waveguides, {self.hits} verified, {self.misses} tracked again."
@@ -0,0 +1,287 @@
+import json
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+
+def gaus(x, a, x0, sigma):
+    """
+    Gaussian function for fitting the power array.
+
+    :param x: The x values
+    :type x: np.ndarray
+    :param a: The amplitude of the Gaussian function
+    :type a: float
+    :param x0: The mean of the Gaussian function
+    :type x0: float
+    :param sigma: The standard deviation of the Gaussian function
+    :type sigma: float
+    :return: The Gaussian function
+    :rtype: np.ndarray
+    """
+    return a*np.exp(-(x-x0)**2/(2*sigma**2))
+
+
+def gaus_jacobian(x, a, x0, sigma):
+    """Analytic Jacobian of gaus with respect to (a, x0, sigma)."""
+    dx = x - x0
+    e = np.exp(-dx**2/(2*sigma**2))
+    return np.column_stack((e, a*e*dx/sigma**2, a*e*dx**2/sigma**3))
+
+
+def quadratic_form(sigma_x, sigma_y, theta):
+    """Returns the coefficients (a, b, c) of the rotated 2D Gaussian exponent a*dx^2 + 2*b*dx*dy + c*dy^2."""
+    cos_2 = np.cos(theta)**2
+    sin_2 = np.sin(theta)**2
+    sin_2theta = np.sin(2*theta)
+    a = cos_2/(2*sigma_x**2) + sin_2/(2*sigma_y**2)
+    b = -sin_2theta/(4*sigma_x**2) + sin_2theta/(4*sigma_y**2)
+    c = sin_2/(2*sigma_x**2) + cos_2/(2*sigma_y**2)
+    return a, b, c
+
+
+def gaus_2d(XY, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    """
+    Rotated 2D Gaussian with offset for fitting the power map.
+
+    :param XY: The positions with shape (points, 2)
+    :type XY: np.ndarray
+    :return: The 2D Gaussian function at the positions
+    :rtype: np.ndarray
+    """
+    x, y = XY[:, 0], XY[:, 1]
+    a, b, c = quadratic_form(sigma_x, sigma_y, theta)
+    dx = x - float(xo)
+    dy = y - float(yo)
+    g = offset + amplitude*np.exp(-(a*dx**2 + 2*b*dx*dy + c*dy**2))
+    return g.ravel()
+
+
+def gaus_2d_jacobian(XY, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    """Analytic Jacobian of gaus_2d with respect to (amplitude, xo, yo, sigma_x, sigma_y, theta, offset)."""
+    x, y = XY[:, 0], XY[:, 1]
+    a, b, c = quadratic_form(sigma_x, sigma_y, theta)
+    dx = x - xo
+    dy = y - yo
+    dx2, dxdy, dy2 = dx**2, dx*dy, dy**2
+    e = np.exp(-(a*dx2 + 2*b*dxdy + c*dy2))
+    ae = amplitude*e
+
+    cos_2 = np.cos(theta)**2
+    sin_2 = np.sin(theta)**2
+    sin_2theta = np.sin(2*theta)
+    cos_2theta = np.cos(2*theta)
+    # Derivatives of the quadratic form coefficients
+    da_sx, db_sx, dc_sx = -cos_2/sigma_x**3, sin_2theta/(2*sigma_x**3), -sin_2/sigma_x**3
+    da_sy, db_sy, dc_sy = -sin_2/sigma_y**3, -sin_2theta/(2*sigma_y**3), -cos_2/sigma_y**3
+    inverse_difference = 1/sigma_y**2 - 1/sigma_x**2
+    da_t = sin_2theta*inverse_difference/2
+    db_t = cos_2theta*inverse_difference/2
+
+    return np.column_stack((
+        e,
+        ae*(2*a*dx + 2*b*dy),
+        ae*(2*b*dx + 2*c*dy),
+        -ae*(da_sx*dx2 + 2*db_sx*dxdy + dc_sx*dy2),
+        -ae*(da_sy*dx2 + 2*db_sy*dxdy + dc_sy*dy2),
+        -ae*(da_t*dx2 + 2*db_t*dxdy - da_t*dy2),
+        np.ones_like(x)
+    ))
+
+
+def estimate_gaus(x, y):
+    """
+    Closed-form estimate of the 1D Gaussian parameters.
+
+    Fits log-power with a weighted linear least-squares quadratic and falls back to moments
+    if the quadratic does not open downwards.
+
+    :param x: The positions
+    :type x: np.ndarray
+    :param y: The linear power
+    :type y: np.ndarray
+    :return: The estimated (a, x0, sigma)
+    :rtype: np.ndarray
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    mask = y > 0.1*np.max(y)
+    if np.count_nonzero(mask) >= 3:
+        xm, ym = x[mask], y[mask]
+        design = np.column_stack((np.ones_like(xm), xm, xm**2))*ym[:, None]
+        c0, c1, c2 = np.linalg.lstsq(design, np.log(ym)*ym, rcond=None)[0]
+        if c2 < 0:
+            x0 = -c1/(2*c2)
+            return np.array([np.exp(c0 - c1**2/(4*c2)), x0, np.sqrt(-1/(2*c2))])
+
+    weights = np.clip(y - np.min(y), 0, None)
+    if np.sum(weights) <= 0:
+        return np.array([np.max(y), np.mean(x), np.ptp(x)/4])
+    x0 = np.sum(weights*x)/np.sum(weights)
+    sigma = np.sqrt(np.sum(weights*(x - x0)**2)/np.sum(weights))
+    return np.array([np.max(y), x0, max(sigma, 1e-3)])
+
+
+def quadratic_to_gaussian(a, b, c):
+    """
+    Converts the exponent coefficients of a 2D Gaussian into (sigma_x, sigma_y, theta).
+
+    :return: The widths and rotation, or None if the quadratic form is not positive definite.
+    :rtype: tuple
+    """
+    if a <= 0 or c <= 0 or a*c - b**2 <= 0:
+        return None
+    theta = 0.5*np.arctan2(-2*b, a - c)
+    difference = np.hypot(a - c, 2*b)
+    total = a + c
+    return np.sqrt(1/(total + difference)), np.sqrt(1/(total - difference)), theta
+
+
+def estimate_gaus_2d(XY, z):
+    """
+    Closed-form estimate of the 2D Gaussian parameters.
+
+    Fits log-power above the offset with a weighted linear least-squares quadratic in x and y.
+    Falls back to image moments if the quadratic is not positive definite.
+
+    :param XY: The positions with shape (points, 2)
+    :type XY: np.ndarray
+    :param z: The linear power
+    :type z: np.ndarray
+    :return: The estimated (amplitude, xo, yo, sigma_x, sigma_y, theta, offset)
+    :rtype: np.ndarray
+    """
+    x, y = XY[:, 0], XY[:, 1]
+    z = np.asarray(z, dtype=float).ravel()
+    offset = np.min(z)
+    w = z - offset
+    mask = w > 0.1*np.max(w)
+    if np.count_nonzero(mask) >= 6:
+        xm, ym, wm = x[mask], y[mask], w[mask]
+        design = np.column_stack((np.ones_like(xm), xm, ym, xm**2, xm*ym, ym**2))*wm[:, None]
+        c0, c1, c2, c3, c4, c5 = np.linalg.lstsq(design, np.log(wm)*wm, rcond=None)[0]
+        a, b, c = -c3, -c4/2, -c5
+        widths = quadratic_to_gaussian(a, b, c)
+        if widths is not None:
+            xo, yo = np.linalg.solve(2*np.array([[a, b], [b, c]]), [c1, c2])
+            amplitude = np.exp(c0 + a*xo**2 + 2*b*xo*yo + c*yo**2)
+            return np.array([amplitude, xo, yo, widths[0], widths[1], widths[2], offset])
+
+    # Image moments of the power above the offset
+    total = np.sum(w)
+    if total <= 0:
+        return np.array([np.max(z), np.mean(x), np.mean(y), 3, 3, 0, offset])
+    xo = np.sum(w*x)/total
+    yo = np.sum(w*y)/total
+    covariance = np.cov(np.vstack((x - xo, y - yo)), aweights=w, bias=True)
+    try:
+        a, b, c = (0.5*np.linalg.inv(covariance))[[0, 0, 1], [0, 1, 1]]
+        widths = quadratic_to_gaussian(a, b, c)
+    except np.linalg.LinAlgError:
+        widths = None
+    if widths is None:
+        widths = (3, 3, 0)
+    return np.array([np.max(w), xo, yo, widths[0], widths[1], widths[2], offset])
+
+
+def fit_gaus(x, y):
+    """
+    Fits the 1D Gaussian starting from the closed-form estimate with the analytic Jacobian.
+
+    :param x: The positions
+    :type x: np.ndarray
+    :param y: The linear power
+    :type y: np.ndarray
+    :return: The optimal parameters and their covariance
+    :rtype: tuple
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    p0 = estimate_gaus(x, y)
+    return curve_fit(gaus, x, y, p0=p0, jac=gaus_jacobian)
+
+
+def fit_gaus_2d(XY, z):
+    """
+    Fits the 2D Gaussian starting from the closed-form estimate with the analytic Jacobian.
+
+    The position grid is split into contiguous x and y columns once and reused for every evaluation.
+
+    :param XY: The positions with shape (points, 2)
+    :type XY: np.ndarray
+    :param z: The linear power
+    :type z: np.ndarray
+    :return: The optimal parameters and their covariance
+    :rtype: tuple
+    """
+    grid = np.ascontiguousarray(XY, dtype=float)
+    z = np.asarray(z, dtype=float).ravel()
+    p0 = estimate_gaus_2d(grid, z)
+    popt, pcov = curve_fit(lambda _, *p: gaus_2d(grid, *p), None, z, p0=p0, jac=lambda _, *p: gaus_2d_jacobian(grid, *p))
+    return popt, pcov
+
+
+class FitStatistics:
+    """Collects fit durations and failures to report fit time and failure rate."""
+    def __init__(self):
+        self.durations = []
+        self.failures = 0
+
+    def record(self, duration, success):
+        """
+        Records one fit.
+
+        :param duration: The fit duration in seconds
+        :type duration: float
+        :param success: True if the fit converged to finite parameters
+        :type success: bool
+        """
+        self.durations.append(duration)
+        if not success:
+            self.failures += 1
+
+    def summary(self):
+        """Returns the number of fits, mean fit time and failure rate as text."""
+        if not self.durations:
+            return "No coupling fits."
+        return f"{len(self.durations)} coupling fits, {1e3*np.mean(self.durations):.1f}ms mean fit time, {100*self.failures/len(self.durations):.1f}% failed."
+
+
+def timed_fit(fit_function, *args):
+    """
+    Runs a fit and measures its duration.
+
+    :return: The optimal parameters (None if the fit failed), the covariance and the duration in seconds
+    :rtype: tuple
+    """
+    time_start = time.perf_counter()
+    try:
+        popt, pcov = fit_function(*args)
+        if not np.all(np.isfinite(popt)) or not np.all(np.isfinite(np.diag(pcov))):
+            popt = None
+    except (RuntimeError, ValueError, np.linalg.LinAlgError):
+        popt, pcov = None, None
+    return popt, pcov, time.perf_counter() - time_start
+
+
+if __name__ == '__main__':
+    # Compare the fixed-guess fit with the estimator on recorded 2D scans, e.g. power_array_linear_2d.json
+    if len(sys.argv) < 2:
+        print('Usage: python -m core.coupling_fit <power_array_linear_2d.json> [...]')
+        sys.exit(1)
+    legacy = FitStatistics()
+    estimated = FitStatistics()
+    for file_path in sys.argv[1:]:
+        power = np.array(json.load(open(file_path)))
+        rows, columns = power.shape
+        i, j = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+        grid = np.column_stack(((i/2).ravel(), (j/2).ravel()))
+        guess = [np.max(power), np.mean(grid[:, 0]), np.mean(grid[:, 1]), 3, 3, 0, np.min(power)]
+        popt, _, duration = timed_fit(lambda xy, z: curve_fit(gaus_2d, xy, z, p0=guess), grid, power.ravel())
+        legacy.record(duration, popt is not None)
+        popt, _, duration = timed_fit(fit_gaus_2d, grid, power.ravel())
+        estimated.record(duration, popt is not None)
+    print(f'Fixed guess, numerical Jacobian: {legacy.summary()}')
+    print(f'Closed-form estimate, analytic Jacobian: {estimated.summary()}')
@@ -0,0 +1,217 @@
+import time
+
+import numpy as np
+
+from core import coupling_fit
+
+
+class CouplingScan:
+    """
+    Scan strategies for the 2D coupling check on the NanoTrak piezo range.
+
+    Every strategy visits positions through the measure callable and returns the visited positions and
+    readings. 'raster' keeps the full grid used for facet quality maps, the other strategies visit far
+    fewer points and stop as soon as the Gaussian is located well enough.
+    """
+    STRATEGIES = ('raster', 'coarse_to_fine', 'spiral', 'crosshair')
+
+    def __init__(self, measure, convert=None, low=0.0, high=10.0, step=0.5, target_std=0.05):
+        """
+        :param measure: Moves to (horz, vert) in NT units and returns the reading there.
+        :type measure: callable
+        :param convert: Converts an array of readings into linear power, defaults to the identity.
+        :type convert: callable
+        :param low: Lower bound of both axes in NT units.
+        :type low: float
+        :param high: Upper bound of both axes in NT units.
+        :type high: float
+        :param step: Step of the dense grid in NT units.
+        :type step: float
+        :param target_std: Standard deviation of the fitted centre in NT units at which adaptive scans stop.
+        :type target_std: float
+        """
+        self.measure = measure
+        self.convert = convert or (lambda readings: readings)
+        self.low = low
+        self.high = high
+        self.step = step
+        self.target_std = target_std
+        self.positions = []
+        self.readings = []
+        self.visited = {}
+        self.popt = None
+        self.pcov = None
+        # Time in s spent in the fits of the scan, the strategies that fit while scanning report it here
+        self.fit_time = 0.0
+
+    def run(self, strategy='coarse_to_fine', center=None):
+        """
+        Runs a scan strategy.
+
+        :param strategy: One of STRATEGIES.
+        :type strategy: str
+        :param center: Start position (horz, vert) of the spiral and crosshair scans, defaults to the middle of the range.
+        :type center: tuple
+        :return: The visited positions with shape (points, 2), the readings and the scan statistics.
+        :rtype: tuple
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Unknown coupling scan strategy {strategy}, expected one of {self.STRATEGIES}")
+        if center is None:
+            center = ((self.low + self.high) / 2, (self.low + self.high) / 2)
+        time_start = time.time()
+        if strategy == 'raster':
+            self.raster()
+        elif strategy == 'coarse_to_fine':
+            self.coarse_to_fine()
+        elif strategy == 'spiral':
+            self.spiral(center)
+        else:
+            self.crosshair(center)
+        statistics = {'strategy': strategy, 'points': len(self.readings), 'wall_time_s': time.time() - time_start}
+        return np.array(self.positions, dtype=float).reshape(-1, 2), np.array(self.readings, dtype=float), statistics
+
+    def grid_axis(self, low=None, high=None, step=None):
+        """Returns the grid positions of one axis clipped to the piezo range."""
+        low = self.low if low is None else max(low, self.low)
+        high = self.high if high is None else min(high, self.high)
+        step = step or self.step
+        return np.round(np.arange(low, high + step / 2, step) / self.step) * self.step
+
+    def visit(self, horz, vert):
+        """Measures a position once; positions that were already visited are not measured again."""
+        key = (round(horz / self.step), round(vert / self.step))
+        if key in self.visited or not (self.low <= horz <= self.high and self.low <= vert <= self.high):
+            return
+        self.visited[key] = len(self.readings)
+        self.positions.append((horz, vert))
+        self.readings.append(self.measure(horz, vert))
+
+    def fit(self):
+        """
+        Fits the 2D Gaussian to the points visited so far.
+
+        :return: True if the fitted centre is known to within target_std.
+        :rtype: bool
+        """
+        positions = np.array(self.positions, dtype=float)
+        popt, pcov, duration = coupling_fit.timed_fit(coupling_fit.fit_gaus_2d, positions, self.convert(np.array(self.readings)))
+        self.fit_time += duration
+        if popt is None:
+            return False
+        self.popt, self.pcov = popt, pcov
+        return bool(np.all(np.sqrt(np.diag(pcov)[1:3]) < self.target_std))
+
+    def raster(self):
+        """Visits the full grid, column by column as the facet quality maps expect."""
+        axis = self.grid_axis()
+        for horz in axis:
+            for vert in axis:
+                self.visit(horz, vert)
+
+    def coarse_to_fine(self, coarse_step=2.0, patch_half_width=1.5):
+        """Visits a coarse grid, estimates the peak and then visits a dense patch around it."""
+        coarse_axis = self.grid_axis(step=coarse_step)
+        for horz in coarse_axis:
+            for vert in coarse_axis:
+                self.visit(horz, vert)
+        estimate = coupling_fit.estimate_gaus_2d(np.array(self.positions), self.convert(np.array(self.readings)))
+        horz_peak = np.clip(estimate[1], self.low, self.high)
+        vert_peak = np.clip(estimate[2], self.low, self.high)
+        for horz in self.grid_axis(horz_peak - patch_half_width, horz_peak + patch_half_width):
+            for vert in self.grid_axis(vert_peak - patch_half_width, vert_peak + patch_half_width):
+                self.visit(horz, vert)
+
+    def spiral(self, center, min_rings=2):
+        """Visits square rings around the centre and stops once the fitted centre is pinned."""
+        horz_center = np.round(center[0] / self.step) * self.step
+        vert_center = np.round(center[1] / self.step) * self.step
+        self.visit(horz_center, vert_center)
+        max_rings = int(np.ceil((self.high - self.low) / self.step))
+        for ring in range(1, max_rings + 1):
+            for offset in range(-ring, ring + 1):
+                for horz_offset, vert_offset in ((offset, -ring), (ring, offset), (-offset, ring), (-ring, -offset)):
+                    self.visit(horz_center + horz_offset * self.step, vert_center + vert_offset * self.step)
+            if ring >= min_rings and len(self.readings) >= 7 and self.fit():
+                return
+
+    def crosshair(self, center, max_passes=3):
+        """Scans a horizontal and a vertical line through the centre and recentres on the peak until it stops moving."""
+        horz_center, vert_center = center
+        for _ in range(max_passes):
+            horz_center = np.round(horz_center / self.step) * self.step
+            vert_center = np.round(vert_center / self.step) * self.step
+            axis = self.grid_axis()
+            for horz in axis:
+                self.visit(horz, vert_center)
+            for vert in axis:
+                self.visit(horz_center, vert)
+
+            power = self.convert(np.array([self.readings[self.visited[(round(h / self.step), round(vert_center / self.step))]] for h in axis]))
+            offset = np.min(power)
+            horz_fit, horz_cov, horz_duration = coupling_fit.timed_fit(coupling_fit.fit_gaus, axis, power - offset)
+            power = self.convert(np.array([self.readings[self.visited[(round(horz_center / self.step), round(v / self.step))]] for v in axis]))
+            vert_fit, vert_cov, vert_duration = coupling_fit.timed_fit(coupling_fit.fit_gaus, axis, power - np.min(power))
+            self.fit_time += horz_duration + vert_duration
+            if horz_fit is None or vert_fit is None:
+                return
+            amplitude = max(horz_fit[0], vert_fit[0])
+            self.popt = np.array([amplitude, horz_fit[1], vert_fit[1], abs(horz_fit[2]), abs(vert_fit[2]), 0.0, offset])
+            self.pcov = np.diag([horz_cov[0, 0], horz_cov[1, 1], vert_cov[1, 1], horz_cov[2, 2], vert_cov[2, 2], 0.0, 0.0])
+            moved = np.hypot(horz_fit[1] - horz_center, vert_fit[1] - vert_center)
+            if moved < self.step and np.all(np.sqrt(np.diag(self.pcov)[1:3]) < self.target_std):
+                return
+            horz_center = np.clip(horz_fit[1], self.low, self.high)
+            vert_center = np.clip(vert_fit[1], self.low, self.high)
+
+
+def regrid(horz, vert, values, low=0.0, high=10.0, points=100):
+    """
+    Regrids scattered samples onto a regular map.
+
+    Each sample is split bilinearly onto its four neighbouring grid nodes and the weighted sums are
+    accumulated with np.bincount. Nodes without samples are interpolated along the scan lines.
+
+    :param horz: Horizontal positions of the samples in NT units
+    :type horz: np.ndarray
+    :param vert: Vertical positions of the samples in NT units
+    :type vert: np.ndarray
+    :param values: The sampled values
+    :type values: np.ndarray
+    :param low: Lower bound of both axes in NT units
+    :type low: float
+    :param high: Upper bound of both axes in NT units
+    :type high: float
+    :param points: Number of grid nodes per axis
+    :type points: int
+    :return: The map indexed [horizontal, vertical] with shape (points, points)
+    :rtype: np.ndarray
+    """
+    scale = (points - 1) / (high - low)
+    u = np.clip((np.asarray(horz, dtype=float) - low) * scale, 0, points - 1)
+    v = np.clip((np.asarray(vert, dtype=float) - low) * scale, 0, points - 1)
+    values = np.asarray(values, dtype=float)
+    i0 = np.minimum(u.astype(int), points - 2)
+    j0 = np.minimum(v.astype(int), points - 2)
+    fu = u - i0
+    fv = v - j0
+
+    weights = np.zeros(points * points)
+    sums = np.zeros(points * points)
+    for di, dj, weight in ((0, 0, (1 - fu) * (1 - fv)), (1, 0, fu * (1 - fv)), (0, 1, (1 - fu) * fv), (1, 1, fu * fv)):
+        index = (i0 + di) * points + (j0 + dj)
+        weights += np.bincount(index, weight, points * points)
+        sums += np.bincount(index, weight * values, points * points)
+    grid = np.full(points * points, np.nan)
+    filled = weights > 1e-6
+    grid[filled] = sums[filled] / weights[filled]
+    grid = grid.reshape(points, points)
+
+    # Fill the gaps along the horizontal scan lines, then across lines that have no samples at all
+    axis = np.arange(points)
+    for line in (grid.T, grid):
+        for row in line:
+            known = ~np.isnan(row)
+            if known.any() and not known.all():
+                row[~known] = np.interp(axis[~known], axis[known], row[known])
+    return grid
@@ -0,0 +1,106 @@
+import queue
+import threading
+
+import numpy as np
+
+
+def freeze(value):
+    """
+    Returns an immutable copy of a record value: arrays become read-only copies, lists become tuples.
+
+    :param value: The value to freeze.
+    :return: The frozen value.
+    """
+    if isinstance(value, np.ndarray):
+        value = value.copy()
+        value.flags.writeable = False
+        return value
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(element) for element in value)
+    if isinstance(value, dict):
+        return {key: freeze(element) for key, element in value.items()}
+    return value
+
+
+def to_json(value):
+    """
+    Converts a frozen record value back into JSON serialisable types.
+
+    :param value: The value to convert.
+    :return: The converted value.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [to_json(element) for element in value]
+    if isinstance(value, dict):
+        return {key: to_json(element) for key, element in value.items()}
+    return value
+
+
+class DataWriter:
+    """
+    Persists measurement records in submission order on a background thread.
+
+    The queue is bounded: submit() blocks while it is full, so a slow disk or network share
+    throttles the measurement loop instead of growing memory without limit.
+    """
+    def __init__(self, write_function, error_callback=None, maxsize=8):
+        """
+        :param write_function: Called with each record on the writer thread.
+        :type write_function: callable
+        :param error_callback: Called with an error message if writing a record fails.
+        :type error_callback: callable
+        :param maxsize: Number of records that may wait in the queue.
+        :type maxsize: int
+        """
+        self.write_function = write_function
+        self.error_callback = error_callback
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='DataWriter', daemon=True)
+        self.thread.start()
+
+    def submit(self, record, write_function=None):
+        """
+        Queues a record for writing. Blocks while the queue is full.
+
+        :param record: The immutable record to write.
+        :param write_function: Optional function used for this record instead of the default one.
+        :type write_function: callable
+        """
+        if self.closed:
+            raise RuntimeError('DataWriter is closed.')
+        self.queue.put((write_function or self.write_function, record))
+
+    def pending(self):
+        """Returns the number of records waiting to be written."""
+        return self.queue.qsize()
+
+    def run(self):
+        """Writes queued records until the close marker arrives."""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                write_function, record = item
+                write_function(record)
+            except Exception as e:
+                if self.error_callback is not None:
+                    self.error_callback(f"Error while saving data: {e}")
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Blocks until all queued records are written."""
+        self.queue.join()
+
+    def close(self):
+        """Writes the remaining records and stops the writer thread."""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,98 @@
+import numpy as np
+
+
+class DriftModel:
+    """
+    Robust linear model of the latched NanoTrak positions against the output motor position.
+
+    The chip facet is rarely perpendicular to the motor travel, so the latched positions drift roughly
+    linearly from waveguide to waveguide. The model is refit after every tracking with a Huber weighted
+    least-squares fit, so single bad trackings do not pull the prediction, and predicts where the
+    NanoTraks should start tracking at the next waveguide.
+    """
+    AXES = ('input_horz', 'input_vert', 'output_horz', 'output_vert', 'focus_horz', 'focus_vert')
+
+    def __init__(self, min_points=3, huber_threshold=1.345, iterations=10, window=(2.0, 8.0)):
+        """
+        :param min_points: Number of trackings before the model predicts.
+        :type min_points: int
+        :param huber_threshold: Residual in robust standard deviations beyond which points are down-weighted.
+        :type huber_threshold: float
+        :param iterations: Number of reweighting iterations per fit.
+        :type iterations: int
+        :param window: NanoTrak window in NT units the predictions are clipped to.
+        :type window: tuple
+        """
+        self.min_points = min_points
+        self.huber_threshold = huber_threshold
+        self.iterations = iterations
+        self.window = window
+        self.motor_positions = []
+        self.positions = []
+        self.coefficients = None
+        self.tracking_times = {True: [], False: []}
+
+    def add(self, motor_position, positions):
+        """
+        Adds the latched positions after a tracking and refits the model.
+
+        :param motor_position: The output motor position in mm
+        :type motor_position: float
+        :param positions: The latched position in NT units for every axis of AXES
+        :type positions: sequence
+        """
+        self.motor_positions.append(motor_position)
+        self.positions.append(positions)
+        if len(self.positions) >= self.min_points:
+            self.fit()
+
+    def fit(self):
+        """Fits offset and slope of every axis by iteratively reweighted least squares with Huber weights."""
+        x = np.asarray(self.motor_positions, dtype=float)
+        y = np.asarray(self.positions, dtype=float)
+        design = np.column_stack((np.ones_like(x), x - x.mean()))
+        weights = np.ones_like(y)
+        for _ in range(self.iterations):
+            # Weighted normal equations of all axes at once, shape (axes, 2, 2) and (axes, 2)
+            normal = np.einsum('ni,nj,nk->kij', design, design, weights)
+            right = np.einsum('ni,nk,nk->ki', design, weights, y)
+            try:
+                coefficients = np.linalg.solve(normal, right[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                return
+            residuals = y - design @ coefficients.T
+            scale = 1.4826 * np.median(np.abs(residuals - np.median(residuals, axis=0)), axis=0)
+            scale = np.where(scale > 1e-9, scale, 1.0)
+            scaled = np.abs(residuals) / (self.huber_threshold * scale)
+            weights = np.minimum(1.0, 1.0 / np.maximum(scaled, 1e-12))
+        self.coefficients = (x.mean(), coefficients)
+
+    def predict(self, motor_position):
+        """
+        Predicts the latched positions at a motor position.
+
+        :param motor_position: The output motor position in mm
+        :type motor_position: float
+        :return: The predicted position in NT units for every axis of AXES, None before the model has been fitted.
+        :rtype: np.ndarray
+        """
+        if self.coefficients is None:
+            return None
+        x_mean, coefficients = self.coefficients
+        prediction = coefficients[:, 0] + coefficients[:, 1] * (motor_position - x_mean)
+        return np.clip(prediction, *self.window)
+
+    def record_tracking(self, time_s, predicted):
+        """Records the duration of a tracking that started from a predicted position or not."""
+        self.tracking_times[bool(predicted)].append(time_s)
+
+    def summary(self):
+        """Returns the mean tracking time with and without prediction as text."""
+        parts = []
+        for predicted, label in ((True, 'with'), (False, 'without')):
+            times = self.tracking_times[predicted]
+            if times:
+                parts.append(f"{np.mean(times):.1f}s mean over {len(times)} trackings {label} prediction")
+        if not parts:
+            return "No trackings."
+        return "Tracking: " + ", ".join(parts) + "."
@@ -3,19 +3,33 @@ from datetime import datetime
 import threading
 import time
 from PyQt5.QtCore import QObject, pyqtSignal
-from scipy.optimize import curve_fit
 import json
 
+from core import coupling_fit
+from devices import wait_for_motors
+from core.alignment import AlignmentCache, AlignmentEngine
+from core.coupling_scan import CouplingScan, regrid
+from core.drift_model import DriftModel
+from core.data_writer import DataWriter, freeze, to_json
+from core.run_container import RunContainer, h5py
+from core.run_log import RunLog
+from core.run_estimator import RunEstimator
+from core.settle_monitor import SettleMonitor
+from core.step_scheduler import StepScheduler
+from core.tracking import TrackingController
+from core.waveguide_planner import WaveguidePlanner
+
 class LoopWorker(QObject):
     """Worker class for the loop function. This class is used to perform the loop function in a separate thread."""
     
     update_status = pyqtSignal(str)
     finished = pyqtSignal()
+    run_planned = pyqtSignal(str)
     measurement_completed = pyqtSignal(np.ndarray, np.ndarray)
     coupling_measurement_completed = pyqtSignal(np.ndarray, np.ndarray, str, np.ndarray, np.ndarray)
     motor_offset_completed = pyqtSignal(np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
 
-    def __init__(self, keithley, apt_tab, exfo_device, lower_optical_switch, upper_optical_switch, temp_controller, min_current, max_current, steps_current, temp_setpoint, start_wavelength, stop_wavelength, sampling, laser_power, scan_speed, save_path, filename, switch_settings, input_waveguide_distance, output_waveguide_distance, chip_distance, number_of_chips, inputs_per_chip, outputs_per_chip, coupling_threshold, gaus_min, gaus_max, scan_type):
+    def __init__(self, keithley, apt_tab, exfo_device, lower_optical_switch, upper_optical_switch, temp_controller, min_current, max_current, steps_current, temp_setpoint, start_wavelength, stop_wavelength, sampling, laser_power, scan_speed, save_path, filename, switch_settings, input_waveguide_distance, output_waveguide_distance, chip_distance, number_of_chips, inputs_per_chip, outputs_per_chip, coupling_threshold, gaus_min, gaus_max, scan_type, pipelined=False, output_channels=None, save_format='hdf5', coupling_strategy='coarse_to_fine', tracking_schedule=None, drift_prediction=True, alignment_margin=0.05, skip_waveguides=(), settle_bands=None, settle_max_wait=20.0, traversal_order='auto'):
         super().__init__()
         self.pause_event = threading.Event()
         self.pause_event.set()
@@ -25,6 +39,15 @@ class LoopWorker(QObject):
         self.keithley = keithley
 
         self.apt_tab = apt_tab 
+        # Diameter schedule of the tracking, every stage ends as soon as the NanoTraks have converged
+        self.tracking_controller = TrackingController(self.apt_tab, schedule=tracking_schedule)
+        # Recovers the alignment with the motors when tracking ends outside the NanoTrak window
+        self.alignment_engine = AlignmentEngine(self.apt_tab)
+        # Learns the drift of the latched NanoTrak positions along the chip to start tracking near the optimum
+        self.drift_prediction = drift_prediction
+        self.drift_model = DriftModel()
+        # Alignment of every waveguide from the first current step, later current steps only verify it
+        self.alignment_cache = AlignmentCache(margin=alignment_margin)
 
         self.exfo_device = exfo_device
 
@@ -34,6 +57,11 @@ class LoopWorker(QObject):
         self.temp_controller = temp_controller
         self.temp_setpoint = temp_setpoint
 
+        # Stability bands of the readbacks watched after every current step, settle_max_wait replaces the fixed 20 s
+        self.settle_bands = {'voltage_v': 0.001, 'temperature_c': 0.01, 'nanotrak_signal': 0.05}
+        self.settle_bands.update(settle_bands or {})
+        self.settle_max_wait = settle_max_wait
+
         # Parameters
         self.min_current = min_current
         self.max_current = max_current
@@ -52,6 +80,12 @@ class LoopWorker(QObject):
         self.scan_speed = scan_speed
         self.save_path = save_path
         self.filename = filename
+        # 'hdf5': one run container per start_loop, 'json': one JSON file per waveguide and current
+        self.save_format = save_format
+        self.run_container = None
+        self.run_log = None
+        self.power_log_line = None
+        self.coupling_log_line = None
 
         self.switch_settings = switch_settings
 
@@ -66,7 +100,32 @@ class LoopWorker(QObject):
         self.gaus_min = gaus_min
         self.gaus_max = gaus_max
         self.scan_type = scan_type
+        # 2D coupling scan strategy, see CouplingScan.STRATEGIES, or 'continuous' for high-resolution facet maps.
+        # 'raster' and 'continuous' also save the facet quality maps
+        self.coupling_strategy = coupling_strategy
+        self.facet_map_points = 100
+
+        # Pipelined acquisition: TE is downloaded from a CTP10 memory slot while the TM sweep runs
+        self.pipelined = pipelined
+        self.waveguide_times = []
 
+        # Output-array mode: one CTP10 detector (module, channel) per AWG output measured in the same sweep
+        if output_channels is None:
+            output_channels = [(self.exfo_device.Module, self.exfo_device.Channel)]
+        self.output_channels = list(output_channels)
+        self.outputs_per_sweep = len(self.output_channels)
+
+        # Absolute target table of the waveguides, visited in serpentine order across the current steps
+        self.waveguide_planner = WaveguidePlanner(self.number_of_chips, self.inputs_per_chip, self.outputs_per_chip, self.input_waveguide_distance, self.output_waveguide_distance, self.chip_distance, self.outputs_per_sweep, skip_waveguides)
+        # 'current_outer', 'waveguide_outer' or 'auto' for the order with the shorter predicted run time, see RunPlanner
+        self.traversal_order = traversal_order
+        self.traversal = None
+        self.traversal_estimates = None
+        # Per-phase timing models, calibrated from the run logs in the save directory
+        self.run_estimator = RunEstimator()
+        self.run_estimate = None
+
+        self.fit_statistics = coupling_fit.FitStatistics()
         self.power_array = []
         self.power_array_linear = []
         self.fitted_power_array = []
@@ -81,6 +140,11 @@ class LoopWorker(QObject):
         self.focus_horz_offset_tracking = [0.0]
         self.focus_vert_offset_tracking = [0.0]
 
+        self.data_writer = None
+        self.log_lock = threading.Lock()
+        # Traces of a sweep step waiting for their download step
+        self.sweep_results = {}
+
     def pause_loop(self):
         self.pause_event.clear()
         self.pause_event.wait()
@@ -89,81 +153,249 @@ class LoopWorker(QObject):
         self.pause_event.set()
 
     def stop_loop(self):
-       self.stop_event.set()
+        """Stops the loop. Measurements still queued for saving are written before the loop reports finished."""
+        self.stop_event.set()
+        if self.data_writer is not None and self.data_writer.pending():
+            self.update_status.emit(f"Saving {self.data_writer.pending()} queued measurements...")
 
     def start_loop(self):
-        self.temp_controller.set_temp(self.temp_setpoint)
-        self.check_temp()
-        for i in self.current:
-            if self.stop_event.is_set(): break
-            self.keithley.set_current(i)
-            self.update_status.emit(f"Set current: {format(i, '.4f')}A")
-            time.sleep(20)
-            # self.voltage.append(self.keithley.measure_voltage())
-            self.measured_power.append(self.keithley.measure_power())
-            self.check_temp()
-            self.pause_event.wait()
-            output_wg = 0
+        self.open_run_container()
+        self.data_writer = DataWriter(self.write_measurement_record, error_callback=self.update_status.emit)
+        now = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        self.run_log = RunLog(f'{self.save_path}/{now}_{self.filename}_run.jsonl')
+        if self.run_container is not None:
+            self.run_container.file.attrs['run_log'] = self.run_log.file_name
+        self.reset_state_caches()
+        # Absolute motor positions of the waveguides are offsets from the first waveguide
+        input_origin = self.apt_tab.MotorIN.motor_position()
+        output_origin = self.apt_tab.MotorOUT.motor_position()
+        if self.traversal is None:
+            self.update_status.emit(self.plan_traversal())
+        self.log_run('recipe', **self.run_estimate['recipe'])
+        self.log_run('traversal', order=self.traversal, estimates=self.traversal_estimates, predicted_total_s=self.run_estimate['total_s'])
 
-            try:
-                if self.stop_event.is_set(): break
-                if not self.confirm_coupling(self.scan_type): self.pause_loop()                   
-        
-                wavelength_array_te, il_data_te = self.perform_scan("TE")
-                wavelength_array_tm, il_data_tm = self.perform_scan("TM")
-
-                self.save_measurement_data(wavelength_array_te, il_data_te, il_data_tm, output_wg, current=i)
-                
-                output_waveguide_startposition = self.apt_tab.MotorOUT.motor_position()
-                skip_first_iteration = False
-                for j in range(self.number_of_chips):
-                    self.pause_event.wait()
-                    if self.stop_event.is_set(): break
-                    if j != 0:
-                        self.move_motors("both", self.chip_distance) # TODO change to output
-                        skip_first_iteration = True
-                    
-                    for k in range(self.outputs_per_chip):
-                        output_wg += 1
-                        self.pause_event.wait()
-                        if self.stop_event.is_set(): break
-                        if k == 0 and j == 0:
-                            self.move_motors("both", self.output_waveguide_distance) # TODO change to output
-                        elif k == 3 and j == 0:
-                            continue
-                        elif skip_first_iteration:
-                            skip_first_iteration = False
-                        else:
-                            self.move_motors("both", self.output_waveguide_distance) # TODO change to output
-                        # self.upper_optical_switch.set_routing(f'A,12')
-                        if not self.tracking(): self.pause_loop()
-                        counter = 0
-                        while not self.confirm_coupling():
-                            self.pause_loop()
-                            counter += 1
-                            if counter == 2:
-                                break
-                        self.motor_offset()
-                        if self.stop_event.is_set(): break
-
-                        wavelength_array_te, il_data_te = self.perform_scan("TE")
-                        wavelength_array_tm, il_data_tm = self.perform_scan("TM")
-                        self.save_measurement_data(wavelength_array_te, il_data_te, il_data_tm, output_wg, current=i)
-                
-                if self.stop_event.is_set(): break
-                output_waveguide_endposition = self.apt_tab.MotorOUT.motor_position()
-                to_start_waveguide = abs(output_waveguide_startposition - output_waveguide_endposition)
-                self.move_motors("both", -to_start_waveguide)
-                # self.upper_optical_switch.set_routing(f'A,12')
-                if not self.tracking(): self.pause_loop()
-                
-            except Exception as e:
-                self.update_status.emit(f"An error occurred in the loop: {e}")
+        # The loop as a graph of steps: a waveguide is aligned while the traces of the previous one are downloaded
+        # and saved, the CTP10 is configured while the temperature settles
+        scheduler = StepScheduler(error_callback=lambda step, e: self.update_status.emit(f"An error occurred in the loop: {e}"))
+        temperature_step = scheduler.add('temperature', self.set_temperature, resources=('temperature',))
+        configure_step = scheduler.add('configure CTP10', self.configure_exfo, resources=('exfo',))
+        previous_sweep = previous_download = None
+
+        def add_current(name, group, i, depends_on):
+            # The settle after the current step watches the chip temperature, no separate temperature check
+            return scheduler.add(f'{name} set', lambda i=i: self.set_current_step(i), resources=('keithley', 'temperature', 'nanotraks'), depends_on=(temperature_step,) + depends_on, group=group)
+
+        def add_waveguide(name, group, target, i, first_waveguide, depends_on):
+            align_step = scheduler.add(f'{name} align', lambda target=target, first_waveguide=first_waveguide: self.align_waveguide(target, first_waveguide, input_origin, output_origin), resources=('motors', 'nanotraks'), depends_on=depends_on, group=group)
+            sweep_step = scheduler.add(f'{name} sweep', lambda name=name: self.sweep_results.update({name: self.sweep_waveguide()}), resources=('exfo', 'switches'), depends_on=(align_step, configure_step, previous_download), group=group)
+            download_step = scheduler.add(f'{name} download', lambda name=name, target=target, i=i: self.download_waveguide(self.sweep_results.pop(name), target['waveguide'], current=i), resources=('exfo',), depends_on=(sweep_step,), group=group)
+            return sweep_step, download_step
+
+        if self.traversal == 'current_outer':
+            for pass_index, i in enumerate(self.current):
+                group = f'current {pass_index}'
+                current_step = add_current(group, group, i, (previous_sweep,))
+                # Passes alternate direction, so each current step starts at the waveguide the previous one ended on
+                for target in self.waveguide_planner.order(pass_index):
+                    first_waveguide = pass_index == 0 and target['waveguide'] == 0
+                    previous_sweep, previous_download = add_waveguide(f"{group} waveguide {target['waveguide']}", group, target, i, first_waveguide, (current_step, previous_sweep))
+        else:
+            for index, target in enumerate(self.waveguide_planner.targets):
+                group = f"waveguide {target['waveguide']}"
+                # Currents run up and down on alternate waveguides, so every waveguide starts next to the last current
+                currents = self.current if index % 2 == 0 else self.current[::-1]
+                for pass_index, i in enumerate(currents):
+                    current_step = add_current(f'{group} current {pass_index}', group, i, (previous_sweep,))
+                    first_waveguide = index == 0 and pass_index == 0 and target['waveguide'] == 0
+                    # Later currents find the waveguide in the alignment cache and only verify it
+                    previous_sweep, previous_download = add_waveguide(f'{group} current {pass_index}', group, target, i, first_waveguide, (current_step, previous_sweep))
+
+        timeline = scheduler.run(self.stop_event)
+        self.log_run('timeline', steps=timeline)
+        motors = (self.apt_tab.MotorIN, self.apt_tab.MotorOUT, self.apt_tab.MotorFocus)
+        self.log_run('motor_moves', moves=[move for motor in motors for move in motor.move_log])
+        self.update_status.emit(scheduler.report())
 
         self.keithley.set_current(0)
+        self.data_writer.close()
+        if self.run_container is not None:
+            self.run_container.close()
+            self.update_status.emit(f"Run saved to {self.run_container.path}")
+        self.report_state_caches()
+        self.report_throughput()
+        self.update_status.emit(self.fit_statistics.summary())
+        self.update_status.emit(f"Input NanoTrak: {self.apt_tab.InputNT.settle_summary()}")
+        self.update_status.emit(self.tracking_controller.summary())
+        self.update_status.emit(self.alignment_engine.summary())
+        self.update_status.emit(self.drift_model.summary())
+        self.update_status.emit(self.alignment_cache.summary())
+        for name, motor in (('Input motor', self.apt_tab.MotorIN), ('Output motor', self.apt_tab.MotorOUT)):
+            self.update_status.emit(f"{name}: {motor.move_summary()}")
         self.update_status.emit("Loop finished.")
         self.finished.emit()
     
+    def plan_run(self):
+        """
+        Plan the traversal in a background thread and emit run_planned with the text for the status printer.
+
+        The calibration parses the run logs under the save path, which takes a while on a large or network directory.
+        The motor parameters are read here, so the ActiveX control is only accessed from the calling thread.
+        """
+        motor = self.apt_tab.MotorOUT
+        max_velocity, acceleration = float(motor.fMaxVel), float(motor.fAccn)
+
+        def plan():
+            try:
+                message = self.plan_traversal(max_velocity, acceleration)
+            except Exception as e:
+                self.run_estimate = None
+                message = f"Run time estimate failed: {e}"
+            self.run_planned.emit(message)
+
+        threading.Thread(target=plan, name='RunPlanner', daemon=True).start()
+
+    def plan_traversal(self, max_velocity=None, acceleration=None):
+        """
+        Estimate the run time of both traversal orders from the phase timings of earlier runs and pick the order of this run.
+
+        :param max_velocity: Maximum velocity of the output motor in mm/s, read from the motor if None
+        :type max_velocity: float
+        :param acceleration: Acceleration of the output motor in mm/s^2, read from the motor if None
+        :type acceleration: float
+        :return: The calibration, the chosen order with its predicted time and phases, for the status printer
+        :rtype: str
+        """
+        runs = self.run_estimator.calibrate(self.save_path)
+        motor = self.apt_tab.MotorOUT
+        if max_velocity is None:
+            max_velocity = float(motor.fMaxVel)
+        if acceleration is None:
+            acceleration = float(motor.fAccn)
+        self.run_estimate = self.run_estimator.estimate(self.current, self.waveguide_planner, self.start_wavelength, self.stop_wavelength, self.sampling, self.scan_speed,
+                                                        outputs_per_sweep=self.outputs_per_sweep, scan_type=self.scan_type, coupling_strategy=self.coupling_strategy,
+                                                        max_velocity=max_velocity, acceleration=acceleration, settle_max_wait=self.settle_max_wait, traversal_order=self.traversal_order)
+        self.traversal = self.run_estimate['order']
+        self.traversal_estimates = self.run_estimate['estimates']
+        serpentine_travel, return_travel = self.waveguide_planner.travel(len(self.current))
+        return (f"{len(self.waveguide_planner.targets)} waveguides per current step, {serpentine_travel:.2f}mm output travel ({return_travel:.2f}mm with return trips).\n"
+                f"{self.run_estimator.summary(runs)}\n{self.run_estimate['summary']}")
+
+    def set_temperature(self):
+        """Set the temperature setpoint and wait until the temperature has settled."""
+        self.temp_controller.set_temp(self.temp_setpoint)
+        self.check_temp()
+
+    def configure_exfo(self):
+        """Send the scan parameters to the EXFO device ahead of the first sweep."""
+        self.exfo_device.set_scan_parameters(
+            start_wav=self.start_wavelength, 
+            stop_wav=self.stop_wavelength, 
+            sampling=self.sampling, 
+            speed=self.scan_speed, 
+            laser_power=self.laser_power
+        )
+
+    def set_current_step(self, current):
+        """
+        Set the current, wait until it has settled and log the Keithley power.
+
+        :param current: The current in A
+        :type current: float
+        """
+        self.keithley.set_current(current)
+        self.update_status.emit(f"Set current: {format(current, '.4f')}A")
+        self.wait_for_current_settle(current)
+        # self.voltage.append(self.keithley.measure_voltage())
+        self.measured_power.append(self.keithley.measure_power())
+        self.power_log_line = self.log_run('keithley_power', current_a=current, measured_power=self.measured_power[-1])
+
+    def align_waveguide(self, target, first_waveguide, input_origin, output_origin):
+        """
+        Move to a waveguide and align the fibers, from the alignment cache if possible.
+
+        :param target: The target from the waveguide planner
+        :type target: dict
+        :param first_waveguide: True for the first waveguide of the run, which is aligned by hand before the loop starts
+        :type first_waveguide: bool
+        :param input_origin: The input motor position of the first waveguide in mm
+        :type input_origin: float
+        :param output_origin: The output motor position of the first waveguide in mm
+        :type output_origin: float
+        """
+        self.pause_event.wait()
+        output_wg = target['waveguide']
+        restore_time = 0.0
+        if self.alignment_cache.get(output_wg) is not None:
+            # Repeat pass: jump straight to the alignment of the first pass
+            restore_time = self.move_to_alignment(output_wg)
+        elif not first_waveguide:
+            self.move_motors_absolute(input_origin + target['input_offset'], output_origin + target['output_offset'])
+        # self.upper_optical_switch.set_routing(f'A,12')
+        if not self.verify_alignment(output_wg, restore_time):
+            if not first_waveguide and not self.tracking(): self.pause_loop()
+            counter = 0
+            while not self.confirm_coupling(self.scan_type):
+                self.pause_loop()
+                counter += 1
+                if counter == 2:
+                    break
+            self.store_alignment(output_wg)
+        self.motor_offset()
+
+    def log_run(self, kind, **values):
+        """
+        Queue an entry of a run-wide series for the run log sidecar.
+
+        :param kind: The series of the entry
+        :type kind: str
+        :return: The line number of the entry in the sidecar
+        :rtype: int
+        """
+        # Steps run on several threads, the lines have to reach the writer in the order they were numbered
+        with self.log_lock:
+            line, entry = self.run_log.entry(kind, **values)
+            self.data_writer.submit(freeze(entry), write_function=self.run_log.write)
+        return line
+
+    def open_run_container(self):
+        """Create the HDF5 run container of this run. Falls back to JSON files if h5py is not installed."""
+        if self.save_format != 'hdf5':
+            return
+        if h5py is None:
+            self.update_status.emit("h5py is not installed, saving JSON files instead.")
+            self.save_format = 'json'
+            return
+        now = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        attributes = {
+            'measurement_time': now,
+            'sampling_resolution_pm': self.sampling,
+            'laser_sweep_speed_nm_per_s': self.scan_speed,
+            'laser_power_dbm': self.laser_power,
+            'temp_setpoint_c': self.temp_setpoint
+        }
+        self.run_container = RunContainer(f'{self.save_path}/{now}_{self.filename}.h5', self.current, attributes)
+
+    def state_cached_devices(self):
+        """Returns the devices that write their settings through a state cache."""
+        return {
+            'Keithley': self.keithley,
+            'EXFO': self.exfo_device,
+            'Lower switch': self.lower_optical_switch,
+            'Upper switch': self.upper_optical_switch
+        }
+
+    def reset_state_caches(self):
+        """Resynchronises the state caches with the instruments and resets the write counters for this run."""
+        for device in self.state_cached_devices().values():
+            device.state_cache.invalidate()
+            device.state_cache.reset_counters()
+
+    def report_state_caches(self):
+        """Sends the number of sent and skipped instrument writes of this run to the GUI."""
+        for name, device in self.state_cached_devices().items():
+            writes_sent, writes_saved = device.state_cache.counters()
+            self.update_status.emit(f"{name}: {writes_sent} writes sent, {writes_saved} redundant writes skipped.")
+
     def confirm_coupling(self, scan_type='1D'):
         """
         Confirm the coupling of the fiber to the chip by scanning the power at different positions.
@@ -174,52 +406,78 @@ class LoopWorker(QObject):
         :rtype: bool
         """
         horz_pos_input, vert_pos_input, _ = self.apt_tab.InputNT.circ_position()
+        settle_start = len(self.apt_tab.InputNT.settle_log)
         volt_array = []
-        x_pos_array = []
-        y_pos_array = []
         scan_range = 21
         if self.scan_type == '1D':
             # 1D scan (horizontal)
+            time_start = time.time()
             for i in range(scan_range):
-                self.apt_tab.InputNT.move_nanotrak(i/2, vert_pos_input)
-                time.sleep(0.1) # Wait for the nanotrak to move
-                _, _, current_power = self.apt_tab.InputNT.circ_position()
-                volt_array.append(current_power)
+                volt_array.append(self.measure_coupling_point(i/2, vert_pos_input))
+            scan_statistics = {'strategy': '1D', 'points': scan_range, 'wall_time_s': time.time() - time_start}
         
+        elif self.scan_type == '2D' and self.coupling_strategy == 'continuous':
+            # Continuous serpentine scan, the samples are regridded onto the facet map afterwards
+            time_start = time.time()
+            samples = self.apt_tab.InputNT.scan_lines(self.facet_map_points, self.facet_map_points, stop_event=self.stop_event)
+            xy_array, volt_array = samples[:, 1:3], samples[:, 3]
+            scan_statistics = {'strategy': 'continuous', 'points': len(volt_array), 'wall_time_s': time.time() - time_start}
+            self.update_status.emit(f"{scan_statistics['strategy']} coupling scan: {scan_statistics['points']} points in {scan_statistics['wall_time_s']:.1f}s.")
+
         elif self.scan_type == '2D':
             # 2D scan (horizontal and vertical)
-            for i in range(scan_range):
-                for j in range(scan_range):
-                    self.apt_tab.InputNT.move_nanotrak(i/2, j/2)
-                    if j == 0:
-                        time.sleep(0.25)
-                    else:
-                        time.sleep(0.1) 
-                    x_pos_array.append(i/2)
-                    y_pos_array.append(j/2)
-                    _, _, current_power = self.apt_tab.InputNT.circ_position()  
-                    volt_array.append(current_power)
+            scan = CouplingScan(self.measure_coupling_point, convert=lambda volts: 10**(self.volt_to_dbm(volts)/10))
+            xy_array, volt_array, scan_statistics = scan.run(self.coupling_strategy, center=(horz_pos_input, vert_pos_input))
+            self.update_status.emit(f"{scan_statistics['strategy']} coupling scan: {scan_statistics['points']} points in {scan_statistics['wall_time_s']:.1f}s.")
 
         self.apt_tab.InputNT.move_nanotrak(horz_pos_input, vert_pos_input)
+        settle_times = [entry['settle_time_s'] for entry in self.apt_tab.InputNT.settle_log[settle_start:]]
 
         # Convert the voltage to dBm: dBm = ((V - max_current) * Faktor_exfo) - Offset_exfo
-        self.power_array = ((np.array(volt_array) - 3.5) * 22.17647059) - 20.1
+        self.power_array = self.volt_to_dbm(np.array(volt_array))
         self.power_array_linear = 10**(self.power_array/10)
+        # Set again by the log entry of this scan, a failed fit must not leave the previous waveguide's fit in the records
+        self.popt = None
+        self.coupling_log_line = None
 
         if self.scan_type == '2D':
-            self.power_array_toemit = self.power_array.reshape(scan_range, scan_range)
-            x = np.array(x_pos_array)
-            y = np.array(y_pos_array)
-            xy_array = np.column_stack((x, y))
-            initial_guess = [np.max(self.power_array_linear), np.mean(x), np.mean(y), 3, 3, 0, np.min(self.power_array_linear)]
+            x = xy_array[:, 0]
+            y = xy_array[:, 1]
             try:
-                self.popt, self.pcov = curve_fit(self.gaus_2d, xy_array, self.power_array_linear.ravel(), p0=initial_guess)
-                self.fitted_power_array_2d = self.gaus_2d(xy_array, *self.popt).reshape(scan_range, scan_range)
-                self.power_array_linear_2d = self.power_array_linear.reshape(scan_range, scan_range)
-                json.dump(self.fitted_power_array_2d.tolist(), open('fitted_power_array_2d.json', 'w'))
-                json.dump(self.power_array_linear_2d.tolist(), open('power_array_linear_2d.json', 'w'))
-                json.dump(self.power_array_toemit.tolist(), open('power_array_toemit.json', 'w'))
-                self.coupling_measurement_completed.emit(self.power_array_toemit, self.fitted_power_array_2d, '2D', x, y)
+                if self.coupling_strategy == 'crosshair':
+                    # Two lines do not constrain the rotation, the crosshair scan combines its two 1D fits
+                    popt, pcov = scan.popt, scan.pcov
+                    self.fit_statistics.record(scan.fit_time, popt is not None)
+                else:
+                    popt, pcov, duration = coupling_fit.timed_fit(coupling_fit.fit_gaus_2d, xy_array, self.power_array_linear)
+                    self.fit_statistics.record(duration, popt is not None)
+                if popt is None:
+                    raise RuntimeError("2D Gaussian fit did not converge.")
+                self.popt, self.pcov = popt, pcov
+                if self.coupling_strategy == 'continuous':
+                    grid_axis = np.linspace(0, 10, self.facet_map_points)
+                else:
+                    grid_axis = scan.grid_axis()
+                grid_x, grid_y = np.meshgrid(grid_axis, grid_axis, indexing='ij')
+                grid = np.column_stack((grid_x.ravel(), grid_y.ravel()))
+                self.fitted_power_array_2d = self.gaus_2d(grid, *self.popt).reshape(len(grid_axis), len(grid_axis))
+                x_emit, y_emit = x, y
+                if self.coupling_strategy in ('raster', 'continuous'):
+                    if self.coupling_strategy == 'raster':
+                        self.power_array_toemit = self.power_array.reshape(scan_range, scan_range)
+                    else:
+                        self.power_array_toemit = regrid(x, y, self.power_array, points=self.facet_map_points)
+                        x_emit, y_emit = grid[:, 0], grid[:, 1]
+                    self.power_array_linear_2d = 10**(self.power_array_toemit/10)
+                    self.data_writer.submit(freeze({
+                        'fitted_power_array_2d.json': self.fitted_power_array_2d,
+                        'power_array_linear_2d.json': self.power_array_linear_2d,
+                        'power_array_toemit.json': self.power_array_toemit
+                    }), write_function=self.write_coupling_maps)
+                else:
+                    self.power_array_toemit = self.power_array
+                self.coupling_measurement_completed.emit(self.power_array_toemit, self.fitted_power_array_2d, '2D', x_emit, y_emit)
+                self.coupling_log_line = self.log_run('coupling', scan_type='2D', strategy=self.coupling_strategy, points=scan_statistics['points'], scan_time_s=scan_statistics['wall_time_s'], sampled_power_dbm=self.power_array, fitted_power=self.fitted_power_array_2d, horz_pos=x, vert_pos=y, gaussian_fit_params=self.popt, settle_times_s=settle_times)
 
                 if self.gaus_min < self.popt[1] < self.gaus_max and self.gaus_min < self.popt[2] < self.gaus_max:
                     self.update_status.emit("Coupling successful.")
@@ -231,6 +489,8 @@ class LoopWorker(QObject):
 
             except Exception as e:
                 self.update_status.emit(f"Error during 2D scan fitting: {e}")
+                if self.coupling_log_line is None:
+                    self.log_failed_coupling(scan_statistics, settle_times, scan_type='2D', strategy=self.coupling_strategy, horz_pos=x, vert_pos=y)
                 self.update_status.emit("Adjust manually.")
                 self.update_status.emit("Loop paused.")
                 return False
@@ -239,11 +499,16 @@ class LoopWorker(QObject):
             # Fit 1D data
             x = np.arange(0, 10.5, 0.5)
             try:
-                self.popt, self.pcov = curve_fit(self.gaus, x, self.power_array_linear,  p0 = [0.01, 5, 4]) # popt = Optimal parameters for the function, pcov = Covariance of the parameters
+                popt, pcov, duration = coupling_fit.timed_fit(coupling_fit.fit_gaus, x, self.power_array_linear)
+                self.fit_statistics.record(duration, popt is not None)
+                if popt is None:
+                    raise RuntimeError("Gaussian fit did not converge.")
+                self.popt, self.pcov = popt, pcov # popt = Optimal parameters for the function, pcov = Covariance of the parameters
                 x_fine = np.arange(0, 10.5, 0.01) # TODO test or delete
                 self.fitted_power_array = self.gaus(x_fine,*self.popt)
                 self.fitted_power_array = np.array(self.fitted_power_array)
                 self.coupling_measurement_completed.emit(self.power_array_linear, self.fitted_power_array, '1D', np.array([]), np.array([]))
+                self.coupling_log_line = self.log_run('coupling', scan_type='1D', points=scan_statistics['points'], scan_time_s=scan_statistics['wall_time_s'], sampled_power_dbm=self.power_array, fitted_power=self.fitted_power_array, gaussian_fit_params=self.popt, settle_times_s=settle_times)
                 if self.gaus_min < abs(self.popt[2]) < self.gaus_max:
                     self.update_status.emit("Coupling successful.")
                     return True  
@@ -253,37 +518,110 @@ class LoopWorker(QObject):
                     return False
             except Exception as e:
                 self.update_status.emit(f"{e}")
+                if self.coupling_log_line is None:
+                    self.log_failed_coupling(scan_statistics, settle_times, scan_type='1D')
                 self.update_status.emit("Adjust manually.")
                 self.update_status.emit("Loop paused.")
                 return False
 
-    def gaus(self, x, a, x0, sigma):
+    def log_failed_coupling(self, scan_statistics, settle_times, **values):
         """
-        Gaussian function for fitting the power array.
-        
-        :param x: The x values
-        :type x: np.ndarray
-        :param a: The amplitude of the Gaussian function
-        :type a: float
-        :param x0: The mean of the Gaussian function
-        :type x0: float
-        :param sigma: The standard deviation of the Gaussian function
-        :type sigma: float
-        :return: The Gaussian function
-        :rtype: np.ndarray
-        """
-        return a*np.exp(-(x-x0)**2/(2*sigma**2))
+        Log a coupling scan whose fit failed, so the records of this waveguide reference this scan and no fit parameters.
+
+        :param scan_statistics: The number of points and the wall time of the scan
+        :type scan_statistics: dict
+        :param settle_times: The settle times of the scan points in s
+        :type settle_times: list
+        """
+        self.popt = None
+        self.coupling_log_line = self.log_run('coupling', points=scan_statistics['points'], scan_time_s=scan_statistics['wall_time_s'], sampled_power_dbm=self.power_array, fitted_power=None, gaussian_fit_params=None, settle_times_s=settle_times, **values)
+
+    def measure_coupling_point(self, horz, vert):
+        """
+        Move the input NanoTrak to a position of the coupling scan, wait until it has settled and read the power there.
+
+        :param horz: Horizontal position in NT units
+        :type horz: float
+        :param vert: Vertical position in NT units
+        :type vert: float
+        :return: The NanoTrak signal in V
+        :rtype: float
+        """
+        _, _, current_power = self.apt_tab.InputNT.move_and_settle(horz, vert)
+        return current_power
+
+    def volt_to_dbm(self, volt):
+        """Convert the NanoTrak signal to dBm: dBm = ((V - max_current) * Faktor_exfo) - Offset_exfo"""
+        return ((volt - 3.5) * 22.17647059) - 20.1
+
+    def gaus(self, x, a, x0, sigma):
+        """Gaussian function for fitting the power array, see coupling_fit.gaus."""
+        return coupling_fit.gaus(x, a, x0, sigma)
 
     def gaus_2d(self, XY, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
-        x, y = XY[:,0], XY[:,1]
-        xo = float(xo)
-        yo = float(yo)
-        a = (np.cos(theta)**2) / (2 * sigma_x**2) + (np.sin(theta)**2) / (2 * sigma_y**2)
-        b = -(np.sin(2 * theta)) / (4 * sigma_x**2) + (np.sin(2 * theta)) / (4 * sigma_y**2)
-        c = (np.sin(theta)**2) / (2 * sigma_x**2) + (np.cos(theta)**2) / (2 * sigma_y**2)
-        
-        g = offset + amplitude * np.exp(- (a * ((x - xo)**2) + 2 * b * (x - xo) * (y - yo) + c * ((y - yo)**2)))
-        return g.ravel()
+        """Rotated 2D Gaussian for fitting the power map, see coupling_fit.gaus_2d."""
+        return coupling_fit.gaus_2d(XY, amplitude, xo, yo, sigma_x, sigma_y, theta, offset)
+
+    def sweep_waveguide(self):
+        """
+        Sweep TE and TM of the current waveguide. The TE traces are downloaded here, the TM traces stay on the
+        EXFO device for download_waveguide, so the fibers can move on to the next waveguide in the meantime.
+
+        All output channels are read from the same sweep.
+        In pipelined mode the TE traces are copied into a CTP10 memory slot after their sweep and downloaded
+        on a separate thread while the TM sweep runs.
+
+        :return: The start time, the TE wavelength array and IL data and the alignment state of the sweep
+        :rtype: dict
+        """
+        time_start = time.time()
+        if not self.pipelined:
+            wavelength_array_te, il_data_te = self.perform_scan("TE")
+            self.sweep("TM")
+        else:
+            self.sweep("TE")
+            for module, channel in self.output_channels:
+                memory_trace_type = self.exfo_device.copy_trace_to_memory(module=module, channel=channel)
+            te_result = {}
+
+            def download_te():
+                try:
+                    te_result['data'] = self.download_trace(memory_trace_type)
+                except Exception as e:
+                    te_result['error'] = e
+
+            te_thread = threading.Thread(target=download_te)
+            te_thread.start()
+            self.sweep("TM")
+            te_thread.join()
+            if 'error' in te_result:
+                raise te_result['error']
+            wavelength_array_te, il_data_te = te_result['data']
+        return {'time_start': time_start, 'wavelength_array_te': wavelength_array_te, 'il_data_te': il_data_te, 'state': self.measurement_state()}
+
+    def download_waveguide(self, sweep_result, output_wg, current=0.0):
+        """
+        Download the TM traces of a sweep_waveguide and save the data.
+
+        :param sweep_result: The result of sweep_waveguide
+        :type sweep_result: dict
+        :param output_wg: The number of the (first) output waveguide
+        :type output_wg: int
+        :param current: The current set on the Keithley
+        :type current: float
+        """
+        _, il_data_tm = self.download_trace()
+        for index in range(self.outputs_per_sweep):
+            self.save_measurement_data(sweep_result['wavelength_array_te'], sweep_result['il_data_te'][index], il_data_tm[index], output_wg + index, current=current, state=sweep_result['state'])
+        self.waveguide_times.append(time.time() - sweep_result['time_start'])
+
+    def report_throughput(self):
+        """Sends the measured waveguides per hour of this run to the GUI."""
+        if self.waveguide_times:
+            mode = 'pipelined' if self.pipelined else 'serial'
+            mean_time = np.mean(self.waveguide_times)
+            waveguides_per_hour = 3600 / mean_time * self.outputs_per_sweep
+            self.update_status.emit(f"Acquisition ({mode}, {self.outputs_per_sweep} outputs per sweep): {mean_time:.1f}s per sweep pair, {waveguides_per_hour:.0f} waveguides per hour.")
 
     def perform_scan(self, polarization_type):
         """
@@ -291,9 +629,19 @@ class LoopWorker(QObject):
         
         :param polarization_type: The polarization type to scan. Can be "TE" or "TM"
         :type polarization_type: str
-        :return: The wavelength array and the IL data
+        :return: The wavelength array and the IL data with shape (output channels, wavelength)
         :rtype: tuple
         """
+        self.sweep(polarization_type)
+        return self.download_trace()
+
+    def sweep(self, polarization_type):
+        """
+        Set the optical switches for the polarization and sweep the laser until the scan succeeds.
+
+        :param polarization_type: The polarization type to scan. Can be "TE" or "TM"
+        :type polarization_type: str
+        """
         lower = self.switch_settings[2][f"switch_1500_1630_{polarization_type}"][0]
         upper = self.switch_settings[2][f"switch_1500_1630_{polarization_type}"][1]
         self.lower_optical_switch.set_routing(f'A,{lower}')
@@ -326,35 +674,58 @@ class LoopWorker(QObject):
             )
             error_code, error_name = self.exfo_device.perform_scan()
         
-        if error_code == 0:
-            self.update_status.emit("Scan completed successfully.")
-            wavelength_array = self.exfo_device.create_wavelength_array()
-            il_data = self.exfo_device.retrieve_ASCii_trace()
-            self.measurement_completed.emit(np.array(wavelength_array), np.array(il_data))
-        
+        sweep = self.exfo_device.sweep_log[-1]
+        self.update_status.emit(f"Scan completed successfully in {sweep['sweep_time_s']:.2f}s ({sweep['mode']}, overhead {sweep['overhead_s']:.2f}s, {sweep['condition_queries']} status queries).")
+
+    def download_trace(self, trace_type=None):
+        """
+        Download the last traces of all output channels from the EXFO device and send the first one to the GUI.
+
+        :param trace_type: The CTP10 trace type to read, defaults to the live trace
+        :type trace_type: int
+        :return: The wavelength array and the IL data with shape (output channels, wavelength)
+        :rtype: tuple
+        """
+        wavelength_array = self.exfo_device.create_wavelength_array(trace_type=trace_type)
+        il_data = self.exfo_device.retrieve_channels(self.output_channels, trace_type=trace_type)
+        self.measurement_completed.emit(np.array(wavelength_array), il_data[0])
         return wavelength_array, il_data
 
-    def save_measurement_data(self, wavelength_array_te, il_data_te, il_data_tm, output_wg, current=0.0):
+    def measurement_state(self):
+        """
+        Take the alignment state a measurement belongs to: fit parameters, run log references, motor positions and tracking offsets.
+
+        :rtype: dict
+        """
+        return freeze({
+            'gaussian_fit_params': self.popt,
+            'coupling_log_line': self.coupling_log_line,
+            'power_log_line': self.power_log_line,
+            'measured_power_dbm': self.measured_power[-1],
+            'motor_positions': np.array([self.input_motor_position[-1], self.output_motor_position[-1]], dtype=float),
+            'tracking_offsets': np.array([offsets[-1] for offsets in self.tracking_offsets()], dtype=float)
+        })
+
+    def save_measurement_data(self, wavelength_array_te, il_data_te, il_data_tm, output_wg, current=0.0, state=None):
         """
-        Save the measurement data to a JSON file.
+        Queue the measurement data for saving to a JSON file on the writer thread.
         
+        The record is frozen here so the loop can keep changing its state while the record waits in the queue.
+
         :param wavelength_array_te: The wavelength array for the TE mode
-        :type wavelength_array_te: list
+        :type wavelength_array_te: np.ndarray
         :param il_data_te: The IL data for the TE mode
-        :type il_data_te: list
+        :type il_data_te: np.ndarray
         :param il_data_tm: The IL data for the TM mode
-        :type il_data_tm: list
+        :type il_data_tm: np.ndarray
+        :param state: The alignment state at the time of the sweep, see measurement_state. Defaults to the current state
+        :type state: dict
         """
+        if state is None:
+            state = self.measurement_state()
         # if output_wg >= 4:
         #     output_wg -= 1
 
-        if type(self.popt) == np.ndarray:
-            self.popt = self.popt.tolist()
-        if type(self.power_array) == np.ndarray:
-            self.power_array = self.power_array.tolist()
-        if type(self.fitted_power_array) == np.ndarray:
-            self.fitted_power_array = self.fitted_power_array.tolist()
-
         now = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         data = {
             'metadata': {
@@ -364,67 +735,115 @@ class LoopWorker(QObject):
                 'sampling_resolution_pm': self.sampling,
                 'laser_sweep_speed_nm_per_s': self.scan_speed,
                 'laser_power_dbm': self.laser_power,
-                'gaussian_fit_params': self.popt, 
-                'sampled_power_output': self.power_array,  
-                'fitted_power_output': self.fitted_power_array, 
+                'gaussian_fit_params': state['gaussian_fit_params'], 
+                # Coupling scan arrays and the run-wide series are kept once in the run log sidecar
+                'coupling_scan': self.run_log.reference(state['coupling_log_line']) if state['coupling_log_line'] is not None else None,
                 'currents_a': current,
                 # 'voltage_v': self.voltage,
-                'measured_power_dbm': self.measured_power
+                'measured_power_dbm': state['measured_power_dbm'],
+                'keithley_power': self.run_log.reference(state['power_log_line']) if state['power_log_line'] is not None else None
             },
             'data': {
-                'wavelength_nm': wavelength_array_te.tolist(),  
-                'il_te_db': il_data_te, 
-                'il_tm_db': il_data_tm 
+                'wavelength_nm': wavelength_array_te,
+                'il_te_db': np.asarray(il_data_te),
+                'il_tm_db': np.asarray(il_data_tm)
             }
         }
         
         # File naming
         current_tmp = format(current, '.6f')
         name = f'output_{output_wg}_current_{current_tmp}A'
-        full_path = f'{self.save_path}/{now}_{name}.json'
-        
-        # Save as JSON
-        with open(full_path, 'w') as json_file:
+        data['path'] = f'{self.save_path}/{now}_{name}.json'
+        data['current_index'] = int(np.argmin(np.abs(self.current - current)))
+        data['output_wg'] = output_wg
+        data['motor_positions'] = state['motor_positions']
+        data['tracking_offsets'] = state['tracking_offsets']
+
+        self.data_writer.submit(freeze(data))
+
+    def write_measurement_record(self, record):
+        """
+        Write a measurement record to the run container or to its JSON file. Runs on the writer thread.
+
+        :param record: The frozen record created by save_measurement_data
+        :type record: dict
+        """
+        if self.run_container is not None:
+            # Same sidecar references as the JSON metadata, the file name is the run_log attribute of the container
+            references = {series: record['metadata'][series] for series in RunContainer.RUN_LOG_SERIES}
+            self.run_container.append(
+                record['current_index'], record['output_wg'],
+                record['data']['wavelength_nm'], record['data']['il_te_db'], record['data']['il_tm_db'],
+                fit_params=record['metadata']['gaussian_fit_params'],
+                motor_positions=record['motor_positions'],
+                tracking_offsets=record['tracking_offsets'],
+                run_log_lines={series: reference['line'] for series, reference in references.items() if reference is not None})
+            self.update_status.emit(f"Output {record['output_wg']} saved to {self.run_container.path}")
+            return
+
+        data = {'metadata': to_json(record['metadata']), 'data': to_json(record['data'])}
+        with open(record['path'], 'w') as json_file:
             json.dump(data, json_file, indent=4)
         
-        self.update_status.emit(f"Data saved to {full_path}")
+        self.update_status.emit(f"Data saved to {record['path']}")
+
+    def write_coupling_maps(self, record):
+        """
+        Write the arrays of the last 2D coupling scan to JSON files. Runs on the writer thread.
+
+        :param record: File names mapped to the frozen arrays
+        :type record: dict
+        """
+        for file_name, array in record.items():
+            with open(file_name, 'w') as json_file:
+                json.dump(to_json(array), json_file)
 
     def move_motors(self, motor, distance):
         """
         Move the motors to the specified distance and append the motor positions to the motor position arrays.
+        With "both" the input motor moves by the input waveguide distance and both moves run at the same time.
         
         :param motor: The motor to move. Can be "input", "output" or "both"
         :type motor: str
         """
         if motor == "output":
+            motors = [self.apt_tab.MotorOUT]
             self.apt_tab.MotorOUT.move_relative(distance)
             self.update_status.emit('Output motor is moving...')
-            while self.apt_tab.MotorOUT.is_moving():
-                time.sleep(0.1)
-            self.update_status.emit('Output motor stopped.')
-            self.output_motor_position.append(self.apt_tab.MotorOUT.motor_position())
-
         elif motor == "input":
-            self.apt_tab.MotorIN.move_relative, args=(distance)
+            motors = [self.apt_tab.MotorIN]
+            self.apt_tab.MotorIN.move_relative(distance)
             self.update_status.emit('Input motor is moving...')
-            while self.apt_tab.MotorIN.is_moving():
-                time.sleep(0.1)
-            self.update_status.emit('Input motor stopped.')
-            self.input_motor_position.append(self.apt_tab.MotorIN.motor_position)
-
         else:
-            motor_input_thread = threading.Thread(target=self.apt_tab.MotorIN.move_relative, args=(self.input_waveguide_distance,))
-            motor_output_thread = threading.Thread(target=self.apt_tab.MotorOUT.move_relative, args=(distance,))
-            motor_input_thread.start()
-            motor_output_thread.start()
+            motors = [self.apt_tab.MotorIN, self.apt_tab.MotorOUT]
+            self.apt_tab.MotorIN.move_relative(self.input_waveguide_distance)
+            self.apt_tab.MotorOUT.move_relative(distance)
             self.update_status.emit('Motors are moving...')
-            while self.apt_tab.MotorIN.is_moving() or self.apt_tab.MotorOUT.is_moving():
-                time.sleep(0.1)
-            motor_input_thread.join()
-            motor_output_thread.join()
-            self.update_status.emit('Motors stopped')
-            self.input_motor_position.append(self.apt_tab.MotorIN.motor_position())
-            self.output_motor_position.append(self.apt_tab.MotorOUT.motor_position())
+        wait_for_motors(motors)
+        self.update_status.emit('Motors stopped')
+        self.append_motor_positions()
+
+    def append_motor_positions(self, **values):
+        """Append the input and output motor positions to the motor position arrays and the run log."""
+        self.input_motor_position.append(self.apt_tab.MotorIN.motor_position())
+        self.output_motor_position.append(self.apt_tab.MotorOUT.motor_position())
+        self.log_run('motor_positions', input=self.input_motor_position[-1], output=self.output_motor_position[-1], **values)
+
+    def move_motors_absolute(self, input_position, output_position):
+        """
+        Move the input and output motors to absolute positions and append the motor positions to the motor position arrays.
+
+        :param input_position: The input motor position in mm
+        :type input_position: float
+        :param output_position: The output motor position in mm
+        :type output_position: float
+        """
+        self.apt_tab.MotorIN.move_absolute(input_position)
+        self.apt_tab.MotorOUT.move_absolute(output_position)
+        self.update_status.emit('Motors are moving...')
+        wait_for_motors([self.apt_tab.MotorIN, self.apt_tab.MotorOUT])
+        self.update_status.emit('Motors stopped')
+        self.append_motor_positions()
 
     def tracking(self):
         """
@@ -437,20 +856,23 @@ class LoopWorker(QObject):
         output_horz_pos_before, output_vert_pos_before, _ = self.apt_tab.OutputNT.circ_position()
         focus_horz_pos_before, focus_vert_pos_before, _ = self.apt_tab.FocusNT.circ_position()
 
+        output_motor_position = self.apt_tab.MotorOUT.motor_position()
+        prediction = self.drift_model.predict(output_motor_position) if self.drift_prediction else None
+        if prediction is not None:
+            self.apt_tab.InputNT.move_nanotrak(prediction[0], prediction[1])
+            self.apt_tab.OutputNT.move_nanotrak(prediction[2], prediction[3])
+            self.apt_tab.FocusNT.move_nanotrak(prediction[4], prediction[5])
+
         self.update_status.emit("Tracking...")
-        self.apt_tab.change_circ_diameter_all(1)  
-        self.apt_tab.track_all()
-        time.sleep(3.75)
-        self.apt_tab.change_circ_diameter_all(0.75)  
-        time.sleep(3.75)
-        self.apt_tab.change_circ_diameter_all(0.25)
-        time.sleep(5)
-        self.apt_tab.latch_all()
-        self.update_status.emit("Latched.")
+        tracking_result = self.tracking_controller.run(self.stop_event)
+        self.drift_model.record_tracking(tracking_result['time_s'], prediction is not None)
+        self.log_run('tracking', predicted_positions=prediction, **tracking_result)
+        self.update_status.emit(f"Latched after {tracking_result['time_s']:.1f}s.")
 
         input_horz_pos_after, input_vert_pos_after, _ = self.apt_tab.InputNT.circ_position()
         output_horz_pos_after, output_vert_pos_after ,_ = self.apt_tab.OutputNT.circ_position()
         focus_horz_pos_after, focus_vert_pos_after, _ = self.apt_tab.FocusNT.circ_position()
+        latched_positions = (input_horz_pos_after, input_vert_pos_after, output_horz_pos_after, output_vert_pos_after, focus_horz_pos_after, focus_vert_pos_after)
 
         self.input_horz_offset_tracking.append(input_horz_pos_before - input_horz_pos_after)
         self.input_vert_offset_tracking.append(input_vert_pos_before - input_vert_pos_after)
@@ -460,12 +882,116 @@ class LoopWorker(QObject):
         self.focus_vert_offset_tracking.append(focus_vert_pos_before - focus_vert_pos_after)
 
         if self.apt_tab.get_circ_position_all() == False:
-            self.update_status.emit("Adjust manually.")
-            self.update_status.emit("Loop paused.")
+            if not self.recover_alignment():
+                self.update_status.emit("Adjust manually.")
+                self.update_status.emit("Loop paused.")
+                return False
+            # The recovery moved the motors and tracked again
+            output_motor_position = self.output_motor_position[-1]
+            latched_positions = tuple(position for nanotrak in (self.apt_tab.InputNT, self.apt_tab.OutputNT, self.apt_tab.FocusNT) for position in nanotrak.circ_position()[:2])
+        # Only latches inside the NanoTrak window train the drift model
+        self.drift_model.add(output_motor_position, latched_positions)
+        self.update_status.emit("Tracking successful.")
+        return True
+
+    def recover_alignment(self):
+        """
+        Align the fibers automatically with the motors and piezos when tracking ended outside the NanoTrak window, then track again.
+
+        :return: True if all NanoTraks are inside the window afterwards, False if not
+        :rtype: bool
+        """
+        self.update_status.emit("NanoTrak outside the tracking window, aligning automatically...")
+        alignment_result = self.alignment_engine.recover(self.stop_event)
+        self.input_motor_position.append(self.apt_tab.MotorIN.motor_position())
+        self.output_motor_position.append(self.apt_tab.MotorOUT.motor_position())
+        self.log_run('alignment', input=self.input_motor_position[-1], output=self.output_motor_position[-1], **alignment_result)
+        self.update_status.emit(f"Aligned {', '.join(alignment_result['sides'])} with {alignment_result['evaluations']} evaluations in {alignment_result['time_s']:.1f}s.")
+        if not alignment_result['recovered']:
+            return False
+        tracking_result = self.tracking_controller.run(self.stop_event)
+        self.log_run('tracking', **tracking_result)
+        return self.apt_tab.get_circ_position_all()
+
+    def store_alignment(self, waveguide):
+        """
+        Store the motor positions, latched NanoTrak positions and signals of a waveguide in the alignment cache.
+
+        :param waveguide: The output waveguide
+        :type waveguide: int
+        """
+        nanotraks = (self.apt_tab.InputNT, self.apt_tab.OutputNT, self.apt_tab.FocusNT)
+        readings = [nanotrak.circ_position() for nanotrak in nanotraks]
+        motor_positions = (self.apt_tab.MotorIN.motor_position(), self.apt_tab.MotorOUT.motor_position(), self.apt_tab.MotorFocus.motor_position())
+        # Later passes skip the coupling scan, their records take the fit and offsets of this alignment
+        state = {
+            'gaussian_fit_params': self.popt,
+            'coupling_log_line': self.coupling_log_line,
+            'tracking_offsets': tuple(offsets[-1] for offsets in self.tracking_offsets())
+        }
+        self.alignment_cache.store(waveguide, motor_positions, [reading[:2] for reading in readings], [reading[2] for reading in readings], state)
+
+    def tracking_offsets(self):
+        """Returns the input, output and focus tracking offset series, horizontal and vertical each."""
+        return (self.input_horz_offset_tracking, self.input_vert_offset_tracking,
+                self.output_horz_offset_tracking, self.output_vert_offset_tracking,
+                self.focus_horz_offset_tracking, self.focus_vert_offset_tracking)
+
+    def move_to_alignment(self, waveguide):
+        """
+        Move the motors and NanoTraks to the cached alignment of a waveguide and restore the coupling fit,
+        coupling scan reference and tracking offsets of that alignment.
+
+        :param waveguide: The output waveguide
+        :type waveguide: int
+        :return: The time in s the NanoTraks took to return to their cached positions
+        :rtype: float
+        """
+        alignment = self.alignment_cache.get(waveguide)
+        motors = (self.apt_tab.MotorIN, self.apt_tab.MotorOUT, self.apt_tab.MotorFocus)
+        for motor, position in zip(motors, alignment['motor_positions']):
+            motor.move_absolute(position)
+        self.update_status.emit('Motors are moving...')
+        wait_for_motors(motors)
+        self.update_status.emit('Motors stopped')
+        nanotraks = (self.apt_tab.InputNT, self.apt_tab.OutputNT, self.apt_tab.FocusNT)
+        time_start = time.perf_counter()
+        for nanotrak, (horz_pos, vert_pos) in zip(nanotraks, alignment['nanotrak_positions']):
+            nanotrak.move_and_settle(horz_pos, vert_pos)
+        restore_time = time.perf_counter() - time_start
+        self.append_motor_positions(cached_alignment=waveguide)
+        state = alignment['state']
+        self.popt = state.get('gaussian_fit_params')
+        self.coupling_log_line = state.get('coupling_log_line')
+        for offsets, offset in zip(self.tracking_offsets(), state.get('tracking_offsets', ())):
+            offsets.append(offset)
+        return restore_time
+
+    def verify_alignment(self, waveguide, restore_time=0.0):
+        """
+        Check if the NanoTrak signals at the cached alignment of a waveguide are still within the margin of the cache.
+
+        The logged time covers the NanoTrak restore and the check only, motor travel and re-tracking are timed by their own phases.
+
+        :param waveguide: The output waveguide
+        :type waveguide: int
+        :param restore_time: The time in s the NanoTraks took to return to the cached alignment
+        :type restore_time: float
+        :return: True if the cached alignment holds, False if there is none or the waveguide has to be tracked again
+        :rtype: bool
+        """
+        if self.alignment_cache.get(waveguide) is None:
             return False
+        time_start = time.perf_counter()
+        nanotraks = (self.apt_tab.InputNT, self.apt_tab.OutputNT, self.apt_tab.FocusNT)
+        signals = [nanotrak.circ_position()[2] for nanotrak in nanotraks]
+        verified = self.alignment_cache.verify(waveguide, signals)
+        self.log_run('alignment_check', waveguide=waveguide, signals=signals, verified=verified, time_s=restore_time + time.perf_counter() - time_start)
+        if verified:
+            self.update_status.emit("Cached alignment verified.")
         else:
-            self.update_status.emit("Tracking successful.")
-            return True
+            self.update_status.emit("Signal below the cached alignment, tracking again.")
+        return verified
 
     def motor_offset(self):
         """Calculates the offset from nanotrak units to nm, sends the motor positions and the offset tracking to the GUI"""
@@ -480,19 +1006,43 @@ class LoopWorker(QObject):
 
         self.motor_offset_completed.emit(input_motor_position, output_motor_position, input_horz_offset_tracking, input_vert_offset_tracking, output_horz_offset_tracking, output_vert_offset_tracking, focus_horz_offset_tracking, focus_vert_offset_tracking)
 
+    def wait_for_current_settle(self, current):
+        """
+        Wait until the Keithley voltage, the chip temperature and the input NanoTrak signal are stable after a current step.
+
+        :param current: The current that was set in A
+        :type current: float
+        """
+        monitor = SettleMonitor(max_wait=self.settle_max_wait)
+        monitor.add_channel('voltage_v', self.keithley.measure_voltage, self.settle_bands['voltage_v'])
+        monitor.add_channel('temperature_c', self.temp_controller.measure_temp, self.settle_bands['temperature_c'])
+        monitor.add_channel('nanotrak_signal', lambda: self.apt_tab.InputNT.circ_position()[2], self.settle_bands['nanotrak_signal'])
+        settle = monitor.wait(self.stop_event)
+        self.log_run('current_settle', current_a=current, **settle)
+        if settle['settled']:
+            self.update_status.emit(f"Settled after {settle['settle_time_s']:.1f}s.")
+        else:
+            unstable = ', '.join(name for name, channel in settle['channels'].items() if not channel['stable'])
+            self.update_status.emit(f"Not settled after {settle['settle_time_s']:.1f}s ({unstable}), continuing.")
+
     def check_temp(self):
-        """Check the temperature of the chip and adjust the temperature controller if necessary."""
+        """Wait until the temperature of the chip has settled at the setpoint of the temperature controller."""
         current_temp = float(self.temp_controller.measure_temp())
-        temp_diff = abs(self.temp_setpoint - current_temp)
-        self.update_status.emit(f"Setting temperature to 25°C. Current temperature: {format(current_temp, '.2f')}°C")
-        while temp_diff > 0.01:
-            if self.stop_event.is_set(): break
-            current_temp = float(self.temp_controller.measure_temp())
-            temp_diff = abs(self.temp_setpoint - current_temp)
-            time.sleep(10)
-            self.update_status.emit(f"Current temperature: {format(current_temp, '.2f')}°C")
-
-        self.update_status.emit("Temperature stabilized.")
+        self.update_status.emit(f"Setting temperature to {self.temp_setpoint}°C. Current temperature: {format(current_temp, '.2f')}°C")
+        last_status = [0.0]
+
+        def temperature_reading(elapsed, temperature):
+            self.log_run('temperature', temperature_c=temperature)
+            if elapsed - last_status[0] >= 10:
+                last_status[0] = elapsed
+                self.update_status.emit(f"Current temperature: {format(temperature, '.2f')}°C")
+
+        settle = self.temp_controller.wait_for_settle(self.temp_setpoint, stop_event=self.stop_event, callback=temperature_reading)
+        self.log_run('temperature_settle', **settle)
+        if settle['settled']:
+            self.update_status.emit(f"Temperature stabilized after {settle['settle_time_s']:.1f}s at {settle['mean_c']:.3f}°C (noise {settle['noise_c']:.3f}°C).")
+        else:
+            self.update_status.emit(f"Temperature not stable after {settle['settle_time_s']:.1f}s: {settle['mean_c']:.3f}°C.")
     
     def current_square(self,  start_value, end_value, steps):
         norm_values = np.linspace(0, 1, steps)
@@ -13,6 +13,7 @@ from PyQt5.QtCore import QThread
 
 #plt.style.use("HHI-HYB")
 
+from core.coupling_scan import CouplingScan
 from core.loop_worker import LoopWorker
 
 from devices import Keithley2400, KeysightN7734A, ThorlabsITC4005, EXFOCTP10
@@ -46,6 +47,8 @@ class MeasurementTab(QtWidgets.QWidget):
         self.wavelength_resolution = self.ui.findChild(QtWidgets.QDoubleSpinBox, 'wavelengthResolution')
         self.optical_power = self.ui.findChild(QtWidgets.QDoubleSpinBox, 'opticalPower')
         self.scan_speed = self.ui.findChild(QtWidgets.QDoubleSpinBox, 'scanSpeed')
+        self.output_channels = self.ui.findChild(QtWidgets.QLineEdit, 'outputChannels')
+        self.pipelined = self.ui.findChild(QtWidgets.QCheckBox, 'checkBoxPipelined')
 
         # APT Settings Inputs
         self.input_waveguide_distance = self.ui.findChild(QtWidgets.QDoubleSpinBox, 'inputWaveguideDistance')
@@ -76,6 +79,9 @@ class MeasurementTab(QtWidgets.QWidget):
         self.gaus_max = self.ui.findChild(QtWidgets.QDoubleSpinBox, 'gausMax')
         self.one_d_scan = self.ui.findChild(QtWidgets.QCheckBox, 'checkBox1D')
         self.two_d_scan = self.ui.findChild(QtWidgets.QCheckBox, 'checkBox2D')
+        # Strategy of the 2D coupling scan, raster first since only raster and continuous save the facet quality maps
+        self.coupling_strategy = self.ui.findChild(QtWidgets.QComboBox, 'couplingStrategy')
+        self.coupling_strategy.addItems(CouplingScan.STRATEGIES + ('continuous',))
 
         self.StatusPrinter = self.ui.findChild(QtWidgets.QTextBrowser, 'StatusUpdate')
 
@@ -212,6 +218,8 @@ class MeasurementTab(QtWidgets.QWidget):
             self.params['wavelength_resolution'] = float(self.wavelength_resolution.text())
             self.params['optical_power'] = float(self.optical_power.text())
             self.params['scan_speed'] = float(self.scan_speed.text())
+            self.params['output_channels'] = self.parse_output_channels(self.output_channels.text())
+            self.params['pipelined'] = self.pipelined.isChecked()
         except ValueError:
             QtWidgets.QMessageBox.warning(self, 'Input Error', 'Please enter valid EXFO values.')
             return
@@ -254,6 +262,7 @@ class MeasurementTab(QtWidgets.QWidget):
             self.params['gaus_max'] = float(self.gaus_max.text())
             self.params['one_d_scan'] = self.one_d_scan.isChecked()
             self.params['two_d_scan'] = self.two_d_scan.isChecked()
+            self.params['coupling_strategy'] = self.coupling_strategy.currentText()
         except ValueError:
             QtWidgets.QMessageBox.warning(self, 'Input Error', 'Please enter valid Coupling values.')
             return
@@ -261,6 +270,23 @@ class MeasurementTab(QtWidgets.QWidget):
         self.send_parameters.emit(self.params)
         # QtWidgets.QMessageBox.information(self, 'Success', 'Parameters set successfully.')
 
+    def parse_output_channels(self, text):
+        """
+        Parse the detectors of the output-array mode.
+
+        :param text: (module, channel) pairs separated by ';', e.g. '1,1;1,2'
+        :type text: str
+        :return: The (module, channel) tuples, None for the configured detector if the text is empty
+        :rtype: list
+        """
+        if not text.strip():
+            return None
+        output_channels = []
+        for pair in text.split(';'):
+            module, channel = pair.split(',')
+            output_channels.append((int(module), int(channel)))
+        return output_channels
+
     def clear_button(self):
         """Clear all input fields in the UI."""
         self.min_current.clear()
@@ -292,6 +318,7 @@ class MeasurementTab(QtWidgets.QWidget):
         self.exfo_IP.clear()
         self.temp_setpoint.clear()
         self.scan_speed.clear()
+        self.output_channels.clear()
 
     def save_settings(self):
         """Save all parameters to a JSON file."""
@@ -316,6 +343,8 @@ class MeasurementTab(QtWidgets.QWidget):
                     'optical_power': self.optical_power.value(),
                     'temp_setpoint': self.temp_setpoint.value(),
                     'set_scan_speed': self.scan_speed.value(),
+                    'output_channels': self.output_channels.text(),
+                    'pipelined': self.pipelined.isChecked(),
                     'compliance_voltage': self.current_limit.value(),
                     'input_waveguide_distance': self.input_waveguide_distance.value(),
                     'output_waveguide_distance': self.output_waveguide_distance.value(),
@@ -326,6 +355,7 @@ class MeasurementTab(QtWidgets.QWidget):
                     'coupling_threshold': self.coupling_threshold.value(),
                     'gaus_min': self.gaus_min.value(),
                     'gaus_max': self.gaus_max.value(),
+                    'coupling_strategy': self.coupling_strategy.currentText(),
                     'switch_1260_1360_TE': self.switch_1260_1360_TE.text(),
                     'switch_1260_1360_TM': self.switch_1260_1360_TM.text(),
                     'switch_1350_1510_TE': self.switch_1350_1510_TE.text(),
@@ -363,6 +393,9 @@ class MeasurementTab(QtWidgets.QWidget):
                     self.optical_power.setValue(settings['optical_power'])
                     self.temp_setpoint.setValue(settings['temp_setpoint'])
                     self.scan_speed.setValue(settings['set_scan_speed'])
+                    # Settings files from before the output-array mode have neither key
+                    self.output_channels.setText(settings.get('output_channels', ''))
+                    self.pipelined.setChecked(settings.get('pipelined', False))
                     self.current_limit.setValue(settings['compliance_voltage'])
                     self.input_waveguide_distance.setValue(settings['input_waveguide_distance'])
                     self.output_waveguide_distance.setValue(settings['output_waveguide_distance'])
@@ -373,6 +406,7 @@ class MeasurementTab(QtWidgets.QWidget):
                     self.coupling_threshold.setValue(settings['coupling_threshold'])
                     self.gaus_min.setValue(settings['gaus_min'])
                     self.gaus_max.setValue(settings['gaus_max'])
+                    self.coupling_strategy.setCurrentText(settings.get('coupling_strategy', 'raster'))
                     self.switch_1260_1360_TE.setText(settings['switch_1260_1360_TE'])
                     self.switch_1260_1360_TM.setText(settings['switch_1260_1360_TM'])
                     self.switch_1350_1510_TE.setText(settings['switch_1350_1510_TE'])
@@ -446,9 +480,40 @@ class MeasurementTab(QtWidgets.QWidget):
             scan_type = '2D'
         else:
             scan_type = '1D'
+        coupling_strategy = self.params['coupling_strategy']
         
+        # Output-array mode: neighbouring outputs on several detectors in one sweep
+        pipelined = self.params['pipelined']
+        output_channels = self.params['output_channels']
+
         # Erstelle den LoopWorker und übergebe alle notwendigen Parameter:
-        self.loop_worker = LoopWorker(self.keithley, self.apt_tab, self.exfo_device, self.lower_optical_switch, self.upper_optical_switch, self.temp_controller, min_current, max_current, steps_current, temp_setpoint, start_wavelength, stop_wavelength, sampling, laser_power, scan_speed, save_path, filename, switch_settings, input_waveguide_distance, output_waveguide_distance, chip_distance, number_of_chips, inputs_per_chip, outputs_per_chip, coupling_threshold, gaus_min, gaus_max, scan_type)
+        try:
+            self.loop_worker = LoopWorker(self.keithley, self.apt_tab, self.exfo_device, self.lower_optical_switch, self.upper_optical_switch, self.temp_controller, min_current, max_current, steps_current, temp_setpoint, start_wavelength, stop_wavelength, sampling, laser_power, scan_speed, save_path, filename, switch_settings, input_waveguide_distance, output_waveguide_distance, chip_distance, number_of_chips, inputs_per_chip, outputs_per_chip, coupling_threshold, gaus_min, gaus_max, scan_type,
+                                          pipelined=pipelined, output_channels=output_channels, coupling_strategy=coupling_strategy)
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self, 'Input Error', f'{e}')
+            return
+        # Traversal order and predicted run time before the run starts, planned off the GUI thread
+        self.loop_worker.run_planned.connect(self.confirm_loop_start)
+        self.StatusPrinter.append("Estimating the run time from earlier runs...")
+        self.loop_worker.plan_run()
+
+    def confirm_loop_start(self, message):
+        """
+        Shows the planned traversal and starts the loop thread after confirmation.
+
+        :param message: The planned traversal and predicted run time
+        :type message: str
+        """
+        self.StatusPrinter.append(message)
+        if self.loop_worker.run_estimate is None:
+            question = 'The run time could not be predicted. Do you want to start the loop?'
+        else:
+            question = f"The run is predicted to take {self.loop_worker.run_estimate['total_s'] / 3600:.1f} h. Do you want to start the loop?"
+        reply = QtWidgets.QMessageBox.question(self, 'Confirmation', question, QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
+        if reply != QtWidgets.QMessageBox.Yes:
+            self.StatusPrinter.append("Loop aborted.")
+            return
         self.loop_thread = QThread()
 
         # Verbinde das Signal des Workers mit der Statusaktualisierungsmethode in der GUI
@@ -521,7 +586,7 @@ class MeasurementTab(QtWidgets.QWidget):
             if error_code == 0:
                 self.StatusPrinter.append("Scan completed successfully.")
                 wavelength_array = self.exfo_device.create_wavelength_array()
-                il_data = self.exfo_device.retrieve_ASCii_trace()
+                il_data = self.exfo_device.retrieve_trace()
 
             else:
                 self.StatusPrinter.append(f"Scan failed with error code {error_code}: {error_name}")
@@ -541,7 +606,7 @@ class MeasurementTab(QtWidgets.QWidget):
                 },
                 'data': {
                     'wavelength_nm': wavelength_array.tolist(),
-                    'il_te_dbm': il_data,
+                    'il_te_dbm': il_data.tolist(),
                 }
             }
 
@@ -601,8 +666,15 @@ class MeasurementTab(QtWidgets.QWidget):
             x_vals_2d, y_vals_2d = np.meshgrid(np.unique(x_vals), np.unique(y_vals))
             fitted_power = 10 * np.log10(fitted_power/1e-3)
             try:
-                # Create the colorplot (heatmap) for the measured data
-                c = self.ax_coupling.pcolormesh(x_vals_2d, y_vals_2d, power, shading='auto', cmap='viridis')
+                if power.ndim == 1:
+                    # Adaptive scans visit scattered points, the fit is evaluated on the full grid
+                    c = self.ax_coupling.scatter(x_vals, y_vals, c=power, cmap='viridis')
+                    grid = np.linspace(0, 10, fitted_power.shape[0])
+                    x_vals_2d, y_vals_2d = np.meshgrid(grid, grid)
+                    fitted_power = fitted_power.T
+                else:
+                    # Create the colorplot (heatmap) for the measured data
+                    c = self.ax_coupling.pcolormesh(x_vals_2d, y_vals_2d, power, shading='auto', cmap='viridis')
                 self.coupling_canvas.figure.colorbar(c, ax=self.ax_coupling, label='Measured Power')
 
                 # Plot the fitted 2D Gaussian as contour lines
@@ -0,0 +1,170 @@
+import glob
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+class RunContainer:
+    """
+    HDF5 container holding all measurements of one run.
+
+    TE and TM traces are stored as compressed float32 datasets shaped (current, waveguide, wavelength),
+    chunked per trace so each append only touches the chunks of the new record. The file is flushed
+    after every append, so a crash loses at most the record in flight.
+    """
+    FIT_PARAMS = 7  # Parameters of the 2D Gaussian; 1D fits fill the first three
+    TRACKING_AXES = ('input_horz', 'input_vert', 'output_horz', 'output_vert', 'focus_horz', 'focus_vert')
+    # Run log series a record references by line number, -1 if the record has no entry in the series
+    RUN_LOG_SERIES = ('keithley_power', 'coupling_scan')
+
+    def __init__(self, path, currents, attributes=None, compression='gzip'):
+        """
+        :param path: The path of the HDF5 file.
+        :type path: str
+        :param currents: The currents of the run in A.
+        :type currents: np.ndarray
+        :param attributes: Run settings stored as file attributes, e.g. sampling or laser power.
+        :type attributes: dict
+        :param compression: The HDF5 compression filter of the trace datasets.
+        :type compression: str
+        """
+        if h5py is None:
+            raise ImportError('The HDF5 run container requires h5py. Install it with "pip install h5py".')
+        self.path = path
+        self.compression = compression
+        self.file = h5py.File(path, 'w')
+        self.file.create_dataset('currents_a', data=np.asarray(currents, dtype=np.float64))
+        for key, value in (attributes or {}).items():
+            self.file.attrs[key] = value
+        self.file.flush()
+
+    def create_datasets(self, number_of_points):
+        """Creates the per-record datasets once the trace length is known."""
+        number_of_currents = len(self.file['currents_a'])
+        for name in ('il_te_db', 'il_tm_db'):
+            self.file.create_dataset(
+                name, shape=(number_of_currents, 0, number_of_points), maxshape=(number_of_currents, None, number_of_points),
+                dtype=np.float32, chunks=(1, 1, number_of_points), compression=self.compression, fillvalue=np.nan)
+        self.file.create_dataset('gaussian_fit_params', shape=(number_of_currents, 0, self.FIT_PARAMS), maxshape=(number_of_currents, None, self.FIT_PARAMS), dtype=np.float64, fillvalue=np.nan)
+        self.file.create_dataset('motor_positions', shape=(number_of_currents, 0, 2), maxshape=(number_of_currents, None, 2), dtype=np.float64, fillvalue=np.nan)
+        self.file.create_dataset('tracking_offsets', shape=(number_of_currents, 0, len(self.TRACKING_AXES)), maxshape=(number_of_currents, None, len(self.TRACKING_AXES)), dtype=np.float64, fillvalue=np.nan)
+        self.file.create_dataset('run_log_lines', shape=(number_of_currents, 0, len(self.RUN_LOG_SERIES)), maxshape=(number_of_currents, None, len(self.RUN_LOG_SERIES)), dtype=np.int64, fillvalue=-1)
+        self.file.create_dataset('measured', shape=(number_of_currents, 0), maxshape=(number_of_currents, None), dtype=bool, fillvalue=False)
+        self.file['motor_positions'].attrs['columns'] = ['input', 'output']
+        self.file['tracking_offsets'].attrs['columns'] = list(self.TRACKING_AXES)
+        self.file['run_log_lines'].attrs['columns'] = list(self.RUN_LOG_SERIES)
+
+    def append(self, current_index, waveguide, wavelength_nm, il_te_db, il_tm_db, fit_params=None, motor_positions=None, tracking_offsets=None, run_log_lines=None):
+        """
+        Writes the record of one waveguide at one current step and flushes the file.
+
+        :param current_index: Index of the current step.
+        :type current_index: int
+        :param waveguide: Index of the output waveguide.
+        :type waveguide: int
+        :param wavelength_nm: The wavelength axis.
+        :type wavelength_nm: np.ndarray
+        :param il_te_db: The TE insertion loss.
+        :type il_te_db: np.ndarray
+        :param il_tm_db: The TM insertion loss.
+        :type il_tm_db: np.ndarray
+        :param fit_params: The parameters of the coupling fit.
+        :type fit_params: np.ndarray
+        :param motor_positions: The input and output motor positions.
+        :type motor_positions: np.ndarray
+        :param tracking_offsets: The NanoTrak offsets of the last tracking, ordered as TRACKING_AXES.
+        :type tracking_offsets: np.ndarray
+        :param run_log_lines: Line numbers of the entries of the record in the run log sidecar, by series of RUN_LOG_SERIES.
+        :type run_log_lines: dict
+        """
+        if 'wavelength_nm' not in self.file:
+            self.file.create_dataset('wavelength_nm', data=np.asarray(wavelength_nm, dtype=np.float64))
+            self.create_datasets(len(wavelength_nm))
+
+        if waveguide >= self.file['measured'].shape[1]:
+            for name in ('il_te_db', 'il_tm_db', 'gaussian_fit_params', 'motor_positions', 'tracking_offsets', 'run_log_lines', 'measured'):
+                self.file[name].resize(waveguide + 1, axis=1)
+
+        self.file['il_te_db'][current_index, waveguide] = np.asarray(il_te_db, dtype=np.float32)
+        self.file['il_tm_db'][current_index, waveguide] = np.asarray(il_tm_db, dtype=np.float32)
+        if fit_params is not None and len(fit_params):
+            params = np.full(self.FIT_PARAMS, np.nan)
+            params[:len(fit_params)] = fit_params
+            self.file['gaussian_fit_params'][current_index, waveguide] = params
+        if motor_positions is not None:
+            self.file['motor_positions'][current_index, waveguide] = motor_positions
+        if tracking_offsets is not None:
+            self.file['tracking_offsets'][current_index, waveguide] = tracking_offsets
+        if run_log_lines is not None:
+            lines = [run_log_lines.get(series) for series in self.RUN_LOG_SERIES]
+            self.file['run_log_lines'][current_index, waveguide] = [-1 if line is None else line for line in lines]
+        self.file['measured'][current_index, waveguide] = True
+        self.file.flush()
+
+    def close(self):
+        """Closes the HDF5 file."""
+        self.file.close()
+
+
+def convert_json_folder(folder, path):
+    """
+    Converts a folder of per-waveguide JSON files written by the measurement loop into one run container.
+
+    :param folder: The folder with the JSON files.
+    :type folder: str
+    :param path: The path of the HDF5 file to create.
+    :type path: str
+    :return: The number of converted files.
+    :rtype: int
+    """
+    pattern = re.compile(r'output_(\d+)_current_([-\d.]+)A\.json$')
+    records = []
+    for file_path in sorted(glob.glob(os.path.join(folder, '*.json'))):
+        match = pattern.search(os.path.basename(file_path))
+        if match:
+            records.append((float(match.group(2)), int(match.group(1)), file_path))
+    if not records:
+        raise FileNotFoundError(f'No measurement files found in {folder}')
+
+    currents = sorted({current for current, _, _ in records})
+    with open(records[0][2]) as json_file:
+        first_metadata = json.load(json_file)['metadata']
+    attributes = {
+        'sampling_resolution_pm': first_metadata['sampling_resolution_pm'],
+        'laser_sweep_speed_nm_per_s': first_metadata['laser_sweep_speed_nm_per_s'],
+        'laser_power_dbm': first_metadata['laser_power_dbm'],
+        'converted_from': os.path.abspath(folder)
+    }
+    container = RunContainer(path, currents, attributes)
+    try:
+        for current, waveguide, file_path in records:
+            with open(file_path) as json_file:
+                measurement = json.load(json_file)
+            references = {series: measurement['metadata'].get(series) for series in RunContainer.RUN_LOG_SERIES}
+            for reference in references.values():
+                if reference is not None:
+                    container.file.attrs['run_log'] = reference['file']
+            container.append(
+                currents.index(current), waveguide,
+                measurement['data']['wavelength_nm'], measurement['data']['il_te_db'], measurement['data']['il_tm_db'],
+                fit_params=measurement['metadata'].get('gaussian_fit_params'),
+                run_log_lines={series: reference['line'] for series, reference in references.items() if reference is not None})
+    finally:
+        container.close()
+    return len(records)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('Usage: python -m core.run_container <json_folder> <output.h5>')
+        sys.exit(1)
+    converted = convert_json_folder(sys.argv[1], sys.argv[2])
+    print(f'Converted {converted} measurement files into {sys.argv[2]}')
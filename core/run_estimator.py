@@ -0,0 +1,325 @@
+import glob
+import json
+import os
+
+import numpy as np
+
+from core.run_planner import RunPlanner
+
+
+class PhaseModel:
+    """
+    Duration of one phase of the loop as a line time = offset + slope * x over a phase specific size x,
+    e.g. the sweep time over range / speed or the download time over the number of trace points.
+
+    The model starts from default coefficients and is refit from the latest logged samples. With too
+    little spread in x only the offset is refit and the default slope is kept.
+    """
+    def __init__(self, offset, slope=0.0, max_samples=200):
+        """
+        :param offset: Default duration in s at x = 0.
+        :type offset: float
+        :param slope: Default duration in s per unit of x.
+        :type slope: float
+        :param max_samples: Number of latest samples the model is fitted to.
+        :type max_samples: int
+        """
+        self.offset = offset
+        self.slope = slope
+        self.max_samples = max_samples
+        self.samples = []
+
+    def add(self, x, time_s):
+        """Adds a logged duration in s at size x."""
+        self.samples.append((float(x), float(time_s)))
+        del self.samples[:-self.max_samples]
+
+    def fit(self):
+        """Refits the coefficients to the samples."""
+        if not self.samples:
+            return
+        x, t = np.array(self.samples).T
+        if len(x) >= 3 and np.ptp(x) > 0.1 * max(np.abs(x).max(), 1e-12):
+            slope, offset = np.polyfit(x, t, 1)
+            if slope >= 0:
+                self.slope, self.offset = float(slope), float(offset)
+                return
+        # The median keeps single long waits, e.g. the first temperature settle of a run, from pulling the offset
+        self.offset = float(np.median(t - self.slope * x))
+
+    def predict(self, x=0.0):
+        """Returns the predicted duration in s at size x."""
+        return max(self.offset + self.slope * x, 0.0)
+
+    def rms_error(self):
+        """Returns the root mean square deviation in s of the samples from the model, None without samples."""
+        if not self.samples:
+            return None
+        x, t = np.array(self.samples).T
+        return float(np.sqrt(np.mean((t - (self.offset + self.slope * x))**2)))
+
+
+class RunEstimator:
+    """
+    Dry-run estimate of a measurement recipe from per-phase timing models.
+
+    The models are calibrated from the run logs (*_run.jsonl) of earlier runs, so the estimate follows the
+    setup as more runs are logged. A recipe is played through RunPlanner with the calibrated phase costs,
+    which also picks the traversal order.
+    """
+    # Default (offset in s, slope) of every phase and the size the slope refers to
+    DEFAULTS = {
+        'sweep': (4.4, 2.0),                # TE and TM sweep of a waveguide over range / speed in s
+        'download': (1.0, 2e-5),            # TM download over the number of trace points
+        'tracking': (12.5, 0.0),
+        'verify': (1.5, 0.0),               # NanoTrak restore and signal check at a cached alignment
+        'current_settle': (3.0, 2.0),       # settle after a current step over the step in mA
+        'initial_temperature': (60.0, 0.0), # temperature settle at the start of the run
+        'move': (0.3, 1.0)                  # motor move over the move time expected from the velocity profile
+    }
+    # Default (offset in s, slope in s per point) and number of points of the coupling scan strategies
+    COUPLING_DEFAULTS = {
+        '1D': (1.0, 0.1, 21),
+        'raster': (1.0, 0.1, 441),
+        'coarse_to_fine': (1.0, 0.1, 83),
+        'spiral': (1.0, 0.1, 25),
+        'crosshair': (1.0, 0.1, 80),
+        'continuous': (5.0, 0.0025, 10000)
+    }
+
+    # Fields of the run log entries the models are calibrated from
+    LOG_FIELDS = {
+        'recipe': ('sweep_time_s', 'trace_points'),
+        'traversal': ('predicted_total_s',),
+        'tracking': ('time_s',),
+        'coupling': ('scan_type', 'strategy', 'points', 'scan_time_s'),
+        'current_settle': ('current_a', 'settle_time_s'),
+        'alignment_check': ('verified', 'time_s'),
+        'motor_moves': ('moves',),
+        'timeline': ('steps',)
+    }
+    # Reduced entries of the run logs read so far, by path, with the modification time and size they were read at
+    log_cache = {}
+
+    def __init__(self, max_samples=200):
+        """
+        :param max_samples: Number of latest samples every phase model is fitted to.
+        :type max_samples: int
+        """
+        self.max_samples = max_samples
+        self.models = {phase: PhaseModel(offset, slope, max_samples) for phase, (offset, slope) in self.DEFAULTS.items()}
+        self.coupling_models = {strategy: PhaseModel(offset, slope, max_samples) for strategy, (offset, slope, _) in self.COUPLING_DEFAULTS.items()}
+        self.coupling_points = {strategy: [points] for strategy, (_, _, points) in self.COUPLING_DEFAULTS.items()}
+        self.cache_checks = []
+        self.runs = []
+
+    def calibrate(self, directory):
+        """
+        Refits the phase models from all run logs in a directory and its subdirectories, oldest first.
+
+        The timing fields of every log are kept in log_cache, so a log is only parsed again when it changed.
+
+        :param directory: The directory holding the run logs
+        :type directory: str
+        :return: The number of run logs read
+        :rtype: int
+        """
+        paths = sorted(glob.glob(os.path.join(directory, '**', '*_run.jsonl'), recursive=True), key=os.path.basename)
+        runs = 0
+        for path in paths:
+            entries = self.read_log(path)
+            if entries is None:
+                continue
+            self.add_run(entries, os.path.basename(path))
+            runs += 1
+        for model in list(self.models.values()) + list(self.coupling_models.values()):
+            model.fit()
+        return runs
+
+    def read_log(self, path):
+        """
+        Returns the timing fields of the entries of a run log, from log_cache if the file has not changed.
+
+        :param path: The path of the run log
+        :type path: str
+        :return: The reduced entries, None if the log cannot be read
+        :rtype: list
+        """
+        try:
+            status = os.stat(path)
+        except OSError:
+            return None
+        cached = self.log_cache.get(path)
+        if cached is not None and cached[0] == (status.st_mtime, status.st_size):
+            return cached[1]
+        entries = []
+        try:
+            with open(path) as log_file:
+                for line in log_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    # Only the timing fields are kept, the coupling scan arrays would fill the cache
+                    if entry.get('kind') in self.LOG_FIELDS:
+                        entries.append({key: entry[key] for key in ('kind',) + self.LOG_FIELDS[entry['kind']] if key in entry})
+        except OSError:
+            return None
+        self.log_cache[path] = ((status.st_mtime, status.st_size), entries)
+        return entries
+
+    def add_run(self, entries, name=''):
+        """
+        Adds the phase timings of one run log.
+
+        :param entries: The entries of the run log
+        :type entries: list
+        :param name: The name of the run in the error history
+        :type name: str
+        """
+        recipe = None
+        predicted = None
+        previous_current = 0.0
+        for entry in entries:
+            kind = entry.get('kind')
+            if kind == 'recipe':
+                recipe = entry
+            elif kind == 'traversal':
+                predicted = entry.get('predicted_total_s')
+            elif kind == 'tracking' and 'time_s' in entry:
+                self.models['tracking'].add(0, entry['time_s'])
+            elif kind == 'coupling' and 'scan_time_s' in entry:
+                strategy = entry.get('strategy', '1D') if entry.get('scan_type') == '2D' else '1D'
+                model = self.coupling_models.setdefault(strategy, PhaseModel(1.0, 0.1, self.max_samples))
+                model.add(entry['points'], entry['scan_time_s'])
+                self.coupling_points.setdefault(strategy, []).append(entry['points'])
+            elif kind == 'current_settle':
+                self.models['current_settle'].add(abs(entry['current_a'] - previous_current) * 1e3, entry['settle_time_s'])
+                previous_current = entry['current_a']
+            elif kind == 'alignment_check':
+                self.cache_checks.append(bool(entry['verified']))
+                # Without the motor travel and re-tracking of the align step, RunPlanner adds those separately
+                if 'time_s' in entry:
+                    self.models['verify'].add(0, entry['time_s'])
+            elif kind == 'motor_moves':
+                for move in entry['moves']:
+                    if move.get('stopped', True):
+                        self.models['move'].add(move['expected_s'], move['time_s'])
+            elif kind == 'timeline':
+                self.add_timeline(entry['steps'], recipe, predicted, name)
+
+    def add_timeline(self, steps, recipe, predicted, name):
+        """Adds the durations of the steps of a run and the error of its predicted run time."""
+        ran = [step for step in steps if step['start_s'] is not None and not step['skipped'] and step['error'] is None]
+        for step in ran:
+            duration = step['end_s'] - step['start_s']
+            if step['name'] == 'temperature':
+                self.models['initial_temperature'].add(0, duration)
+            elif recipe is None:
+                continue
+            elif step['name'].endswith(' sweep'):
+                self.models['sweep'].add(recipe['sweep_time_s'], duration)
+            elif step['name'].endswith(' download'):
+                self.models['download'].add(recipe['trace_points'], duration)
+        if predicted is not None and ran:
+            actual = max(step['end_s'] for step in ran)
+            self.runs.append({'run': name, 'predicted_s': predicted, 'actual_s': actual, 'error': (predicted - actual) / actual if actual > 0 else 0.0})
+
+    def costs(self, sweep_time, trace_points, coupling_strategy):
+        """
+        Returns the calibrated phase costs of a recipe for RunPlanner.
+
+        :param sweep_time: Duration of one sweep in s, the wavelength range over the sweep speed
+        :type sweep_time: float
+        :param trace_points: Number of trace points downloaded per sweep over all output channels
+        :type trace_points: int
+        :param coupling_strategy: The coupling scan, '1D' or one of the 2D strategies
+        :type coupling_strategy: str
+        :rtype: dict
+        """
+        coupling_model = self.coupling_models.get(coupling_strategy, self.coupling_models['coarse_to_fine'])
+        coupling_points = np.median(self.coupling_points.get(coupling_strategy, self.coupling_points['coarse_to_fine']))
+        move = self.models['move']
+        settle = self.models['current_settle']
+        switches = RunPlanner.SWITCH_CHANGES_PER_SWEEP * RunPlanner.COSTS['switch_s']
+        costs = {
+            'settle_s': settle.offset,
+            'settle_s_per_ma': settle.slope,
+            'tracking_s': self.models['tracking'].predict(),
+            'coupling_s': coupling_model.predict(float(coupling_points)),
+            'verify_s': self.models['verify'].predict(),
+            'move_overhead_s': move.offset,
+            'move_scale': move.slope,
+            'sweep_overhead_s': self.models['sweep'].offset - switches,
+            'sweep_s_per_s': self.models['sweep'].slope,
+            'download_s': self.models['download'].predict(trace_points)
+        }
+        if self.cache_checks:
+            costs['cache_miss_rate'] = 1 - float(np.mean(self.cache_checks))
+        return costs
+
+    def estimate(self, currents, waveguide_planner, start_wavelength, stop_wavelength, sampling, scan_speed, outputs_per_sweep=1, scan_type='2D', coupling_strategy='coarse_to_fine', max_velocity=0.5, acceleration=0.2, settle_max_wait=20.0, traversal_order='auto'):
+        """
+        Estimates the run time of a recipe from the parameters the LoopWorker receives.
+
+        :param currents: The current steps in A
+        :type currents: sequence
+        :param waveguide_planner: The target table of the waveguides
+        :type waveguide_planner: WaveguidePlanner
+        :param start_wavelength: Start wavelength of the sweeps in nm
+        :type start_wavelength: float
+        :param stop_wavelength: Stop wavelength of the sweeps in nm
+        :type stop_wavelength: float
+        :param sampling: Sampling resolution in pm
+        :type sampling: float
+        :param scan_speed: Sweep speed in nm/s
+        :type scan_speed: float
+        :param outputs_per_sweep: Number of output channels downloaded per sweep
+        :type outputs_per_sweep: int
+        :param scan_type: '1D' or '2D' coupling scan
+        :type scan_type: str
+        :param coupling_strategy: The 2D coupling scan strategy
+        :type coupling_strategy: str
+        :param max_velocity: Maximum velocity of the motors in mm/s
+        :type max_velocity: float
+        :param acceleration: Acceleration of the motors in mm/s^2
+        :type acceleration: float
+        :param settle_max_wait: Upper bound of the settle after a current step in s
+        :type settle_max_wait: float
+        :param traversal_order: 'auto' or one of RunPlanner.ORDERS
+        :type traversal_order: str
+        :return: The recipe sizes, the traversal order, the per-phase estimate of every order and the total in s
+        :rtype: dict
+        """
+        sweep_range = abs(stop_wavelength - start_wavelength)
+        recipe = {
+            'sweep_time_s': sweep_range / scan_speed if scan_speed > 0 else 0.0,
+            'trace_points': int(round(sweep_range * 1e3 / sampling)) + 1 if sampling > 0 else 0,
+            'coupling_strategy': coupling_strategy if scan_type == '2D' else '1D'
+        }
+        recipe['trace_points'] *= outputs_per_sweep
+        costs = self.costs(recipe['sweep_time_s'], recipe['trace_points'], recipe['coupling_strategy'])
+        run_planner = RunPlanner(currents, waveguide_planner, sweep_range, scan_speed, max_velocity=max_velocity, acceleration=acceleration, settle_max_wait=settle_max_wait, costs=costs)
+        order, estimates = run_planner.choose(traversal_order)
+        initial = self.models['initial_temperature'].predict()
+        for estimate in estimates.values():
+            estimate['initial_s'] = initial
+            estimate['total_s'] += initial
+        return {'recipe': recipe, 'order': order, 'estimates': estimates, 'total_s': estimates[order]['total_s'], 'summary': run_planner.summary(order, estimates)}
+
+    def summary(self, runs=None):
+        """
+        Returns the calibration state as text: the run logs read, the residuals of the phase models and the error of the latest predictions.
+
+        :param runs: The number of run logs read by calibrate
+        :type runs: int
+        :rtype: str
+        """
+        if not runs:
+            return "Run time estimate from default phase timings, no run logs found."
+        residuals = ", ".join(f"{phase} {model.rms_error():.1f}s" for phase, model in self.models.items() if model.samples)
+        text = f"Run time estimate calibrated from {runs} run logs, phase model residuals: {residuals}."
+        if self.runs:
+            errors = ", ".join(f"{100*run['error']:+.0f}%" for run in self.runs[-5:])
+            text += f" Prediction error of the latest runs: {errors}."
+        return text
@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+import time
+
+from core.data_writer import to_json
+
+
+class RunLog:
+    """
+    Append-only JSON lines sidecar holding the run-wide series of a loop run.
+
+    Keithley power, temperatures, motor positions and coupling scans are written once as they occur.
+    Measurement files reference an entry by its line number instead of repeating the history.
+    """
+    def __init__(self, path):
+        """
+        :param path: The path of the sidecar file.
+        :type path: str
+        """
+        self.path = path
+        self.file_name = os.path.basename(path)
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def entry(self, kind, **values):
+        """
+        Reserves the next line for an entry.
+
+        :param kind: The series of the entry, e.g. 'keithley_power' or 'temperature'.
+        :type kind: str
+        :param values: The values of the entry.
+        :return: The line number and the entry.
+        :rtype: tuple
+        """
+        with self.lock:
+            line = self.lines
+            self.lines += 1
+        entry = {'line': line, 'time': time.time(), 'kind': kind}
+        entry.update(values)
+        return line, entry
+
+    def write(self, entry):
+        """
+        Appends an entry to the sidecar file.
+
+        :param entry: The entry created by entry().
+        :type entry: dict
+        """
+        with open(self.path, 'a') as log_file:
+            log_file.write(json.dumps(to_json(entry)) + '\n')
+
+    def reference(self, line):
+        """
+        Returns the reference to a sidecar entry stored in measurement files.
+
+        :param line: The line number of the entry.
+        :type line: int
+        :rtype: dict
+        """
+        return {'file': self.file_name, 'line': line}
@@ -0,0 +1,185 @@
+import numpy as np
+
+
+class RunPlanner:
+    """
+    Cost model of the two traversal orders of the loop.
+
+    'current_outer' sets every current once and visits all waveguides per current step, so the chip is
+    traversed once per current and every later visit of a waveguide moves back to its cached alignment.
+    'waveguide_outer' aligns every waveguide once and steps through all currents there, so the chip is
+    traversed once but the current settles once per current step and waveguide. The currents run up and
+    down on alternate waveguides, so no waveguide starts with a jump over the whole current range.
+
+    Both orders are played through the pipeline of the step graph: a waveguide is prepared (current
+    settle, motor move, alignment) while the traces of the previous one are downloaded.
+    """
+    ORDERS = ('current_outer', 'waveguide_outer')
+    # Default phase costs in s, a current step settles in settle_s plus settle_s_per_ma per mA of the step,
+    # the sweeps of a waveguide take sweep_s_per_s times range / speed plus sweep_overhead_s and a move takes
+    # move_scale times the time of the velocity profile plus move_overhead_s
+    COSTS = {
+        'settle_s': 3.0,
+        'settle_s_per_ma': 2.0,
+        'tracking_s': 12.5,
+        'coupling_s': 30.0,
+        'verify_s': 1.5,
+        'cache_miss_rate': 0.1,
+        'move_overhead_s': 0.3,
+        'move_scale': 1.0,
+        'sweep_overhead_s': 4.0,
+        'sweep_s_per_s': 2.0,
+        'download_s': 3.0,
+        'switch_s': 0.1
+    }
+    SWITCH_CHANGES_PER_SWEEP = 4
+
+    def __init__(self, currents, waveguide_planner, sweep_range_nm, scan_speed, max_velocity=0.5, acceleration=0.2, settle_max_wait=20.0, costs=None):
+        """
+        :param currents: The current steps in A
+        :type currents: sequence
+        :param waveguide_planner: The target table of the waveguides
+        :type waveguide_planner: WaveguidePlanner
+        :param sweep_range_nm: Wavelength range of a sweep in nm
+        :type sweep_range_nm: float
+        :param scan_speed: Sweep speed in nm/s
+        :type scan_speed: float
+        :param max_velocity: Maximum velocity of the motors in mm/s
+        :type max_velocity: float
+        :param acceleration: Acceleration of the motors in mm/s^2
+        :type acceleration: float
+        :param settle_max_wait: Upper bound of the settle after a current step in s
+        :type settle_max_wait: float
+        :param costs: Phase costs replacing entries of COSTS
+        :type costs: dict
+        """
+        self.currents = np.asarray(currents, dtype=float)
+        self.waveguide_planner = waveguide_planner
+        self.sweep_range_nm = abs(sweep_range_nm)
+        self.scan_speed = scan_speed
+        self.max_velocity = max_velocity if max_velocity > 0 else 1.0
+        self.acceleration = acceleration if acceleration > 0 else 1.0
+        self.settle_max_wait = settle_max_wait
+        self.costs = dict(self.COSTS)
+        self.costs.update(costs or {})
+
+    def settle_time(self, current_step):
+        """Returns the settle time in s after a current step in A."""
+        return min(self.costs['settle_s'] + self.costs['settle_s_per_ma'] * abs(current_step) * 1e3, self.settle_max_wait)
+
+    def move_time(self, distance):
+        """Returns the duration in s of a motor move from the trapezoidal velocity profile, 0 without a move."""
+        distance = abs(distance)
+        if distance == 0:
+            return 0.0
+        if distance < self.max_velocity**2 / self.acceleration:
+            profile = 2 * np.sqrt(distance / self.acceleration)
+        else:
+            profile = distance / self.max_velocity + self.max_velocity / self.acceleration
+        return self.costs['move_scale'] * profile + self.costs['move_overhead_s']
+
+    def hop_time(self, previous, target):
+        """Returns the time in s to move from one target to the next, the input and output motors move together."""
+        if previous is None:
+            return 0.0
+        return max(self.move_time(target['input_offset'] - previous['input_offset']), self.move_time(target['output_offset'] - previous['output_offset']))
+
+    def sweep_time(self):
+        """Returns the duration in s of the TE and TM sweep of a waveguide including the switch changes."""
+        sweep = self.sweep_range_nm / self.scan_speed if self.scan_speed > 0 else 0.0
+        return self.costs['sweep_s_per_s'] * sweep + self.costs['sweep_overhead_s'] + self.SWITCH_CHANGES_PER_SWEEP * self.costs['switch_s']
+
+    def verify_time(self):
+        """Returns the time in s to confirm a cached alignment, including the waveguides that have to be tracked again."""
+        return self.costs['verify_s'] + self.costs['cache_miss_rate'] * (self.costs['tracking_s'] + self.costs['coupling_s'])
+
+    def visits(self, order):
+        """
+        Lists the visits of a traversal order with their phase times.
+
+        :param order: One of ORDERS
+        :type order: str
+        :return: One dict per sweep with the settle, move, align, sweep and download time in s
+        :rtype: list
+        """
+        if order not in self.ORDERS:
+            raise ValueError(f"Unknown traversal order {order}.")
+        targets = self.waveguide_planner.targets
+        first_alignment = self.costs['tracking_s'] + self.costs['coupling_s']
+        visits = []
+        previous_target = None
+        previous_current = 0.0
+        if order == 'current_outer':
+            for pass_index, current in enumerate(self.currents):
+                for index, target in enumerate(self.waveguide_planner.order(pass_index)):
+                    visits.append({
+                        'settle': self.settle_time(current - previous_current) if index == 0 else 0.0,
+                        'move': self.hop_time(previous_target, target),
+                        'align': first_alignment if pass_index == 0 else self.verify_time(),
+                        'sweep': self.sweep_time(),
+                        'download': self.costs['download_s']
+                    })
+                    previous_target = target
+                previous_current = current
+        else:
+            for index, target in enumerate(targets):
+                currents = self.currents if index % 2 == 0 else self.currents[::-1]
+                for current_index, current in enumerate(currents):
+                    visits.append({
+                        'settle': self.settle_time(current - previous_current),
+                        'move': self.hop_time(previous_target, target) if current_index == 0 else 0.0,
+                        'align': first_alignment if current_index == 0 else self.verify_time(),
+                        'sweep': self.sweep_time(),
+                        'download': self.costs['download_s']
+                    })
+                    previous_current = current
+                previous_target = target
+        return visits
+
+    def estimate(self, order):
+        """
+        Estimates the run time of a traversal order.
+
+        The next waveguide is prepared while the previous one is downloaded, the difference between the sum
+        of the phases and the pipelined total is reported as negative overlap.
+
+        :param order: One of ORDERS
+        :type order: str
+        :return: The time in s per phase, the overlap and the total
+        :rtype: dict
+        """
+        visits = self.visits(order)
+        sweep_end = download_end = 0.0
+        for visit in visits:
+            prepared = sweep_end + visit['settle'] + visit['move'] + visit['align']
+            sweep_end = max(prepared, download_end) + visit['sweep']
+            download_end = sweep_end + visit['download']
+        phases = {f'{phase}_s': float(sum(visit[phase] for visit in visits)) for phase in ('settle', 'move', 'align', 'sweep', 'download')}
+        phases['overlap_s'] = download_end - sum(phases.values())
+        phases['total_s'] = download_end
+        return phases
+
+    def choose(self, order='auto'):
+        """
+        Picks the traversal order of a run.
+
+        :param order: 'auto' for the fastest order, or one of ORDERS to keep it
+        :type order: str
+        :return: The order and the estimate of every order
+        :rtype: tuple
+        """
+        estimates = {candidate: self.estimate(candidate) for candidate in self.ORDERS}
+        if order == 'auto':
+            order = min(estimates, key=lambda candidate: estimates[candidate]['total_s'])
+        elif order not in self.ORDERS:
+            raise ValueError(f"Unknown traversal order {order}.")
+        return order, estimates
+
+    def summary(self, order, estimates):
+        """Returns the chosen order with its phases and the predicted times of all orders as text."""
+        labels = (('initial_s', 'initial temperature'), ('settle_s', 'settle'), ('move_s', 'motion'), ('align_s', 'alignment'),
+                  ('sweep_s', 'sweeps'), ('download_s', 'downloads'), ('overlap_s', 'overlap'))
+        estimate = estimates[order]
+        phases = ", ".join(f"{label} {estimate[key]/60:.0f}min" for key, label in labels if key in estimate)
+        others = ", ".join(f"{candidate} {estimates[candidate]['total_s']/3600:.2f}h" for candidate in self.ORDERS if candidate != order)
+        return f"Traversal: {order}, predicted {estimate['total_s']/3600:.2f}h ({phases}); {others}."
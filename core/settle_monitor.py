@@ -0,0 +1,74 @@
+import time
+from collections import deque
+
+import numpy as np
+
+
+class SettleMonitor:
+    """
+    Watches several readbacks together and releases once all of them are stable.
+
+    A channel is stable when its readings over the last window seconds stay inside its band. The wait ends
+    as soon as every channel is stable, or after max_wait, so a fixed sleep becomes only the upper bound.
+    """
+    def __init__(self, max_wait=20.0, window=2.0, poll_interval=0.25):
+        """
+        :param max_wait: Maximum wait in s.
+        :type max_wait: float
+        :param window: Time in s a channel has to stay inside its band.
+        :type window: float
+        :param poll_interval: Time between two readings of all channels in s.
+        :type poll_interval: float
+        """
+        self.max_wait = max_wait
+        self.window = window
+        self.poll_interval = poll_interval
+        self.channels = {}
+
+    def add_channel(self, name, read, band):
+        """
+        Adds a readback to watch.
+
+        :param name: The name of the channel in the result
+        :type name: str
+        :param read: Returns the current reading
+        :type read: callable
+        :param band: Largest peak-to-peak change over the window that counts as stable
+        :type band: float
+        """
+        self.channels[name] = (read, band)
+
+    def wait(self, stop_event=None):
+        """
+        Reads all channels until they are stable.
+
+        :param stop_event: Ends the wait early when set.
+        :type stop_event: threading.Event
+        :return: Whether all channels settled, the settle time in s and the last reading and peak-to-peak change of every channel.
+        :rtype: dict
+        """
+        readings = {name: deque() for name in self.channels}
+        time_start = time.perf_counter()
+        settled = False
+        while True:
+            elapsed = time.perf_counter() - time_start
+            stable = {}
+            for name, (read, band) in self.channels.items():
+                channel_readings = readings[name]
+                channel_readings.append((elapsed, float(read())))
+                while channel_readings[0][0] < elapsed - self.window:
+                    channel_readings.popleft()
+                values = np.array([value for _, value in channel_readings])
+                stable[name] = elapsed >= self.window and np.ptp(values) <= band
+            if all(stable.values()):
+                settled = True
+                break
+            if elapsed >= self.max_wait or (stop_event is not None and stop_event.is_set()):
+                break
+            time.sleep(max(self.poll_interval - (time.perf_counter() - time_start - elapsed), 0))
+
+        channels = {}
+        for name, channel_readings in readings.items():
+            values = np.array([value for _, value in channel_readings])
+            channels[name] = {'last': float(values[-1]), 'span': float(np.ptp(values)), 'stable': bool(stable[name])}
+        return {'settled': settled, 'settle_time_s': elapsed, 'channels': channels}
@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+class Step:
+    """A unit of work of the loop with the device resources it occupies and the steps it has to wait for."""
+    def __init__(self, name, function, resources=(), depends_on=(), group=None):
+        """
+        :param name: The unique name of the step
+        :type name: str
+        :param function: Called without arguments to run the step
+        :type function: callable
+        :param resources: Names of the devices the step occupies while it runs
+        :type resources: iterable
+        :param depends_on: Names of the steps that have to be finished before this step starts
+        :type depends_on: iterable
+        :param group: Steps of a group that have not started yet are skipped when a step of the group fails
+        :type group: str
+        """
+        self.name = name
+        self.function = function
+        self.resources = frozenset(resources)
+        self.depends_on = tuple(depends_on)
+        self.group = group
+        self.start = None
+        self.end = None
+        self.error = None
+        self.skipped = False
+
+
+class StepScheduler:
+    """
+    Runs a graph of steps on threads. A step starts as soon as all steps it depends on are finished and
+    none of its resources is occupied, so waits on one device overlap with work on the others.
+    Steps are considered in the order they were added.
+    """
+    def __init__(self, error_callback=None):
+        """
+        :param error_callback: Called with the step and the exception when a step fails
+        :type error_callback: callable
+        """
+        self.error_callback = error_callback
+        self.steps = {}
+        self.condition = threading.Condition()
+        self.busy = set()
+        self.done = set()
+        self.running = 0
+        self.pending = []
+        self.time_start = None
+
+    def add(self, name, function, resources=(), depends_on=(), group=None):
+        """
+        Adds a step, see Step.
+
+        :return: The name of the step, to be used in depends_on of later steps
+        :rtype: str
+        """
+        if name in self.steps:
+            raise ValueError(f"Step {name} already exists.")
+        depends_on = [dependency for dependency in depends_on if dependency is not None]
+        for dependency in depends_on:
+            if dependency not in self.steps:
+                raise ValueError(f"Step {name} depends on the unknown step {dependency}.")
+        self.steps[name] = Step(name, function, resources, depends_on, group)
+        return name
+
+    def run(self, stop_event=None):
+        """
+        Runs all steps and returns when the last one has finished. When stop_event is set no further steps are started.
+
+        :param stop_event: Stops starting new steps when set
+        :type stop_event: threading.Event
+        :return: The timeline, see timeline()
+        :rtype: list
+        """
+        self.time_start = time.perf_counter()
+        self.pending = list(self.steps.values())
+        with self.condition:
+            while self.pending or self.running:
+                if stop_event is not None and stop_event.is_set():
+                    self.skip(self.pending)
+                for step in list(self.pending):
+                    if all(dependency in self.done for dependency in step.depends_on) and not (step.resources & self.busy):
+                        self.pending.remove(step)
+                        self.busy |= step.resources
+                        self.running += 1
+                        threading.Thread(target=self.execute, args=(step,), daemon=True).start()
+                self.condition.wait(0.5)
+        return self.timeline()
+
+    def execute(self, step):
+        """Runs one step on its own thread and releases its resources afterwards."""
+        step.start = time.perf_counter() - self.time_start
+        try:
+            step.function()
+        except Exception as e:
+            step.error = e
+        step.end = time.perf_counter() - self.time_start
+        with self.condition:
+            self.busy -= step.resources
+            self.done.add(step.name)
+            self.running -= 1
+            if step.error is not None and step.group is not None:
+                self.skip([pending for pending in self.pending if pending.group == step.group])
+            self.condition.notify_all()
+        if step.error is not None and self.error_callback is not None:
+            self.error_callback(step, step.error)
+
+    def skip(self, steps):
+        """Marks steps as skipped, they count as finished for the steps depending on them. Call with the condition held."""
+        for step in list(steps):
+            step.skipped = True
+            self.pending.remove(step)
+            self.done.add(step.name)
+
+    def timeline(self):
+        """
+        Returns the start and end in s after the start of the run, the resources and the state of every step that ran or was skipped.
+
+        :rtype: list
+        """
+        return [{'name': step.name, 'start_s': step.start, 'end_s': step.end, 'resources': sorted(step.resources), 'skipped': step.skipped, 'error': None if step.error is None else str(step.error)} for step in self.steps.values()]
+
+    def report(self):
+        """
+        Summarises the timeline: wall time, the time the steps would take one after another and the idle time recovered by overlapping them.
+
+        :rtype: str
+        """
+        ran = [step for step in self.steps.values() if step.start is not None]
+        if not ran:
+            return "No steps ran."
+        wall_time = max(step.end for step in ran) - min(step.start for step in ran)
+        sequential_time = sum(step.end - step.start for step in ran)
+        resources = sorted(set().union(*(step.resources for step in ran)))
+        usage = ', '.join(f"{resource} {100*sum(step.end - step.start for step in ran if resource in step.resources)/wall_time:.0f}%" for resource in resources) if wall_time > 0 else ''
+        return f"{len(ran)} steps in {wall_time:.0f}s, {sequential_time:.0f}s one after another, {sequential_time - wall_time:.0f}s recovered by overlapping. Busy: {usage}."
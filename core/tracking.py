@@ -0,0 +1,106 @@
+import time
+from collections import deque
+
+import numpy as np
+
+
+class TrackingController:
+    """
+    Tracks the Input, Output and Focus NanoTraks through a shrinking circle diameter schedule.
+
+    Each stage of the schedule has a diameter and a maximum duration. A stage ends early as soon as the
+    positions and signals of all three NanoTraks stop changing, so an aligned fiber latches after a few
+    readings while the worst case stays the fixed schedule.
+    """
+    SCHEDULE = ((1.0, 3.75), (0.75, 3.75), (0.25, 5.0))
+
+    def __init__(self, apt_tab, schedule=None, position_tolerance=0.02, signal_tolerance=0.005, window=5, poll_interval=0.05, min_stage_time=0.25):
+        """
+        :param apt_tab: The APT tab holding the InputNT, OutputNT and FocusNT NanoTraks.
+        :type apt_tab: APTTab
+        :param schedule: Pairs of circle diameter in NT units and maximum stage duration in s, defaults to SCHEDULE.
+        :type schedule: tuple
+        :param position_tolerance: Largest position change in NT units over the window that counts as converged.
+        :type position_tolerance: float
+        :param signal_tolerance: Largest relative signal change over the window that counts as converged.
+        :type signal_tolerance: float
+        :param window: Number of readings per NanoTrak the convergence is judged on.
+        :type window: int
+        :param poll_interval: Wait in seconds between two readings.
+        :type poll_interval: float
+        :param min_stage_time: Minimum duration of a stage in s, so the circle has taken on the new diameter.
+        :type min_stage_time: float
+        """
+        self.apt_tab = apt_tab
+        self.schedule = tuple(schedule or self.SCHEDULE)
+        self.position_tolerance = position_tolerance
+        self.signal_tolerance = signal_tolerance
+        self.window = window
+        self.poll_interval = poll_interval
+        self.min_stage_time = min_stage_time
+        self.history = []
+
+    def nanotraks(self):
+        """Returns the NanoTraks that are tracked together."""
+        return (self.apt_tab.InputNT, self.apt_tab.OutputNT, self.apt_tab.FocusNT)
+
+    def max_time(self):
+        """Returns the longest possible tracking time in s, the sum of the stage durations."""
+        return sum(duration for _, duration in self.schedule)
+
+    def converged(self, readings):
+        """
+        Checks if the last window readings of one NanoTrak have stopped changing.
+
+        :param readings: (horizontal position, vertical position, signal) readings
+        :type readings: deque
+        :rtype: bool
+        """
+        if len(readings) < self.window:
+            return False
+        readings = np.array(readings)
+        span = np.ptp(readings, axis=0)
+        signal_level = max(np.mean(np.abs(readings[:, 2])), 1e-12)
+        return span[0] <= self.position_tolerance and span[1] <= self.position_tolerance and span[2] / signal_level <= self.signal_tolerance
+
+    def run(self, stop_event=None):
+        """
+        Tracks through the schedule and latches all NanoTraks.
+
+        :param stop_event: Ends tracking early when set.
+        :type stop_event: threading.Event
+        :return: Total tracking time in s, whether every stage converged and the time and state of each stage.
+        :rtype: dict
+        """
+        nanotraks = self.nanotraks()
+        time_start = time.perf_counter()
+        stages = []
+        for stage, (diameter, duration) in enumerate(self.schedule):
+            self.apt_tab.change_circ_diameter_all(diameter)
+            if stage == 0:
+                self.apt_tab.track_all()
+            readings = [deque(maxlen=self.window) for _ in nanotraks]
+            stage_start = time.perf_counter()
+            converged = False
+            while True:
+                for nanotrak, nanotrak_readings in zip(nanotraks, readings):
+                    nanotrak_readings.append(nanotrak.circ_position())
+                elapsed = time.perf_counter() - stage_start
+                converged = elapsed >= self.min_stage_time and all(self.converged(nanotrak_readings) for nanotrak_readings in readings)
+                if converged or elapsed >= duration or (stop_event is not None and stop_event.is_set()):
+                    break
+                time.sleep(self.poll_interval)
+            stages.append({'diameter': diameter, 'time_s': elapsed, 'converged': converged})
+        self.apt_tab.latch_all()
+
+        result = {'time_s': time.perf_counter() - time_start, 'converged': all(stage['converged'] for stage in stages), 'stages': stages}
+        self.history.append(result)
+        return result
+
+    def summary(self):
+        """Returns the number of tracking runs, the mean and maximum time to converge and the number of capped runs as text."""
+        if not self.history:
+            return "No tracking runs."
+        times = np.array([result['time_s'] for result in self.history])
+        capped = sum(not result['converged'] for result in self.history)
+        return f"{len(times)} tracking runs, {np.mean(times):.1f}s mean, {np.max(times):.1f}s max (cap {self.max_time():.1f}s), {capped} ran into the cap."
@@ -0,0 +1,87 @@
+class WaveguidePlanner:
+    """
+    Absolute target table of all waveguides on the chips and the order they are visited in.
+
+    Offsets are measured from the input and output motor positions of the first waveguide. Every chip
+    holds outputs_per_chip outputs at the output waveguide pitch, the next chip starts chip_distance
+    behind the last output of the previous one. The inputs are spread over the outputs of a chip, with
+    as many inputs as outputs every output has its own input.
+    """
+    def __init__(self, number_of_chips, inputs_per_chip, outputs_per_chip, input_waveguide_distance, output_waveguide_distance, chip_distance, outputs_per_sweep=1, skip_waveguides=()):
+        """
+        :param number_of_chips: Number of chips on the bar.
+        :type number_of_chips: int
+        :param inputs_per_chip: Number of input waveguides per chip.
+        :type inputs_per_chip: int
+        :param outputs_per_chip: Number of output waveguides per chip.
+        :type outputs_per_chip: int
+        :param input_waveguide_distance: Pitch of the input waveguides in mm.
+        :type input_waveguide_distance: float
+        :param output_waveguide_distance: Pitch of the output waveguides in mm.
+        :type output_waveguide_distance: float
+        :param chip_distance: Distance in mm between the last waveguide of a chip and the first waveguide of the next one.
+        :type chip_distance: float
+        :param outputs_per_sweep: Number of neighbouring outputs measured in one sweep, only the first of each group is visited. Must divide outputs_per_chip.
+        :type outputs_per_sweep: int
+        :param skip_waveguides: Waveguides that are not visited.
+        :type skip_waveguides: iterable
+        """
+        self.number_of_chips = int(number_of_chips)
+        self.inputs_per_chip = max(int(inputs_per_chip), 1)
+        self.outputs_per_chip = int(outputs_per_chip)
+        self.input_waveguide_distance = input_waveguide_distance
+        self.output_waveguide_distance = output_waveguide_distance
+        self.chip_distance = chip_distance
+        self.outputs_per_sweep = max(int(outputs_per_sweep), 1)
+        # A group of outputs measured in one sweep must not reach into the next chip
+        if self.outputs_per_chip % self.outputs_per_sweep != 0:
+            raise ValueError(f"{self.outputs_per_chip} outputs per chip cannot be split into groups of {self.outputs_per_sweep} outputs per sweep.")
+        self.skip_waveguides = set(skip_waveguides)
+        self.targets = self.build_targets()
+
+    def build_targets(self):
+        """
+        Builds the target table.
+
+        :return: One dict per visited waveguide with the waveguide number, chip, input and output index and the input and output offsets in mm.
+        :rtype: list
+        """
+        input_chip_pitch = (self.inputs_per_chip - 1) * self.input_waveguide_distance + self.chip_distance
+        output_chip_pitch = (self.outputs_per_chip - 1) * self.output_waveguide_distance + self.chip_distance
+        targets = []
+        for chip in range(self.number_of_chips):
+            for output in range(0, self.outputs_per_chip, self.outputs_per_sweep):
+                waveguide = chip * self.outputs_per_chip + output
+                if waveguide in self.skip_waveguides:
+                    continue
+                input_index = output * self.inputs_per_chip // max(self.outputs_per_chip, 1)
+                targets.append({
+                    'waveguide': waveguide,
+                    'chip': chip,
+                    'input': input_index,
+                    'output': output,
+                    'input_offset': chip * input_chip_pitch + input_index * self.input_waveguide_distance,
+                    'output_offset': chip * output_chip_pitch + output * self.output_waveguide_distance
+                })
+        return targets
+
+    def order(self, pass_index):
+        """
+        Returns the targets in the order of a pass. Passes alternate direction, so every pass starts where the previous one ended.
+
+        :param pass_index: The index of the pass, one pass per current step
+        :type pass_index: int
+        :rtype: list
+        """
+        return self.targets if pass_index % 2 == 0 else self.targets[::-1]
+
+    def travel(self, passes):
+        """
+        Returns the output motor travel in mm of a number of passes, for comparison with returning to the start after every pass.
+
+        :rtype: tuple
+        """
+        if not self.targets:
+            return 0.0, 0.0
+        span = abs(self.targets[-1]['output_offset'] - self.targets[0]['output_offset'])
+        return passes * span, passes * span + max(passes - 1, 0) * span
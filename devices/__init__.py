@@ -3,5 +3,6 @@ from .keithley import Keithley2400
 from .optical_switch import KeysightN7734A
 from .temperatur_controller import ThorlabsITC4005
 from .exfo import EXFOCTP10
-from .apt import ThorlabsNanoTrak, ThorlabsMotor
+from .apt import ThorlabsNanoTrak, ThorlabsMotor, wait_for_motors
 from .owis import OwisHumes100
+from .scpi_state_cache import SCPIStateCache
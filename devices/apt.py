@@ -1,4 +1,7 @@
 import numpy as np
+import threading
+import time
+from collections import deque
 
 class ThorlabsNanoTrak:
     def __init__(self, AX, HWSerialNum: int, iGain: int, fFreq: float, fHorzHomePos: float, fVertHomePos:float, fDia:float, InputSignal: str):
@@ -10,6 +13,8 @@ class ThorlabsNanoTrak:
         self.fVertHomePos = np.float32(fVertHomePos)
         self.fDia = np.float32(fDia)
         self.InputSignal = InputSignal
+        # One entry per move_and_settle call: step distance in NT units, settle time in s and whether it settled
+        self.settle_log = []
 
     def initialize(self, lMode=2):
         """
@@ -87,6 +92,91 @@ class ThorlabsNanoTrak:
         self.AX.dynamicCall('SetCircHomePos({},{})'.format(horz_pos, vert_pos))
         self.AX.dynamicCall('MoveCircHome()')
 
+    def move_and_settle(self, horz_pos, vert_pos, position_tolerance=0.05, signal_variance=1e-4, window=3, max_wait=0.5, poll_interval=0.005):
+        """
+        Moves the Nanotrak and polls the position reading until it has settled.
+        The move has settled once the reported position is within position_tolerance of the target and the
+        variance of the last window signal readings is below signal_variance. The settle time is appended to settle_log.
+
+        :param horz_pos: The horizontal position to move to in NT units (0.0 to 10.0 NT units).
+        :type horz_pos: float
+        :param vert_pos: The vertical position to move to in NT units (0.0 to 10.0 NT units).
+        :type vert_pos: float
+        :param position_tolerance: Allowed deviation of the reported position in NT units.
+        :type position_tolerance: float
+        :param signal_variance: Allowed variance of the last window signal readings.
+        :type signal_variance: float
+        :param window: Number of signal readings the variance is taken over.
+        :type window: int
+        :param max_wait: Maximum wait in seconds, the last reading is returned if the move has not settled by then.
+        :type max_wait: float
+        :param poll_interval: Wait in seconds between two readings.
+        :type poll_interval: float
+        :return: A tuple containing the horizontal position, vertical position and signal strength of the last reading.
+        :rtype: tuple
+        """
+        if self.settle_log:
+            previous_horz, previous_vert = self.settle_log[-1]['target']
+            distance = float(np.hypot(horz_pos - previous_horz, vert_pos - previous_vert))
+        else:
+            distance = None
+        signals = deque(maxlen=window)
+        time_start = time.perf_counter()
+        self.move_nanotrak(horz_pos, vert_pos)
+        while True:
+            horz_read, vert_read, signal = self.circ_position()
+            signals.append(signal)
+            elapsed = time.perf_counter() - time_start
+            in_position = abs(horz_read - horz_pos) <= position_tolerance and abs(vert_read - vert_pos) <= position_tolerance
+            settled = in_position and len(signals) == window and np.var(signals) <= signal_variance
+            if settled or elapsed >= max_wait:
+                break
+            time.sleep(poll_interval)
+        self.settle_log.append({'target': (horz_pos, vert_pos), 'distance': distance, 'settle_time_s': elapsed, 'settled': bool(settled)})
+        return horz_read, vert_read, signal
+
+    def settle_summary(self):
+        """Returns the number of settled moves, the mean and maximum settle time and the number of timeouts as text."""
+        if not self.settle_log:
+            return "No settled moves."
+        settle_times = np.array([entry['settle_time_s'] for entry in self.settle_log])
+        timeouts = sum(not entry['settled'] for entry in self.settle_log)
+        return f"{len(settle_times)} settled moves, {1e3*np.mean(settle_times):.0f}ms mean, {1e3*np.max(settle_times):.0f}ms max, {timeouts} timeouts."
+
+    def scan_lines(self, lines, samples_per_line, low=0.0, high=10.0, settle_time=0.25, stop_event=None):
+        """
+        Sweeps the piezo along serpentine horizontal lines without waiting for it to settle between samples.
+        Every sample sends the next position and reads GetCircPosReading straight away, so the reported
+        position is stored with each reading rather than the commanded one.
+
+        :param lines: Number of horizontal lines between low and high.
+        :type lines: int
+        :param samples_per_line: Number of position updates per line.
+        :type samples_per_line: int
+        :param low: Lower bound of both axes in NT units.
+        :type low: float
+        :param high: Upper bound of both axes in NT units.
+        :type high: float
+        :param settle_time: Wait in seconds after the jump to the start of the first line.
+        :type settle_time: float
+        :param stop_event: Ends the scan early when set.
+        :type stop_event: threading.Event
+        :return: The samples with columns (time in s, horizontal position, vertical position, signal).
+        :rtype: np.ndarray
+        """
+        horz_line = np.linspace(low, high, samples_per_line)
+        samples = []
+        self.move_nanotrak(low, low)
+        time.sleep(settle_time)
+        for line, vert_pos in enumerate(np.linspace(low, high, lines)):
+            if stop_event is not None and stop_event.is_set():
+                break
+            for horz_pos in (horz_line if line % 2 == 0 else horz_line[::-1]):
+                self.move_nanotrak(horz_pos, vert_pos)
+                horz_read, vert_read, signal = self.circ_position()
+                samples.append((time.perf_counter(), horz_read, vert_read, signal))
+        return np.array(samples, dtype=float).reshape(-1, 4)
+
 class ThorlabsMotor:
     def __init__(self, AX, HWSerialNum: int, IChanID: int, fMinVel: float, fAccn: float, fMaxVel: float, fStepSize: float, fMinPos: float, fMaxPos: float, IUnits: int, fPitch: float, IDirSense: int, IRewLimSwitch: int, IFwdLimSwitch: int):
         self.AX = AX
@@ -103,6 +193,15 @@ class ThorlabsMotor:
         self.IDirSense = IDirSense
         self.IRewLimSwitch = IRewLimSwitch
         self.IFwdLimSwitch = IFwdLimSwitch
+        # Set by the MoveComplete event of the control for this channel
+        self.move_complete = threading.Event()
+        self.events_connected = False
+        self.move_start = None
+        self.move_expected = 0.0
+        self.move_distance = 0.0
+        # One entry per wait_for_move: distance, expected and measured move time in s, whether the event ended the wait
+        # and whether the stage stopped within the hard limit
+        self.move_log = []
 
     def initialize(self):
         """
@@ -118,6 +217,48 @@ class ThorlabsMotor:
         self.AX.dynamicCall('SetStageAxisInfo({},{},{},{},{},{})'.format(self.IChanID, self.fMinPos, self.fMaxPos, self.IUnits, self.fPitch, self.IDirSense))
         self.AX.dynamicCall('SetHWLimSwitches({},{},{})'.format(self.IChanID, self.IRewLimSwitch, self.IFwdLimSwitch))
         self.AX.dynamicCall('EnableHWChannel({})'.format(self.IChanID))
+        self.connect_move_complete()
+
+    def connect_move_complete(self):
+        """
+        Connects to the MoveComplete event of the APT control. Without the event wait_for_move falls back to status polling.
+        """
+        if self.events_connected:
+            return
+        try:
+            self.AX.MoveComplete.connect(self.on_move_complete)
+            self.events_connected = True
+        except (AttributeError, TypeError):
+            self.events_connected = False
+
+    def on_move_complete(self, lChanID):
+        """Handles the MoveComplete event, the control reports the channel that finished."""
+        if lChanID == self.IChanID:
+            self.move_complete.set()
+
+    def expected_move_time(self, distance):
+        """
+        Calculates the duration of a move from the trapezoidal velocity profile of the velocity parameters.
+
+        :param distance: The distance of the move in the current units.
+        :type distance: float
+        :return: The expected move time in s.
+        :rtype: float
+        """
+        distance = abs(distance)
+        acceleration = float(self.fAccn) if self.fAccn > 0 else 1.0
+        velocity = float(self.fMaxVel) if self.fMaxVel > 0 else 1.0
+        if distance < velocity**2 / acceleration:
+            # Triangular profile, the maximum velocity is never reached
+            return 2 * np.sqrt(distance / acceleration)
+        return distance / velocity + velocity / acceleration
+
+    def start_move(self, distance):
+        """Prepares the wait for a move of the given distance before it is issued."""
+        self.move_complete.clear()
+        self.move_distance = distance
+        self.move_expected = self.expected_move_time(distance)
+        self.move_start = time.perf_counter()
 
     def deinitialize(self):
         """Deinitializes the motor module by stopping the control loop."""
@@ -134,9 +275,70 @@ class ThorlabsMotor:
         :param distance: The distance to move the motor in the current units.
         :type distance: float
         """
+        self.start_move(distance)
         self.AX.dynamicCall('SetRelMoveDist({},{})'.format(self.IChanID, distance))
         self.AX.dynamicCall('MoveRelative({}, False)'.format(self.IChanID))
 
+    def move_absolute(self, position: float):
+        """
+        Moves the motor to the specified absolute position.
+        
+        :param position: The position to move the motor to in the current units.
+        :type position: float
+        """
+        self.start_move(position - self.motor_position())
+        self.AX.dynamicCall('SetAbsMovePos({},{})'.format(self.IChanID, position))
+        self.AX.dynamicCall('MoveAbsolute({}, False)'.format(self.IChanID))
+
+    def wait_for_move(self, timeout=None, max_wait=None, min_poll_interval=0.01):
+        """
+        Waits until the last move has finished. Waits on the MoveComplete event if it is connected, otherwise or if
+        the event does not arrive in time, sleeps for most of the expected move time and then polls the status bits
+        at an interval sized to the move until the stage has stopped.
+
+        :param timeout: Maximum wait for the MoveComplete event in s, defaults to twice the expected move time plus one second.
+        :type timeout: float
+        :param max_wait: Hard limit in s for the stage to stop, defaults to one minute plus five times the expected move time.
+        :type max_wait: float
+        :param min_poll_interval: Shortest interval between two status polls in s.
+        :type min_poll_interval: float
+        :return: The time from issuing the move until it was detected as finished in s.
+        :rtype: float
+        """
+        if self.move_start is None:
+            return 0.0
+        if timeout is None:
+            timeout = 2 * self.move_expected + 1.0
+        if max_wait is None:
+            max_wait = 60.0 + 5 * self.move_expected
+        event = self.events_connected and self.move_complete.wait(max(self.move_start + timeout - time.perf_counter(), 0))
+        stopped = True
+        if not event:
+            time.sleep(max(self.move_start + 0.8 * self.move_expected - time.perf_counter(), 0))
+            poll_interval = max(self.move_expected / 20, min_poll_interval)
+            hard_deadline = self.move_start + max(max_wait, timeout)
+            while self.is_moving():
+                if time.perf_counter() > hard_deadline:
+                    stopped = False
+                    break
+                time.sleep(poll_interval)
+        elapsed = time.perf_counter() - self.move_start
+        self.move_log.append({'distance': self.move_distance, 'expected_s': self.move_expected, 'time_s': elapsed, 'event': bool(event), 'stopped': stopped})
+        self.move_start = None
+        if not stopped:
+            raise RuntimeError(f"Motor channel {self.IChanID} is still moving {elapsed:.1f}s after the move was issued.")
+        return elapsed
+
+    def move_summary(self):
+        """Returns the number of moves, the mean measured and expected move time and the share ended by the event as text."""
+        if not self.move_log:
+            return "No moves."
+        times = np.array([entry['time_s'] for entry in self.move_log])
+        expected = np.array([entry['expected_s'] for entry in self.move_log])
+        events = sum(entry['event'] for entry in self.move_log)
+        timed_out = sum(not entry['stopped'] for entry in self.move_log)
+        return f"{len(times)} moves, {1e3*np.mean(times):.0f}ms mean ({1e3*np.mean(expected):.0f}ms expected), {100*events/len(times):.0f}% by MoveComplete event, {timed_out} did not stop."
+
     def check_motor_status(self):
         """Checks the status of the motor. Returns the status bits."""
         status_bits = [self.IChanID, 0] 
@@ -170,3 +372,29 @@ class ThorlabsMotor:
       
     def home(self):
         self.AX.dynamicCall('MoveHome()')
+
+
+def wait_for_motors(motors, timeout=None, max_wait=None):
+    """
+    Waits until the moves of several motors have finished. The moves run concurrently, so this returns as soon as the last axis is done.
+
+    :param motors: The motors whose last move is waited for.
+    :type motors: iterable
+    :param timeout: Maximum wait per motor for the MoveComplete event in s, see ThorlabsMotor.wait_for_move.
+    :type timeout: float
+    :param max_wait: Hard limit per motor in s, see ThorlabsMotor.wait_for_move.
+    :type max_wait: float
+    :return: The time until the last motor finished in s.
+    :rtype: float
+    """
+    time_start = time.perf_counter()
+    errors = []
+    for motor in motors:
+        # Every motor is waited for before a stage that did not stop is reported
+        try:
+            motor.wait_for_move(timeout, max_wait)
+        except RuntimeError as e:
+            errors.append(e)
+    if errors:
+        raise errors[0]
+    return time.perf_counter() - time_start
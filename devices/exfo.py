@@ -1,8 +1,11 @@
 import numpy as np
+import threading
 import time
 from datetime import datetime
 import pyvisa as visa
 
+from .scpi_state_cache import SCPIStateCache
+
 
 class EXFOCTP10:
     """ 
@@ -10,8 +13,19 @@ class EXFOCTP10:
     """
     EOL = '\r\n'
     Timeout = 5
+    # Binary trace formats: SCPI format argument and the matching little-endian numpy dtype
+    Binary_Formats = {
+        'REAL32': ('REAL,32', '<f4'),
+        'REAL64': ('REAL,64', '<f8'),
+    }
+    Chunk_Size = 65536  # Trace points per chunk for streamed retrieval
+    # Sweep completion strategies: '*OPC?' blocking, service request event, adaptive polling, fixed 20 ms polling
+    Completion_Modes = ('opc', 'srq', 'adaptive', 'poll')
+    Adaptive_Sleep_Fraction = 0.9  # Fraction of the predicted sweep time slept before polling
+    Adaptive_Poll_Interval = 0.005
+    Memory_Trace_Type = 21  # Trace type of the memory slot that holds a trace while the next sweep runs
 
-    def __init__(self, IP: str, Port: int, Module: int, Channel: int, Trace_Type: int, Start_WL=None, Stop_WL=None, Sampling=None, Laser_Speed=None, Laser_Power=None):
+    def __init__(self, IP: str, Port: int, Module: int, Channel: int, Trace_Type: int, Start_WL=None, Stop_WL=None, Sampling=None, Laser_Speed=None, Laser_Power=None, Trace_Format='REAL32', Completion_Mode='adaptive'):
         self.IP = IP
         self.Port = Port
         self.Module = Module
@@ -22,6 +36,15 @@ class EXFOCTP10:
         self.Sampling = Sampling
         self.Laser_Speed = Laser_Speed
         self.Laser_Power = Laser_Power
+        self.Trace_Format = Trace_Format
+        if Completion_Mode not in self.Completion_Modes:
+            raise ValueError(f'Unknown completion mode {Completion_Mode}, expected one of {self.Completion_Modes}')
+        self.Completion_Mode = Completion_Mode
+        self.condition_queries = 0
+        self.sweep_log = []  # One entry per sweep with strategy, duration, prediction and overhead
+        self.state_cache = SCPIStateCache()
+        self.wavelength_cache = {}  # (Module, Channel, Trace_Type, Start_WL, Stop_WL, Sampling) -> read-only wavelength axis
+        self.io_lock = threading.RLock()  # Serialises the socket between the sweep and a trace download thread
         self.resource = f"TCPIP0::{self.IP}::{self.Port}::SOCKET"
         self.connect()
 
@@ -39,12 +62,20 @@ class EXFOCTP10:
 
     def query(self, command: str):
         """Sends a command and returns the response."""
-        response = self.inst.query(command)
+        with self.io_lock:
+            response = self.inst.query(command)
         return response
 
     def send(self, command: str):
         """Sends the command to the device."""
-        self.inst.write(command)
+        with self.io_lock:
+            self.inst.write(command)
+        if command.strip().upper() == '*RST':
+            self.state_cache.invalidate()
+
+    def send_setting(self, header: str, value):
+        """Sends a setting through the state cache, skipping it if the value is already set."""
+        return self.state_cache.write(self.send, header, value)
         
     def read_until_crlf(self):
         """Reads a non-binary response from the device."""
@@ -55,6 +86,7 @@ class EXFOCTP10:
     def query_condition_register(self):
         """Queries the operation status of the CTP10."""
         response = int(self.query(':STAT:OPER:COND?'))
+        self.condition_queries += 1
         return response
 
     def clear_error_queue(self):
@@ -73,11 +105,11 @@ class EXFOCTP10:
         """Deletes the trace queue."""
         self.send('CLE')
 
-    def wait_for_condition(self, condition_number=0, timeout=30.0):
+    def wait_for_condition(self, condition_number=0, timeout=30.0, poll_interval=0.02):
         """Waits until a certain condition is met or a timeout occurs."""
         time_start = time.time()
         while True:
-            time.sleep(0.02)
+            time.sleep(poll_interval)
             condition = self.query_condition_register()
             if condition == condition_number:
                 return 0, 'NO ERROR'
@@ -85,49 +117,341 @@ class EXFOCTP10:
                 return -1, 'TIMEOUT ERROR WAITING FOR CONDITION'
 
     def set_scan_parameters(self, start_wav: float, stop_wav: float, sampling: int, speed: int, laser_power: float):
-        """Sets the scan parameters of the CTP10."""
-        self.send(f':INIT:WAV:STAR {start_wav:.3f}NM')
-        self.send(f':INIT:WAV:STOP {stop_wav:.3f}NM')
-        self.send(f':INIT:WAV:SAMP {sampling}PM')
-        self.send(f':INIT:TLS1:SPE {speed}')
-        self.send(f':INIT:TLS1:POW {laser_power:.2f}DBM')
-        self.send(':INIT:STAB ON')
-        self.send(':INIT:SMOD SING')
+        """Sets the scan parameters of the CTP10. Clears the wavelength axis cache if the axis changes."""
+        if (start_wav, stop_wav, sampling) != (self.Start_WL, self.Stop_WL, self.Sampling):
+            self.wavelength_cache.clear()
+        self.Start_WL = start_wav
+        self.Stop_WL = stop_wav
+        self.Sampling = sampling
+        self.Laser_Speed = speed
+        self.Laser_Power = laser_power
+        self.send_setting(':INIT:WAV:STAR', f'{start_wav:.3f}NM')
+        self.send_setting(':INIT:WAV:STOP', f'{stop_wav:.3f}NM')
+        self.send_setting(':INIT:WAV:SAMP', f'{sampling}PM')
+        self.send_setting(':INIT:TLS1:SPE', speed)
+        self.send_setting(':INIT:TLS1:POW', f'{laser_power:.2f}DBM')
+        self.send_setting(':INIT:STAB', 'ON')
+        self.send_setting(':INIT:SMOD', 'SING')
+
+    def predicted_sweep_time(self):
+        """
+        Predicts the sweep duration from the scan range and the laser speed.
+
+        :return: The predicted sweep time in seconds, 0 if the scan parameters are unknown.
+        :rtype: float
+        """
+        if self.Start_WL is None or self.Stop_WL is None or not self.Laser_Speed:
+            return 0.0
+        return abs(float(self.Stop_WL) - float(self.Start_WL)) / float(self.Laser_Speed)
+
+    def wait_for_opc(self, timeout=60.0):
+        """
+        Blocks on *OPC? until the sweep is complete or the timeout occurs.
+
+        The socket stays locked for the whole sweep, a trace download running meanwhile waits for the end of the sweep.
+        """
+        with self.io_lock:
+            self.inst.timeout = timeout * 1000
+            try:
+                self.query('*OPC?')
+                return 0, 'NO ERROR'
+            except visa.errors.VisaIOError:
+                return -1, 'TIMEOUT ERROR WAITING FOR OPC'
+            finally:
+                self.inst.timeout = self.Timeout * 1000
+
+    def enable_service_request(self):
+        """
+        Enables a service request on operation complete.
+
+        :return: False if the transport does not support service request events.
+        :rtype: bool
+        """
+        try:
+            self.inst.enable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+        except (visa.errors.VisaIOError, NotImplementedError):
+            return False
+        self.send('*ESE 1')
+        self.send('*SRE 32')
+        return True
+
+    def wait_for_service_request(self, timeout=60.0):
+        """Waits for the operation complete service request of the sweep."""
+        self.send('*OPC')
+        try:
+            self.inst.wait_on_event(visa.constants.EventType.service_request, int(timeout * 1000))
+            self.query('*ESR?')  # Clears the event status register
+            return 0, 'NO ERROR'
+        except visa.errors.VisaIOError:
+            return -1, 'TIMEOUT ERROR WAITING FOR SERVICE REQUEST'
+        finally:
+            self.inst.disable_event(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+            self.inst.discard_events(visa.constants.EventType.service_request, visa.constants.EventMechanism.queue)
+
+    def wait_adaptive(self, timeout=60.0):
+        """Sleeps for most of the predicted sweep time and then polls the condition register quickly."""
+        time_start = time.time()
+        time.sleep(min(max(self.predicted_sweep_time() * self.Adaptive_Sleep_Fraction, 0.02), timeout))
+        remaining = max(timeout - (time.time() - time_start), 0.0)
+        return self.wait_for_condition(condition_number=0, timeout=remaining, poll_interval=self.Adaptive_Poll_Interval)
 
     def perform_scan(self, timeout=60.0):
-        """Starts a sweep scan and waits until it is complete."""
+        """Starts a sweep scan and waits with the configured completion strategy until it is complete."""
         self.clear_error_queue()
+        mode = self.Completion_Mode
+        if mode == 'srq' and not self.enable_service_request():
+            mode = 'adaptive'
+        queries_start = self.condition_queries
+        time_start = time.time()
         self.send(':INIT')
-        error_code, error_name = self.wait_for_condition(condition_number=0, timeout=timeout)
+        if mode == 'opc':
+            error_code, error_name = self.wait_for_opc(timeout)
+        elif mode == 'srq':
+            error_code, error_name = self.wait_for_service_request(timeout)
+        elif mode == 'adaptive':
+            error_code, error_name = self.wait_adaptive(timeout)
+        else:
+            error_code, error_name = self.wait_for_condition(condition_number=0, timeout=timeout)
+        sweep_time = time.time() - time_start
+        predicted = self.predicted_sweep_time()
+        self.sweep_log.append({
+            'mode': mode,
+            'sweep_time_s': sweep_time,
+            'predicted_s': predicted,
+            'overhead_s': sweep_time - predicted,
+            'condition_queries': self.condition_queries - queries_start
+        })
         if error_code == 0:
             error_code, error_name = self.query_error_queue()
+        # The sweep moves the laser and changes the sense state, so these are sent after every sweep and not cached
         self.send('INIT:FBC:SENS 1')
         self.send('CTP:RLAS1:WAV 1550NM')
         return error_code, error_name
 
-    def create_wavelength_array(self):
-        """Creates the wavelength array based on the passed parameters."""
-        Query_start_wav = f':TRAC:SENS{self.Module}:CHAN{self.Channel}:TYPE{self.Trace_Type}:DATA:STAR?'
+    def create_wavelength_array(self, trace_type=None):
+        """
+        Returns the wavelength axis of the current trace.
+
+        The axis is queried once per (module, channel, trace type, start, stop, sampling) and then
+        served from the cache as a shared read-only array.
+
+        :param trace_type: The trace type the axis belongs to, defaults to Trace_Type. A memory slot keeps its axis during the next sweep.
+        :type trace_type: int
+        :return: The wavelength array in nm.
+        :rtype: np.ndarray
+        """
+        trace_type = self.Trace_Type if trace_type is None else trace_type
+        key = (self.Module, self.Channel, trace_type, self.Start_WL, self.Stop_WL, self.Sampling)
+        if key not in self.wavelength_cache:
+            Wavelength_array = self.query_wavelength_array(trace_type)
+            Wavelength_array.flags.writeable = False
+            self.wavelength_cache[key] = Wavelength_array
+        return self.wavelength_cache[key]
+
+    def query_wavelength_array(self, trace_type=None):
+        """Creates the wavelength array from the start, sampling and length reported by the CTP10, optionally for another trace type."""
+        Query_start_wav = f'{self.trace_header(trace_type)}:DATA:STAR?'
         L_start = self.query(Query_start_wav)
         L_start = float(L_start) * 1E9  # in nm
 
-        Query_sampling = f':TRAC:SENS{self.Module}:CHAN{self.Channel}:TYPE{self.Trace_Type}:DATA:SAMP?'
+        Query_sampling = f'{self.trace_header(trace_type)}:DATA:SAMP?'
         Sampling = self.query(Query_sampling)
         Sampling = float(Sampling) * 1E12  # in pm
 
-        Query_length = f':TRAC:SENS{self.Module}:CHAN{self.Channel}:TYPE{self.Trace_Type}:DATA:LENG?'
-        Length = self.query(Query_length)
-        Length = int(Length)
+        Length = self.query_trace_length(trace_type)
 
         L_stop = L_start + Sampling * (Length - 1) / 1000  # Stop wavelength in nm
         Wavelength_array = np.linspace(L_start, L_stop, Length)
         return Wavelength_array
 
+    def trace_header(self, trace_type=None, module=None, channel=None):
+        """Returns the SCPI trace header of the configured detector, optionally for another trace type, module or channel."""
+        trace_type = self.Trace_Type if trace_type is None else trace_type
+        module = self.Module if module is None else module
+        channel = self.Channel if channel is None else channel
+        return f':TRAC:SENS{module}:CHAN{channel}:TYPE{trace_type}'
+
+    def query_trace_length(self, trace_type=None, module=None, channel=None):
+        """Queries the number of points of the current trace."""
+        Query_length = f'{self.trace_header(trace_type, module, channel)}:DATA:LENG?'
+        return int(self.query(Query_length))
+
+    def copy_trace_to_memory(self, memory_trace_type=None, module=None, channel=None):
+        """
+        Copies the live trace into a memory trace slot so it can be downloaded while the next sweep runs.
+
+        :param memory_trace_type: The trace type of the memory slot, defaults to Memory_Trace_Type.
+        :type memory_trace_type: int
+        :param module: The detector module, defaults to Module.
+        :type module: int
+        :param channel: The detector channel, defaults to Channel.
+        :type channel: int
+        :return: The trace type of the memory slot.
+        :rtype: int
+        """
+        memory_trace_type = memory_trace_type or self.Memory_Trace_Type
+        self.send(f'{self.trace_header(module=module, channel=channel)}:COPY TYPE{memory_trace_type}')
+        return memory_trace_type
+
+    def retrieve_channels(self, channels, trace_type=None, progress_callback=None):
+        """
+        Retrieves the traces of several detector channels recorded during the same sweep.
+
+        :param channels: The detectors to read as (module, channel) tuples.
+        :type channels: list
+        :param trace_type: The trace type to read, defaults to Trace_Type.
+        :type trace_type: int
+        :param progress_callback: Called as progress_callback(channels_done, channels_total) after each channel.
+        :type progress_callback: callable
+        :return: The trace data in dB with shape (channels, wavelength).
+        :rtype: np.ndarray
+        """
+        module, channel = channels[0]
+        length = self.query_trace_length(trace_type, module, channel)
+        traces = np.empty((len(channels), length), dtype=np.float64)
+        for index, (module, channel) in enumerate(channels):
+            self.stream_trace(trace_type=trace_type, module=module, channel=channel, out=traces[index])
+            if progress_callback is not None:
+                progress_callback(index + 1, len(channels))
+        return traces
+
+    def stream_trace(self, chunk_size=None, progress_callback=None, chunk_timeout=None, trace_type=None, module=None, channel=None, out=None):
+        """
+        Retrieves the trace in index ranges and writes each chunk into a preallocated array.
+
+        Peak memory stays near one trace, and the VISA timeout applies to each chunk instead of the whole trace.
+
+        :param chunk_size: Number of trace points per request, defaults to Chunk_Size.
+        :type chunk_size: int
+        :param progress_callback: Called as progress_callback(points_done, points_total) after each chunk.
+        :type progress_callback: callable
+        :param chunk_timeout: Timeout per chunk in seconds, defaults to Timeout.
+        :type chunk_timeout: float
+        :param trace_type: The trace type to read, e.g. a memory slot, defaults to Trace_Type.
+        :type trace_type: int
+        :param module: The detector module, defaults to Module.
+        :type module: int
+        :param channel: The detector channel, defaults to Channel.
+        :type channel: int
+        :param out: Optional preallocated array of the trace length the trace is written into.
+        :type out: np.ndarray
+        :return: The trace data in dB.
+        :rtype: np.ndarray
+        """
+        chunk_size = chunk_size or self.Chunk_Size
+        length = self.query_trace_length(trace_type, module, channel)
+        if out is None:
+            trace = np.empty(length, dtype=np.float64)
+        elif out.size != length:
+            raise ValueError(f'Trace has {length} points, output array has {out.size}')
+        else:
+            trace = out
+        binary = self.Trace_Format in self.Binary_Formats
+        if binary:
+            scpi_format, dtype = self.Binary_Formats[self.Trace_Format]
+            self.send(f':FORM:DATA {scpi_format}')
+
+        # The socket is locked per chunk only, so the commands of a sweep running meanwhile get in between chunks
+        try:
+            start = 0
+            while start < length:
+                count = min(chunk_size, length - start)
+                Query_data = f'{self.trace_header(trace_type, module, channel)}:DATA? {start},{count},DB'
+                with self.io_lock:
+                    self.inst.timeout = (chunk_timeout or self.Timeout) * 1000
+                    try:
+                        self.send(Query_data)
+                        if binary:
+                            try:
+                                self.retrieve_binary_response(dtype, out=trace[start:start + count])
+                            except (visa.errors.VisaIOError, ValueError):
+                                # Resynchronise and repeat this chunk in ASCII
+                                self.inst.clear()
+                                self.send(':FORM:DATA ASC')
+                                binary = False
+                                continue
+                        else:
+                            trace[start:start + count] = self.retrieve_ASCii_response()
+                    finally:
+                        self.inst.timeout = self.Timeout * 1000
+                start += count
+                if progress_callback is not None:
+                    progress_callback(start, length)
+        finally:
+            if binary:
+                self.send(':FORM:DATA ASC')
+        return trace
+
+    def retrieve_trace(self):
+        """
+        Retrieves the trace array in the configured format.
+
+        Uses the binary block transfer for 'REAL32'/'REAL64' and falls back to the ASCII
+        transfer if the binary transfer fails or 'ASCii' is configured.
+
+        :return: The trace data in dB.
+        :rtype: np.ndarray
+        """
+        if self.Trace_Format in self.Binary_Formats:
+            try:
+                return self.retrieve_binary_trace(self.Trace_Format)
+            except (visa.errors.VisaIOError, ValueError):
+                # Resynchronise the socket before retrying in ASCII
+                self.inst.clear()
+                self.send(':FORM:DATA ASC')
+        return np.asarray(self.retrieve_ASCii_trace(), dtype=np.float64)
+
+    def retrieve_binary_trace(self, trace_format='REAL32'):
+        """
+        Retrieves the trace array as an IEEE-488.2 definite-length binary block.
+
+        :param trace_format: 'REAL32' or 'REAL64'
+        :type trace_format: str
+        :return: The trace data in dB.
+        :rtype: np.ndarray
+        """
+        scpi_format, dtype = self.Binary_Formats[trace_format]
+        with self.io_lock:
+            self.send(f':FORM:DATA {scpi_format}')
+            Query_data = f'{self.trace_header()}:DATA? 0,DB'
+            self.send(Query_data)
+            Trace_array = self.retrieve_binary_response(dtype)
+            self.send(':FORM:DATA ASC')
+        return Trace_array
+
+    def retrieve_binary_response(self, dtype='<f4', out=None):
+        """
+        Reads an IEEE-488.2 definite-length block (#<n><length><data>) and decodes it without an intermediate list.
+
+        :param dtype: The numpy dtype of the block elements.
+        :type dtype: str
+        :param out: Optional array the decoded block is written into.
+        :type out: np.ndarray
+        :return: The decoded block.
+        :rtype: np.ndarray
+        """
+        header = self.inst.read_bytes(2)
+        if header[:1] != b'#' or not header[1:2].isdigit() or header[1:2] == b'0':
+            raise ValueError(f'Invalid binary block header: {header!r}')
+        length = int(self.inst.read_bytes(int(header[1:2])))
+        payload = self.inst.read_bytes(length)
+        # Trailing terminator, read up to '\n' so a bare '\n' works as well as '\r\n'
+        while self.inst.read_bytes(1) != b'\n':
+            pass
+        block = np.frombuffer(payload, dtype=dtype)
+        if out is None:
+            return block.astype(np.float64)
+        if block.size != out.size:
+            raise ValueError(f'Binary block has {block.size} points, expected {out.size}')
+        out[:] = block
+        return out
+
     def retrieve_ASCii_trace(self):
         """Retrieves the trace array in ASCII format."""
-        Query_data = f':TRAC:SENS{self.Module}:CHAN{self.Channel}:TYPE{self.Trace_Type}:DATA? 0,DB'
-        self.send(Query_data)
-        Trace_array = self.retrieve_ASCii_response()
+        Query_data = f'{self.trace_header()}:DATA? 0,DB'
+        with self.io_lock:
+            self.send(Query_data)
+            Trace_array = self.retrieve_ASCii_response()
         return Trace_array
 
     def retrieve_ASCii_response(self):
@@ -185,7 +509,7 @@ if __name__ == "__main__":
             
             # Erstelle das Wellenlängenarray und rufe die IL-Daten ab
             wavelength_array = device.create_wavelength_array()
-            il_data = device.retrieve_ASCii_trace()
+            il_data = device.retrieve_trace()
             print(il_data)
             
             print("Trace data retrieved successfully.")
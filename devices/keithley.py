@@ -1,12 +1,17 @@
 import pyvisa
 import time
 
+from .scpi_state_cache import SCPIStateCache
+
 rm = pyvisa.ResourceManager()
 
 class Keithley2400:
     """
     This class represents the Keithley 2400 Sourcemeter.
     """
+    # Data elements of :READ? after *RST
+    DEFAULT_ELEMENTS = "VOLT,CURR,RES,TIME,STAT"
+
     def __init__(self, gpib_add, compliance_voltage=4):
         """
         Initialize Keithley with given GPIB address.
@@ -16,10 +21,11 @@ class Keithley2400:
         """
         self._gpib = str(gpib_add)
         self.unit = rm.open_resource(f"GPIB1::{self._gpib}::INSTR")
-        self.unit.write("*RST")
-        self.unit.write("*CLS")
-        self.unit.write(":SOUR:FUNC CURR")
-        self.unit.write(f":SENS:VOLT:PROT {compliance_voltage}")
+        self.state_cache = SCPIStateCache()
+        self.write("*RST")
+        self.write("*CLS")
+        self.write_setting(":SOUR:FUNC", "CURR")
+        self.write_setting(":SENS:VOLT:PROT", compliance_voltage)
 
     def write(self, command):
         """
@@ -29,6 +35,19 @@ class Keithley2400:
         :type command: str
         """
         self.unit.write(command)
+        if command.strip().upper() == "*RST":
+            self.state_cache.invalidate()
+
+    def write_setting(self, header, value):
+        """
+        Send a setting through the state cache, skipping it if the value is already set.
+
+        :param header: The SCPI header of the setting.
+        :type header: str
+        :param value: The value of the setting.
+        :type value: str
+        """
+        return self.state_cache.write(self.write, header, value)
 
     def query(self, command):
         """
@@ -46,8 +65,8 @@ class Keithley2400:
         :return: The measured voltage.
         :rtype: float
         """
-        self.write(":SENS:FUNC 'VOLT:DC'")
-        self.write(":FORM:ELEM VOLT")
+        self.write_setting(":SENS:FUNC", "'VOLT:DC'")
+        self.write_setting(":FORM:ELEM", "VOLT")
         return self.query(":READ?")
 
     def measure_current(self):
@@ -57,8 +76,8 @@ class Keithley2400:
         :return: The measured current.
         :rtype: float
         """
-        self.write(":SENS:FUNC 'CURR:DC'")
-        self.write(":FORM:ELEM CURR")
+        self.write_setting(":SENS:FUNC", "'CURR:DC'")
+        self.write_setting(":FORM:ELEM", "CURR")
         return self.query(":READ?")
     
     def measure_power(self):
@@ -68,7 +87,11 @@ class Keithley2400:
         :return: The measured power.
         :rtype: float
         """
+        # measure_voltage and measure_current narrow the elements, the power reading uses the elements after *RST
+        self.write_setting(":FORM:ELEM", self.DEFAULT_ELEMENTS)
         self.write(":SYSTem:KEY 5")
+        # The front panel key changes the measurement configuration
+        self.state_cache.invalidate(":SENS:FUNC", ":FORM:ELEM")
         return self.query(":READ?")
 
     def set_voltage(self, voltage):
@@ -78,9 +101,9 @@ class Keithley2400:
         :param voltage: The voltage to set.
         :type voltage: float
         """
-        self.write(f":SOUR:FUNC VOLT")
-        self.write(f":SOUR:VOLT {voltage}")
-        self.write(":OUTP ON")
+        self.write_setting(":SOUR:FUNC", "VOLT")
+        self.write_setting(":SOUR:VOLT", voltage)
+        self.write_setting(":OUTP", "ON")
 
     def set_current(self, current):
         """
@@ -89,13 +112,13 @@ class Keithley2400:
         :param current: The current to set.
         :type current: float
         """
-        self.write(f":SOUR:FUNC CURR")
-        self.write(f":SOUR:CURR {current}")
-        self.write(":OUTP ON")
+        self.write_setting(":SOUR:FUNC", "CURR")
+        self.write_setting(":SOUR:CURR", current)
+        self.write_setting(":OUTP", "ON")
 
     def turn_off(self):
         """Turn off the output."""
-        self.write(":OUTP OFF")
+        self.write_setting(":OUTP", "OFF")
         self.write("*RST")
 
     def close(self):
@@ -103,17 +126,16 @@ class Keithley2400:
         self.unit.close()
 
 
-print('available resources:', rm.list_resources())
-keithley = Keithley2400(26, compliance_voltage=15)
-
-liste = [0.0, 15.434872662825796, 21.82820625326997, 26.733983660370207, 30.869745325651593, 34.51342449813167, 37.807562268756264, 40.836834583786356, 43.65641250653994, 46.30461798847739, 48.809353009197636, 51.19168130950689, 53.467967320740414, 55.65122481607581, 57.75200531277731, 59.77900477395643, 61.739490651303186, 63.63961030678928, 65.4846187598099, 67.27905014367619, 69.02684899626334, 70.73147231940382, 72.39596998858593, 74.0230488746977, 75.61512453751253, 77.17436331412898, 78.70271689756855, 80.20195098111061, 81.67366916757271, 83.1193330664519, 84.54027929649519, 85.93773395690079, 87.31282501307987, 88.66659295294002, 90.0]
-
-keithley.set_current(80.20195098111061*1e-3)
-keithley.measure_power()
+if __name__ == '__main__':
+    print('available resources:', rm.list_resources())
+    keithley = Keithley2400(26, compliance_voltage=15)
 
-# for i in liste:
-#     keithley.set_current(i*1e-3)
-#     keithley.measure_power()
-#     time.sleep(3)
+    liste = [0.0, 15.434872662825796, 21.82820625326997, 26.733983660370207, 30.869745325651593, 34.51342449813167, 37.807562268756264, 40.836834583786356, 43.65641250653994, 46.30461798847739, 48.809353009197636, 51.19168130950689, 53.467967320740414, 55.65122481607581, 57.75200531277731, 59.77900477395643, 61.739490651303186, 63.63961030678928, 65.4846187598099, 67.27905014367619, 69.02684899626334, 70.73147231940382, 72.39596998858593, 74.0230488746977, 75.61512453751253, 77.17436331412898, 78.70271689756855, 80.20195098111061, 81.67366916757271, 83.1193330664519, 84.54027929649519, 85.93773395690079, 87.31282501307987, 88.66659295294002, 90.0]
 
+    keithley.set_current(80.20195098111061*1e-3)
+    keithley.measure_power()
 
+    # for i in liste:
+    #     keithley.set_current(i*1e-3)
+    #     keithley.measure_power()
+    #     time.sleep(3)
@@ -1,24 +1,26 @@
 import pyvisa
 import warnings
 
+from .scpi_state_cache import SCPIStateCache
+
 warnings.filterwarnings("ignore", message="mkl-service package failed to import")
 
 class KeysightN7734A:
     def __init__(self, address):
         self.rm = pyvisa.ResourceManager()
         self.instrument = self.rm.open_resource(f'TCPIP0::{address}::inst0::INSTR')
+        self.state_cache = SCPIStateCache()
 
     def set_routing(self, route, slot=1):
         """
-        Sets the routing for a specific channel.
+        Sets the routing for a specific channel. Routes that are already active are not sent again.
 
         :param: route: The routing to be set.
         :type route: str
         :param slot: The slot of the switch module.
         :type slot: int
         """
-        command = f':ROUTe{slot} {route}'
-        self.instrument.write(command)
+        self.state_cache.write(self.instrument.write, f':ROUTe{slot}', route)
         
     def get_config(self, slot=1):
         """
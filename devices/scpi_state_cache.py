@@ -0,0 +1,61 @@
+class SCPIStateCache:
+    """
+    Write-through cache of the last value written per SCPI setting.
+
+    Writes that would not change the instrument state are dropped and counted, so repeated
+    configuration calls (scan parameters, routes, source settings) only reach the instrument
+    when something actually changes.
+    """
+    def __init__(self):
+        self.state = {}
+        self.writes_sent = 0
+        self.writes_saved = 0
+
+    def write(self, write_function, header: str, value):
+        """
+        Writes '<header> <value>' unless the setting already holds the value.
+
+        :param write_function: The function that sends a command to the instrument.
+        :type write_function: callable
+        :param header: The SCPI header of the setting, e.g. ':SOUR:FUNC'.
+        :type header: str
+        :param value: The value of the setting, e.g. 'CURR'.
+        :type value: str
+        :return: True if the command was sent, False if it was skipped.
+        :rtype: bool
+        """
+        value = str(value)
+        if self.state.get(header) == value:
+            self.writes_saved += 1
+            return False
+        write_function(f'{header} {value}')
+        self.state[header] = value
+        self.writes_sent += 1
+        return True
+
+    def invalidate(self, *headers):
+        """
+        Forgets the cached state, e.g. after *RST or a front panel change.
+
+        :param headers: The settings to forget. Forgets all settings if none are given.
+        :type headers: str
+        """
+        if headers:
+            for header in headers:
+                self.state.pop(header, None)
+        else:
+            self.state.clear()
+
+    def reset_counters(self):
+        """Resets the sent and saved write counters."""
+        self.writes_sent = 0
+        self.writes_saved = 0
+
+    def counters(self):
+        """
+        Returns the write counters.
+
+        :return: Number of sent and saved writes.
+        :rtype: tuple
+        """
+        return self.writes_sent, self.writes_saved
@@ -1,5 +1,7 @@
+import numpy as np
 import pyvisa as visa
 import time
+from collections import deque
 
 rm = visa.ResourceManager()
 
@@ -61,6 +63,92 @@ class ThorlabsITC4005:
         :type temp: float
         """
         self.write(f"SOUR2:TEMP {temp}")
+
+    def wait_for_settle(self, setpoint, tolerance=0.01, sample_interval=0.5, window=5.0, hold_time=5.0, max_wait=1800.0, stop_event=None, callback=None):
+        """
+        Samples the temperature until it has settled at the setpoint.
+        A straight line is fitted to the readings of the last window seconds. The setpoint counts as reached
+        when the fitted temperature plus the drift predicted over the hold time is within tolerance of the
+        setpoint and the noise band around the line is narrower than the tolerance. The temperature has
+        settled once this holds for hold_time seconds without interruption.
+
+        :param setpoint: The temperature setpoint in degrees C
+        :type setpoint: float
+        :param tolerance: Allowed deviation from the setpoint in degrees C
+        :type tolerance: float
+        :param sample_interval: Time between two readings in s
+        :type sample_interval: float
+        :param window: Length of the rolling window of the line fit in s
+        :type window: float
+        :param hold_time: Time in s the setpoint has to be held
+        :type hold_time: float
+        :param max_wait: Maximum wait in s
+        :type max_wait: float
+        :param stop_event: Ends the wait early when set
+        :type stop_event: threading.Event
+        :param callback: Called with the elapsed time in s and the temperature after every reading
+        :type callback: callable
+        :return: Whether it settled, the settle time in s, the mean, noise and slope of the last window and the time constant of the approach
+        :rtype: dict
+        """
+        readings = deque()
+        history = []
+        time_start = time.perf_counter()
+        stable_since = None
+        settled = False
+        while True:
+            elapsed = time.perf_counter() - time_start
+            temperature = float(self.measure_temp())
+            readings.append((elapsed, temperature))
+            history.append((elapsed, temperature))
+            while readings[0][0] < elapsed - window:
+                readings.popleft()
+            if callback is not None:
+                callback(elapsed, temperature)
+
+            times, temperatures = np.array(readings).T
+            if len(readings) >= 3:
+                slope, intercept = np.polyfit(times - elapsed, temperatures, 1)
+                noise = 2 * np.std(temperatures - (intercept + slope * (times - elapsed)))
+            else:
+                slope, intercept, noise = 0.0, temperature, np.inf
+            predicted_residual = abs(intercept - setpoint) + abs(slope) * hold_time
+            if predicted_residual <= tolerance and noise <= tolerance:
+                stable_since = elapsed if stable_since is None else stable_since
+                if elapsed - stable_since >= hold_time:
+                    settled = True
+                    break
+            else:
+                stable_since = None
+            if elapsed >= max_wait or (stop_event is not None and stop_event.is_set()):
+                break
+            time.sleep(max(sample_interval - (time.perf_counter() - time_start - elapsed), 0))
+
+        return {
+            'settled': settled,
+            'settle_time_s': elapsed,
+            'mean_c': float(np.mean(temperatures)),
+            'noise_c': float(noise),
+            'slope_c_per_s': float(slope),
+            'time_constant_s': self.time_constant(history, setpoint, tolerance)
+        }
+
+    def time_constant(self, history, setpoint, tolerance):
+        """
+        Estimates the time constant of an exponential approach from the readings that are clearly off the setpoint.
+
+        :param history: (elapsed time in s, temperature) readings
+        :type history: list
+        :return: The time constant in s, None if the approach is too short to fit
+        :rtype: float
+        """
+        times, temperatures = np.array(history).T
+        error = np.abs(temperatures - setpoint)
+        mask = error > 2 * tolerance
+        if np.count_nonzero(mask) < 3:
+            return None
+        slope = np.polyfit(times[mask], np.log(error[mask]), 1)[0]
+        return float(-1 / slope) if slope < 0 else None
         
     
 if __name__ == '__main__':
@@ -0,0 +1,13 @@
+from core.alignment import AlignmentCache
+
+
+def test_entries_keep_the_state_of_their_alignment():
+    """A cached alignment returns the fit, coupling scan line and tracking offsets it was stored with."""
+    cache = AlignmentCache()
+    state = {'gaussian_fit_params': (1.0, 5.0, 1.2), 'coupling_log_line': 7, 'tracking_offsets': (0.1, 0.2, 0.0, 0.0, 0.3, 0.4)}
+    cache.store(3, (1.0, 2.0, 3.0), ((5.0, 5.0),) * 3, (1.0, 1.0, 1.0), state)
+    cache.store(4, (1.0, 2.1, 3.0), ((5.0, 5.0),) * 3, (1.0, 1.0, 1.0))
+    state['coupling_log_line'] = 9
+    assert cache.get(3)['state']['coupling_log_line'] == 7
+    assert cache.get(3)['state']['gaussian_fit_params'] == (1.0, 5.0, 1.2)
+    assert cache.get(4)['state'] == {}
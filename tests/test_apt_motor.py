@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+# The devices package opens its VISA instruments through pyvisa
+pytest.importorskip('pyvisa')
+
+from devices.apt import ThorlabsMotor, wait_for_motors
+
+
+class SimulatedMotorControl:
+    """APT motor control whose stage reports moving for move_time after every move, without firing MoveComplete."""
+    def __init__(self, move_time):
+        self.move_time = move_time
+        self.stop_time = 0.0
+
+    def dynamicCall(self, signature, arguments=None):
+        if signature.startswith('MoveRelative') or signature.startswith('MoveAbsolute'):
+            self.stop_time = time.perf_counter() + self.move_time
+        elif signature.startswith('LLGetStatusBits'):
+            arguments[1] = 0x10 if time.perf_counter() < self.stop_time else 0
+        elif signature.startswith('GetPosition'):
+            arguments[1] = 0.0
+
+
+def simulated_motor(move_time):
+    return ThorlabsMotor(SimulatedMotorControl(move_time), HWSerialNum=0, IChanID=0, fMinVel=0, fAccn=0.2, fMaxVel=0.5, fStepSize=0.001, fMinPos=-50, fMaxPos=50, IUnits=1, fPitch=1, IDirSense=1, IRewLimSwitch=1, IFwdLimSwitch=1)
+
+
+def test_wait_polls_until_the_stage_stops():
+    """A stage slower than its velocity profile is waited for past the event timeout, without the event."""
+    motor = simulated_motor(move_time=0.3)
+    motor.move_relative(0.001)
+    elapsed = motor.wait_for_move(timeout=0.05)
+    assert elapsed >= 0.3
+    assert not motor.is_moving()
+    assert motor.move_log[-1]['stopped']
+
+
+def test_wait_raises_when_the_stage_does_not_stop():
+    """A stage still moving at the hard limit is reported instead of returned as finished."""
+    motor = simulated_motor(move_time=10.0)
+    motor.move_relative(0.001)
+    with pytest.raises(RuntimeError):
+        motor.wait_for_move(timeout=0.05, max_wait=0.2)
+    assert not motor.move_log[-1]['stopped']
+    assert motor.move_start is None
+
+
+def test_wait_for_motors_waits_for_every_motor():
+    """All motors are waited for before a stage that did not stop is reported."""
+    stuck, slow = simulated_motor(move_time=10.0), simulated_motor(move_time=0.3)
+    stuck.move_relative(0.001)
+    slow.move_relative(0.001)
+    with pytest.raises(RuntimeError):
+        wait_for_motors((stuck, slow), timeout=0.05, max_wait=0.5)
+    assert slow.move_log[-1]['stopped']
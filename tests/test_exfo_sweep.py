@@ -0,0 +1,57 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pyvisa')
+
+from tests.test_exfo_trace import TRACE, SimulatedCTP10
+
+
+def test_laser_is_reset_after_every_sweep():
+    """The sense state and the 1550 nm laser wavelength are restored after each sweep, not only the first."""
+    device = SimulatedCTP10('REAL32')
+    device.Completion_Mode = 'poll'
+    for _ in range(3):
+        assert device.perform_scan(timeout=1.0) == (0, '"No error"')
+    assert device.inst.commands.count('INIT:FBC:SENS 1') == 3
+    assert device.inst.commands.count('CTP:RLAS1:WAV 1550NM') == 3
+
+
+def test_scan_parameters_are_cached():
+    """Repeated scan parameters reach the instrument only once."""
+    device = SimulatedCTP10('REAL32')
+    for _ in range(3):
+        device.set_scan_parameters(1500, 1600, 1, 50, 3.0)
+    assert device.inst.commands.count(':INIT:WAV:STAR 1500.000NM') == 1
+    assert device.state_cache.counters() == (7, 14)
+
+
+def sweep_and_download(pipelined):
+    """Runs a sweep and downloads the trace of the previous one, one after the other or overlapped as in LoopWorker.sweep_waveguide."""
+    # 0.4 s sweep and 7 chunks of 50 ms, about as long as the sweep
+    device = SimulatedCTP10('REAL32', sweep_time=0.4, chunk_time=0.05, Start_WL=1500, Stop_WL=1520, Laser_Speed=50)
+    device.Chunk_Size = 8
+    memory_trace_type = device.copy_trace_to_memory()
+    result = {}
+    time_start = time.perf_counter()
+    if pipelined:
+        thread = threading.Thread(target=lambda: result.update(traces=device.retrieve_channels([(1, 1)], trace_type=memory_trace_type)))
+        thread.start()
+        error = device.perform_scan(timeout=2.0)
+        thread.join()
+    else:
+        error = device.perform_scan(timeout=2.0)
+        result['traces'] = device.retrieve_channels([(1, 1)], trace_type=memory_trace_type)
+    assert error[0] == 0
+    np.testing.assert_array_equal(result['traces'][0], TRACE)
+    return time.perf_counter() - time_start
+
+
+def test_pipelined_download_overlaps_sweep():
+    """The download only locks the socket per chunk, so the sweep polls in between and both overlap."""
+    serial = sweep_and_download(pipelined=False)
+    pipelined = sweep_and_download(pipelined=True)
+    assert serial > 0.7
+    assert pipelined < 0.75 * serial
@@ -0,0 +1,148 @@
+import time
+
+import numpy as np
+import pytest
+
+visa = pytest.importorskip('pyvisa')
+
+from devices.exfo import EXFOCTP10
+
+
+# Values exactly representable as float32, so all transfer formats must return identical arrays
+TRACE = np.round(np.linspace(-60.0, -3.0, 50), 2).astype(np.float32).astype(np.float64)
+
+
+class SimulatedInstrument:
+    """
+    Socket of a CTP10 that serves the trace as IEEE-488.2 block or ASCII line, depending on :FORM:DATA.
+
+    A sweep reports a busy condition register for sweep_time after :INIT, every trace request takes chunk_time.
+    """
+    def __init__(self, trace, terminator=b'\r\n', sweep_time=0.0, chunk_time=0.0):
+        self.trace = trace
+        self.terminator = terminator
+        self.sweep_time = sweep_time
+        self.chunk_time = chunk_time
+        self.sweep_end = 0.0
+        self.timeout = 5000
+        self.data_format = 'ASC'
+        self.ascii_responses = []
+        self.binary_buffer = b''
+        self.data_queries = 0
+        self.commands = []
+        self.queries = []
+
+    def write(self, command):
+        self.commands.append(command)
+        if command == ':INIT':
+            self.sweep_end = time.perf_counter() + self.sweep_time
+        elif command.startswith(':FORM:DATA '):
+            self.data_format = command.split()[-1]
+        elif ':DATA? ' in command:
+            self.data_queries += 1
+            time.sleep(self.chunk_time)
+            arguments = command.split(':DATA? ')[1].split(',')
+            start = int(arguments[0])
+            count = int(arguments[1]) if len(arguments) == 3 else len(self.trace) - start
+            self.respond(self.trace[start:start + count])
+
+    def respond(self, values):
+        if self.data_format == 'ASC':
+            self.ascii_responses.append(','.join(repr(float(value)) for value in values))
+            return
+        dtype = {'REAL,32': '<f4', 'REAL,64': '<f8'}[self.data_format]
+        payload = np.asarray(values, dtype=dtype).tobytes()
+        length = str(len(payload)).encode()
+        self.binary_buffer += b'#' + str(len(length)).encode() + length + payload + self.terminator
+
+    def query(self, command):
+        self.queries.append(command)
+        if command.endswith(':DATA:LENG?'):
+            return str(len(self.trace))
+        if command.endswith(':DATA:STAR?'):
+            return '1.5E-06'
+        if command.endswith(':DATA:SAMP?'):
+            return '1E-12'
+        if command == ':STAT:OPER:COND?':
+            return '1' if time.perf_counter() < self.sweep_end else '0'
+        if command == ':SYST:ERR?':
+            return '0,"No error"'
+        return '0'
+
+    def read(self):
+        return self.ascii_responses.pop(0)
+
+    def read_bytes(self, count):
+        if len(self.binary_buffer) < count:
+            # VI_ERROR_TMO, the read would wait for bytes the instrument never sends
+            raise visa.errors.VisaIOError(-1073807339)
+        data, self.binary_buffer = self.binary_buffer[:count], self.binary_buffer[count:]
+        return data
+
+    def clear(self):
+        self.binary_buffer = b''
+        self.ascii_responses = []
+
+
+class SimulatedCTP10(EXFOCTP10):
+    """CTP10 connected to a SimulatedInstrument instead of a VISA socket."""
+    def __init__(self, trace_format, trace=TRACE, terminator=b'\r\n', sweep_time=0.0, chunk_time=0.0, **settings):
+        self.simulated = SimulatedInstrument(trace, terminator, sweep_time, chunk_time)
+        super().__init__('127.0.0.1', 5025, 1, 1, 1, Trace_Format=trace_format, **settings)
+
+    def connect(self):
+        self.inst = self.simulated
+
+
+@pytest.mark.parametrize('trace_format', ['REAL32', 'REAL64', 'ASCii'])
+def test_retrieve_trace_matches_ascii(trace_format):
+    """The binary block and the ASCII transfer return identical arrays."""
+    ascii_trace = SimulatedCTP10('ASCii').retrieve_trace()
+    trace = SimulatedCTP10(trace_format).retrieve_trace()
+    assert trace.dtype == np.float64
+    np.testing.assert_array_equal(trace, ascii_trace)
+    np.testing.assert_array_equal(trace, TRACE)
+
+
+@pytest.mark.parametrize('trace_format', ['REAL32', 'REAL64', 'ASCii'])
+@pytest.mark.parametrize('chunk_size', [7, 50, 1000])
+def test_stream_trace_matches_ascii(trace_format, chunk_size):
+    """The chunked transfer returns the same array as the single ASCII transfer."""
+    device = SimulatedCTP10(trace_format)
+    trace = device.stream_trace(chunk_size=chunk_size)
+    np.testing.assert_array_equal(trace, SimulatedCTP10('ASCii').retrieve_trace())
+    assert device.inst.data_queries == -(-len(TRACE) // chunk_size)
+    assert device.inst.data_format == 'ASC'
+
+
+@pytest.mark.parametrize('trace_format', ['REAL32', 'REAL64'])
+def test_binary_block_with_bare_newline(trace_format):
+    """A block terminated by '\\n' only is decoded without falling back to ASCII."""
+    device = SimulatedCTP10(trace_format, terminator=b'\n')
+    np.testing.assert_array_equal(device.retrieve_trace(), TRACE)
+    np.testing.assert_array_equal(device.stream_trace(chunk_size=16), TRACE)
+    assert device.inst.data_queries == 1 + 4
+    assert device.inst.binary_buffer == b''
+
+
+def test_retrieve_channels_streams_every_channel():
+    """All channels of a sweep are streamed into one array."""
+    device = SimulatedCTP10('REAL32')
+    traces = device.retrieve_channels([(1, 1), (1, 2), (2, 1)])
+    assert traces.shape == (3, len(TRACE))
+    np.testing.assert_array_equal(traces, np.tile(TRACE, (3, 1)))
+
+
+def test_wavelength_array_of_memory_slot():
+    """The axis of a memory slot is queried from that slot and cached apart from the live trace."""
+    device = SimulatedCTP10('REAL32')
+    memory_trace_type = device.copy_trace_to_memory()
+    axis = device.create_wavelength_array(trace_type=memory_trace_type)
+    axis_queries = [query for query in device.inst.queries if ':DATA:' in query]
+    assert len(axis_queries) == 3
+    assert all(f'TYPE{memory_trace_type}:' in query for query in axis_queries)
+    assert len(axis) == len(TRACE)
+    assert axis[0] == pytest.approx(1500.0)
+    assert device.create_wavelength_array(trace_type=memory_trace_type) is axis
+    assert device.create_wavelength_array() is not axis
+    assert len(device.inst.queries) == 6
@@ -0,0 +1,41 @@
+import pytest
+
+pytest.importorskip('pyvisa')
+
+from devices import keithley
+
+
+class SimulatedUnit:
+    """GPIB resource of a Keithley 2400 that records the commands and the element format of every :READ?."""
+    def __init__(self):
+        self.commands = []
+        self.elements = keithley.Keithley2400.DEFAULT_ELEMENTS
+        self.read_elements = []
+
+    def write(self, command):
+        self.commands.append(command)
+        if command == '*RST':
+            self.elements = keithley.Keithley2400.DEFAULT_ELEMENTS
+        elif command.startswith(':FORM:ELEM '):
+            self.elements = command.split()[-1]
+
+    def query(self, command):
+        self.read_elements.append(self.elements)
+        return '1.0'
+
+
+class SimulatedResourceManager:
+    def open_resource(self, resource):
+        return SimulatedUnit()
+
+
+def test_power_is_read_with_the_default_elements(monkeypatch):
+    """The power reading after the settle monitor's voltage readings uses the same elements as without them."""
+    monkeypatch.setattr(keithley, 'rm', SimulatedResourceManager())
+    device = keithley.Keithley2400(26)
+    device.measure_power()
+    for _ in range(3):
+        device.measure_voltage()
+    device.measure_power()
+    device.measure_voltage()
+    assert device.unit.read_elements == [keithley.Keithley2400.DEFAULT_ELEMENTS] + ['VOLT'] * 3 + [keithley.Keithley2400.DEFAULT_ELEMENTS, 'VOLT']
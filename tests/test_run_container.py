@@ -0,0 +1,43 @@
+import json
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip('h5py')
+
+from core.run_container import RunContainer, convert_json_folder
+
+
+def test_records_keep_their_run_log_lines(tmp_path):
+    """Every record stores the lines of its sidecar entries, -1 where it has none."""
+    container = RunContainer(str(tmp_path / 'run.h5'), [0.08, 0.09])
+    wavelength = np.linspace(1500, 1600, 11)
+    container.append(0, 0, wavelength, wavelength, wavelength, run_log_lines={'keithley_power': 3, 'coupling_scan': 5})
+    container.append(1, 2, wavelength, wavelength, wavelength, run_log_lines={'keithley_power': 9})
+    container.close()
+    with h5py.File(str(tmp_path / 'run.h5'), 'r') as run_file:
+        lines = run_file['run_log_lines']
+        assert list(lines.attrs['columns']) == list(RunContainer.RUN_LOG_SERIES)
+        np.testing.assert_array_equal(lines[0, 0], [3, 5])
+        np.testing.assert_array_equal(lines[1, 2], [9, -1])
+        np.testing.assert_array_equal(lines[0, 1], [-1, -1])
+
+
+def test_convert_json_folder_keeps_references(tmp_path):
+    """Converted JSON files keep their sidecar references."""
+    for waveguide in range(2):
+        measurement = {
+            'metadata': {
+                'sampling_resolution_pm': 1, 'laser_sweep_speed_nm_per_s': 50, 'laser_power_dbm': 3.0,
+                'gaussian_fit_params': [1.0, 5.0, 1.0],
+                'keithley_power': {'file': 'x_run.jsonl', 'line': 10 + waveguide},
+                'coupling_scan': None
+            },
+            'data': {'wavelength_nm': [1500.0, 1501.0], 'il_te_db': [-3.0, -4.0], 'il_tm_db': [-5.0, -6.0]}
+        }
+        with open(tmp_path / f'2024_output_{waveguide}_current_0.080000A.json', 'w') as json_file:
+            json.dump(measurement, json_file)
+    assert convert_json_folder(str(tmp_path), str(tmp_path / 'run.h5')) == 2
+    with h5py.File(str(tmp_path / 'run.h5'), 'r') as run_file:
+        assert run_file.attrs['run_log'] == 'x_run.jsonl'
+        np.testing.assert_array_equal(run_file['run_log_lines'][0, :], [[10, -1], [11, -1]])
@@ -0,0 +1,81 @@
+import json
+import os
+
+import pytest
+
+from core.run_estimator import RunEstimator
+from core.waveguide_planner import WaveguidePlanner
+
+
+def write_log(path, entries):
+    with open(path, 'w') as log_file:
+        for entry in entries:
+            log_file.write(json.dumps(entry) + '\n')
+
+
+def calibrated_estimator(tmp_path, monkeypatch):
+    """Calibrates an estimator from one run log: 10 s trackings, 30 s 1D coupling scans and 2 s checks with one miss in four."""
+    monkeypatch.setattr(RunEstimator, 'log_cache', {})
+    checks = [{'kind': 'alignment_check', 'verified': verified, 'time_s': 2.0, 'signals': [1.0, 1.0, 1.0]} for verified in (True, True, True, False)]
+    # The align steps of cached visits include motor travel and re-tracking, they must not calibrate the check
+    steps = [
+        {'name': 'current 0 waveguide 0 sweep', 'start_s': 0.0, 'end_s': 10.0, 'skipped': False, 'error': None},
+        {'name': 'current 1 waveguide 0 align', 'start_s': 10.0, 'end_s': 50.0, 'skipped': False, 'error': None},
+        {'name': 'current 1 waveguide 0 download', 'start_s': 50.0, 'end_s': 80.0, 'skipped': False, 'error': None}
+    ]
+    write_log(str(tmp_path / '2024_run.jsonl'), [
+        {'kind': 'recipe', 'sweep_time_s': 2.0, 'trace_points': 100001, 'coupling_strategy': '1D'},
+        {'kind': 'traversal', 'order': 'current_outer', 'predicted_total_s': 100.0},
+        {'kind': 'tracking', 'time_s': 10.0},
+        {'kind': 'coupling', 'scan_type': '1D', 'points': 21, 'scan_time_s': 30.0}
+    ] + checks + [{'kind': 'timeline', 'steps': steps}])
+    estimator = RunEstimator()
+    assert estimator.calibrate(str(tmp_path)) == 1
+    return estimator
+
+
+def test_calibrate_fits_the_check_time_and_the_prediction_error(tmp_path, monkeypatch):
+    """The verify phase is the logged check time, the cache miss rate and prediction error come from the same log."""
+    estimator = calibrated_estimator(tmp_path, monkeypatch)
+    costs = estimator.costs(2.0, 100001, '1D')
+    assert costs['verify_s'] == pytest.approx(2.0)
+    assert costs['cache_miss_rate'] == pytest.approx(0.25)
+    assert costs['tracking_s'] == pytest.approx(10.0)
+    assert costs['coupling_s'] == pytest.approx(30.0)
+    assert estimator.runs[0]['error'] == pytest.approx(0.25)
+    assert '+25%' in estimator.summary(1)
+
+
+def test_estimate_counts_moves_and_misses_once(tmp_path, monkeypatch):
+    """Cached visits cost the check plus the re-tracking of the missed share, the moves are a phase of their own."""
+    estimator = calibrated_estimator(tmp_path, monkeypatch)
+    planner = WaveguidePlanner(1, 4, 4, 0.25, 0.127, 1.0)
+    estimate = estimator.estimate([0.08, 0.09], planner, 1500, 1600, 1, 50, scan_type='1D', traversal_order='current_outer')
+    phases = estimate['estimates']['current_outer']
+    assert estimate['order'] == 'current_outer'
+    # First pass aligns every waveguide, the second verifies it and tracks a quarter of them again
+    assert phases['align_s'] == pytest.approx(4 * (10.0 + 30.0) + 4 * (2.0 + 0.25 * (10.0 + 30.0)))
+    assert phases['move_s'] > 0
+    assert phases['initial_s'] == pytest.approx(RunEstimator.DEFAULTS['initial_temperature'][0])
+    assert estimate['total_s'] == pytest.approx(phases['total_s'])
+    fastest = estimator.estimate([0.08, 0.09], planner, 1500, 1600, 1, 50, scan_type='1D')
+    assert fastest['total_s'] == min(candidate['total_s'] for candidate in fastest['estimates'].values())
+
+
+def test_unchanged_logs_are_read_from_the_cache(tmp_path, monkeypatch):
+    """A run log is parsed once and again only after it changed, without the arrays of its entries."""
+    monkeypatch.setattr(RunEstimator, 'log_cache', {})
+    path = str(tmp_path / '2024_run.jsonl')
+    coupling = {'kind': 'coupling', 'scan_type': '1D', 'points': 21, 'scan_time_s': 30.0, 'sampled_power_dbm': [-40.0, -30.0], 'gaussian_fit_params': [1.0, 0.0, 2.0]}
+    write_log(path, [{'kind': 'tracking', 'time_s': 10.0}, coupling])
+    opened = []
+    real_open = open
+    monkeypatch.setattr('builtins.open', lambda *args, **kwargs: opened.append(args[0]) or real_open(*args, **kwargs))
+    assert RunEstimator().calibrate(str(tmp_path)) == 1
+    assert RunEstimator().calibrate(str(tmp_path)) == 1
+    assert opened == [path]
+    assert RunEstimator.log_cache[path][1] == [{'kind': 'tracking', 'time_s': 10.0}, {'kind': 'coupling', 'scan_type': '1D', 'points': 21, 'scan_time_s': 30.0}]
+    monkeypatch.setattr('builtins.open', real_open)
+    write_log(path, [{'kind': 'tracking', 'time_s': 10.0}, {'kind': 'tracking', 'time_s': 12.0}])
+    os.utime(path, (1, 1))
+    assert len(RunEstimator().read_log(path)) == 2
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from core.step_scheduler import StepScheduler
+
+
+def test_steps_wait_for_their_dependencies():
+    """A step starts only after every step it depends on has finished."""
+    scheduler = StepScheduler()
+    order = []
+    first = scheduler.add('first', lambda: (time.sleep(0.05), order.append('first')))
+    second = scheduler.add('second', lambda: order.append('second'), depends_on=(first,))
+    scheduler.add('third', lambda: order.append('third'), depends_on=(second, None))
+    timeline = {step['name']: step for step in scheduler.run()}
+    assert order == ['first', 'second', 'third']
+    assert timeline['first']['end_s'] <= timeline['second']['start_s']
+
+
+def test_steps_sharing_a_resource_do_not_overlap():
+    """Steps on the same device run one after another, steps on different devices run at the same time."""
+    scheduler = StepScheduler()
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def occupy():
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.05)
+        with lock:
+            running['now'] -= 1
+
+    scheduler.add('sweep 0', occupy, resources=('exfo',))
+    scheduler.add('sweep 1', occupy, resources=('exfo', 'switches'))
+    scheduler.run()
+    assert running['max'] == 1
+
+    scheduler = StepScheduler()
+    scheduler.add('download', occupy, resources=('exfo',))
+    scheduler.add('align', occupy, resources=('motors',))
+    scheduler.run()
+    assert running['max'] == 2
+
+
+def test_failed_step_skips_the_rest_of_its_group():
+    """The steps of a group that have not started are skipped after a failure, other groups go on."""
+    errors = []
+    scheduler = StepScheduler(error_callback=lambda step, e: errors.append((step.name, str(e))))
+    ran = []
+
+    def fail():
+        raise RuntimeError("Scan failed")
+
+    align = scheduler.add('waveguide 0 align', fail, group='waveguide 0')
+    sweep = scheduler.add('waveguide 0 sweep', lambda: ran.append('waveguide 0 sweep'), depends_on=(align,), group='waveguide 0')
+    scheduler.add('waveguide 1 align', lambda: ran.append('waveguide 1 align'), depends_on=(sweep,), group='waveguide 1')
+    timeline = {step['name']: step for step in scheduler.run()}
+    assert ran == ['waveguide 1 align']
+    assert errors == [('waveguide 0 align', 'Scan failed')]
+    assert timeline['waveguide 0 align']['error'] == 'Scan failed'
+    assert timeline['waveguide 0 sweep']['skipped'] and timeline['waveguide 0 sweep']['start_s'] is None
+    assert not timeline['waveguide 1 align']['skipped']
+
+
+def test_stop_event_skips_the_steps_not_started():
+    """Once the stop event is set the running steps finish and no further step starts."""
+    scheduler = StepScheduler()
+    stop_event = threading.Event()
+    ran = []
+    first = scheduler.add('first', lambda: (ran.append('first'), stop_event.set()))
+    second = scheduler.add('second', lambda: ran.append('second'), depends_on=(first,))
+    scheduler.add('third', lambda: ran.append('third'), depends_on=(second,))
+    timeline = scheduler.run(stop_event)
+    assert ran == ['first']
+    assert [step['skipped'] for step in timeline] == [False, True, True]
@@ -0,0 +1,16 @@
+import pytest
+
+from core.waveguide_planner import WaveguidePlanner
+
+
+def test_output_groups_stay_on_their_chip():
+    """Every group of outputs measured in one sweep starts and ends on the same chip."""
+    planner = WaveguidePlanner(2, 3, 6, 0.25, 0.127, 1.0, outputs_per_sweep=2)
+    assert [target['waveguide'] for target in planner.targets] == [0, 2, 4, 6, 8, 10]
+    assert {target['chip'] for target in planner.targets if target['waveguide'] >= 6} == {1}
+
+
+def test_outputs_per_chip_must_divide_into_groups():
+    """Groups that would reach into the next chip are rejected."""
+    with pytest.raises(ValueError):
+        WaveguidePlanner(2, 5, 5, 0.25, 0.127, 1.0, outputs_per_sweep=2)